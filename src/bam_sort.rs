@@ -1,26 +1,113 @@
 use std::collections::{HashMap, HashSet};
 use std::path::Path;
 
+use log::warn;
 use rust_htslib::{
     bam, bam::Read, bam::Reader as BamReader, bam::Record, bam::Writer as BamWriter,
 };
 
-const KEEP_CHROMS: &'static [&'static str] = &[
-    "chr1", "chr2", "chr3", "chr4", "chr5", "chr6", "chr7", "chr8", "chr9", "chr10", "chr11",
-    "chr12", "chr13", "chr14", "chr15", "chr16", "chr17", "chr18", "chr19", "chr20", "chr21",
-    "chr22",
-];
+/// Contigs at least this long get their own output when none are named.
+pub const DEFAULT_MIN_CONTIG_LENGTH: u64 = 1_000_000;
 
-pub fn run_bam_sort(p: &str) -> Result<Vec<(String, String)>, String> {
+/// Which contigs are split out on their own, the rest (unplaced, alt, decoy
+/// and other small contigs) share `misc_buckets` outputs, or are dropped when
+/// there are none.
+pub struct ContigSelection {
+    pub contigs: Option<Vec<String>>,
+    pub min_length: u64,
+    pub misc_buckets: usize,
+}
+
+/// The output group of every contig by tid, `None` for dropped contigs. This
+/// only depends on the header, so every shard of a sample agrees on it.
+fn assign_contigs(
+    targets: &[String],
+    lengths: &[u64],
+    selection: &ContigSelection,
+) -> Vec<Option<String>> {
+    let named = selection
+        .contigs
+        .as_ref()
+        .map(|c| c.iter().collect::<HashSet<_>>());
+    let mut groups = vec![None; targets.len()];
+    let mut misc = Vec::new();
+    for (tid, target) in targets.iter().enumerate() {
+        let own = match &named {
+            Some(named) => named.contains(target),
+            None => lengths[tid] >= selection.min_length,
+        };
+        if own {
+            groups[tid] = Some(target.clone());
+        } else {
+            misc.push(tid);
+        }
+    }
+    if selection.misc_buckets == 0 {
+        if !misc.is_empty() {
+            warn!("dropping alignments to {} unselected contigs", misc.len());
+        }
+        return groups;
+    }
+    // longest first into the emptiest bucket, so buckets hold similar lengths
+    misc.sort_by_key(|&tid| (std::cmp::Reverse(lengths[tid]), tid));
+    let mut bucket_lengths = vec![0u64; selection.misc_buckets];
+    for tid in misc {
+        let bucket = (0..bucket_lengths.len())
+            .min_by_key(|&b| (bucket_lengths[b], b))
+            .unwrap();
+        bucket_lengths[bucket] += lengths[tid];
+        groups[tid] = Some(format!("misc_{}", bucket));
+    }
+    groups
+}
+
+/// The start of the fragment a record belongs to, the leftmost position of
+/// either mate, so both mates of a pair (and duplicates of the fragment, which
+/// deduplicate_bismark recognises by position) land in the same window.
+fn fragment_start(record: &Record) -> i64 {
+    if record.is_paired() && !record.is_mate_unmapped() && record.mtid() == record.tid() {
+        record.pos().min(record.mpos())
+    } else {
+        record.pos()
+    }
+}
+
+fn region_name(chrom: &str, window: Option<(u64, u64)>) -> String {
+    match window {
+        Some((start, end)) => format!("{}:{}-{}", chrom, start, end),
+        None => chrom.to_string(),
+    }
+}
+
+/// Split the alignments of `p` by the contigs of `selection`, or with
+/// `window_bp` into windows of that many bases of each of those contigs,
+/// named `chrom:start-end`. Other contigs go to `misc_N` buckets whole. `p`
+/// has to be sorted by read name, so are the outputs, which keeps the mates
+/// of a pair next to each other. Every output stays open until `p` is read
+/// through, a file descriptor and BGZF writer each: about 310 windows of a
+/// human genome at 10 Mb, so much smaller windows need a higher `ulimit -n`
+/// than the usual 1024 (the workflow sizes their memory with
+/// `ResourceModel.split_window_bytes`).
+pub fn run_bam_sort(
+    p: &str,
+    window_bp: Option<u64>,
+    selection: &ContigSelection,
+) -> Result<Vec<(String, String)>, String> {
     let mut bam_reader = BamReader::from_path(p).map_err(|e| e.to_string())?;
     let mut record = Record::new();
 
-    let keep_chroms = KEEP_CHROMS.iter().collect::<HashSet<_>>();
     let path = Path::new(p);
     let parent_path = path.parent().ok_or("should not be root".to_string())?;
     let filename = path.file_stem().ok_or("should get filename".to_string())?;
     let filename = filename.to_str().ok_or("should make string".to_string())?;
 
+    let header_text = String::from_utf8_lossy(bam_reader.header().as_bytes()).to_string();
+    if !header_text
+        .lines()
+        .any(|l| l.starts_with("@HD") && l.contains("SO:queryname"))
+    {
+        return Err(format!("{} is not sorted by read name", p));
+    }
     let header = bam::Header::from_template(bam_reader.header());
     let targets = bam_reader
         .header()
@@ -28,13 +115,17 @@ pub fn run_bam_sort(p: &str) -> Result<Vec<(String, String)>, String> {
         .iter()
         .map(|t| String::from_utf8_lossy(t).to_string())
         .collect::<Vec<String>>();
+    let target_lengths = (0..targets.len())
+        .map(|tid| bam_reader.header().target_len(tid as u32).unwrap_or(0))
+        .collect::<Vec<u64>>();
+    let groups = assign_contigs(&targets, &target_lengths, selection);
 
     let mut writers = HashMap::new();
-    let writer_maker = |chrom: &str| -> (String, BamWriter) {
-        let chrom_filename = format!("{}_{}.bam", chrom, filename);
-        let writer_path = Path::new(parent_path).join(&chrom_filename);
+    let writer_maker = |region: &str| -> (String, BamWriter) {
+        let region_filename = format!("{}_{}.bam", region.replace(':', "_"), filename);
+        let writer_path = Path::new(parent_path).join(&region_filename);
         (
-            chrom_filename,
+            region_filename,
             BamWriter::from_path(writer_path, &header, bam::Format::BAM)
                 .expect("should make writer"),
         )
@@ -44,13 +135,28 @@ pub fn run_bam_sort(p: &str) -> Result<Vec<(String, String)>, String> {
     while let Some(result) = bam_reader.read(&mut record) {
         match result {
             Ok(_) => {
+                if record.tid() < 0 {
+                    // unmapped, bismark doesn't write these by default
+                    continue;
+                }
                 let tid = record.tid() as usize;
                 assert!(tid < targets.len());
-                let target_name = targets[tid].as_str();
-                if keep_chroms.contains(&target_name) {
-                    let writer = writers.entry(target_name).or_insert_with(|| {
-                        let (file_path, writer) = writer_maker(target_name);
-                        writer_paths.push((target_name.to_string(), file_path));
+                if let Some(group) = &groups[tid] {
+                    let own = group == &targets[tid];
+                    let window = window_bp.filter(|_| own).map(|bp| {
+                        let start = (fragment_start(&record).max(0) as u64 / bp) * bp;
+                        let length = target_lengths[tid];
+                        let end = if length > start {
+                            length.min(start + bp)
+                        } else {
+                            start + bp
+                        };
+                        (start, end)
+                    });
+                    let writer = writers.entry((group, window)).or_insert_with(|| {
+                        let region = region_name(group, window);
+                        let (file_path, writer) = writer_maker(&region);
+                        writer_paths.push((region, file_path));
                         writer
                     });
                     writer.write(&record).map_err(|e| e.to_string())?;
@@ -68,9 +174,49 @@ mod bam_sort_tests {
 
     use rust_htslib::{bam, bam::Read, bam::Reader as BamReader, bam::Record};
 
+    use super::{assign_contigs, region_name, ContigSelection};
+
+    #[test]
+    fn test_assign_contigs() {
+        let targets = ["chr1", "chr2", "chrM", "chrUn_1", "chrUn_2", "chr1_alt"]
+            .iter()
+            .map(|t| t.to_string())
+            .collect::<Vec<String>>();
+        let lengths = [248_956_422, 242_193_529, 16_569, 40_000, 30_000, 20_000];
+        let by_length = ContigSelection {
+            contigs: None,
+            min_length: 1_000_000,
+            misc_buckets: 2,
+        };
+        let groups = assign_contigs(&targets, &lengths, &by_length);
+        assert_eq!(groups[0].as_deref(), Some("chr1"));
+        assert_eq!(groups[1].as_deref(), Some("chr2"));
+        assert_eq!(groups[3].as_deref(), Some("misc_0"));
+        assert_eq!(groups[4].as_deref(), Some("misc_1"));
+        assert_eq!(groups[5].as_deref(), Some("misc_1"));
+        assert_eq!(groups[2].as_deref(), Some("misc_0"));
+
+        let named = ContigSelection {
+            contigs: Some(vec!["chr2".to_string(), "chrM".to_string()]),
+            min_length: 1_000_000,
+            misc_buckets: 0,
+        };
+        let groups = assign_contigs(&targets, &lengths, &named);
+        assert_eq!(groups[0], None);
+        assert_eq!(groups[1].as_deref(), Some("chr2"));
+        assert_eq!(groups[2].as_deref(), Some("chrM"));
+    }
+
+    #[test]
+    fn test_region_name() {
+        assert_eq!(region_name("chr1", None), "chr1");
+        assert_eq!(region_name("chr1", Some((0, 5000))), "chr1:0-5000");
+    }
+
     #[test]
     fn test_bam_sort_basic() {
-        let mut bam = BamReader::from_path("resources/shard_0.bam").expect("should get reader");
+        let mut bam =
+            BamReader::from_path("resources/methylation_call.sam").expect("should get reader");
         let mut record = Record::new();
 
         let targets = bam
@@ -2,27 +2,236 @@ use bio::io::fastq::Record as FqRecord;
 use bio::io::fastq::{Reader as FqReader, Writer as FqWriter};
 use fasthash::murmur3;
 use flate2::read::MultiGzDecoder;
+use flate2::write::GzEncoder;
+use flate2::Compression;
 use log::{info, warn};
 use std::collections::HashMap;
 use std::fs::File;
-use std::path::Path;
+use std::io::{self, Read, Write};
+use std::path::{Path, PathBuf};
+use std::sync::mpsc::{sync_channel, Receiver, SyncSender};
+use std::thread::{self, JoinHandle};
+
+/// Bytes passed between threads at a time, decoded input or shard output.
+const CHUNK_SIZE: usize = 256 * 1024;
+/// Chunks a thread queues up for the next one before it waits.
+const QUEUED_CHUNKS: usize = 16;
+
+/// How shards are written. With a `level` they are gzip compressed, which
+/// trim_galore reads as they are, on `threads` compressor threads. More than
+/// one thread also decodes each input on its own thread.
+pub struct ShardCompression {
+    pub level: Option<u32>,
+    pub threads: u32,
+}
+
+impl ShardCompression {
+    pub fn plain() -> Self {
+        Self {
+            level: None,
+            threads: 1,
+        }
+    }
+}
+
+/// A gzipped input decoded on a thread of its own, so decoding both mates
+/// runs alongside parsing and sharding them.
+struct DecodedReads {
+    receiver: Receiver<io::Result<Vec<u8>>>,
+    chunk: Vec<u8>,
+    position: usize,
+}
+
+impl DecodedReads {
+    fn open(file_path: &str) -> Result<Self, String> {
+        let f = File::open(file_path).map_err(|e| format!("{}, {}", file_path, e))?;
+        let (sender, receiver) = sync_channel(QUEUED_CHUNKS);
+        thread::spawn(move || {
+            let mut decoder = MultiGzDecoder::new(f);
+            loop {
+                let mut chunk = vec![0u8; CHUNK_SIZE];
+                match decoder.read(&mut chunk) {
+                    Ok(0) => return,
+                    Ok(n) => {
+                        chunk.truncate(n);
+                        // a dropped receiver means the split stopped reading
+                        if sender.send(Ok(chunk)).is_err() {
+                            return;
+                        }
+                    }
+                    Err(e) if e.kind() == io::ErrorKind::Interrupted => continue,
+                    Err(e) => {
+                        let _ = sender.send(Err(e));
+                        return;
+                    }
+                }
+            }
+        });
+        Ok(Self {
+            receiver,
+            chunk: Vec::new(),
+            position: 0,
+        })
+    }
+}
+
+impl Read for DecodedReads {
+    fn read(&mut self, buf: &mut [u8]) -> io::Result<usize> {
+        while self.position == self.chunk.len() {
+            match self.receiver.recv() {
+                Ok(chunk) => {
+                    self.chunk = chunk?;
+                    self.position = 0;
+                }
+                // the decoder is done, and dropped its sender
+                Err(_) => return Ok(0),
+            }
+        }
+        let n = buf.len().min(self.chunk.len() - self.position);
+        buf[..n].copy_from_slice(&self.chunk[self.position..self.position + n]);
+        self.position += n;
+        Ok(n)
+    }
+}
+
+/// The write end of a compressed shard, which passes its bytes in chunks to
+/// the compressor thread the shard belongs to.
+struct ShardSender {
+    shard: usize,
+    buffer: Vec<u8>,
+    sender: SyncSender<(usize, Vec<u8>)>,
+}
+
+impl ShardSender {
+    fn send_buffer(&mut self) -> io::Result<()> {
+        if self.buffer.is_empty() {
+            return Ok(());
+        }
+        let chunk = std::mem::replace(&mut self.buffer, Vec::with_capacity(CHUNK_SIZE));
+        self.sender
+            .send((self.shard, chunk))
+            .map_err(|_| io::Error::new(io::ErrorKind::BrokenPipe, "shard compressor stopped"))
+    }
+}
+
+impl Write for ShardSender {
+    fn write(&mut self, buf: &[u8]) -> io::Result<usize> {
+        self.buffer.extend_from_slice(buf);
+        if self.buffer.len() >= CHUNK_SIZE {
+            self.send_buffer()?;
+        }
+        Ok(buf.len())
+    }
+
+    fn flush(&mut self) -> io::Result<()> {
+        self.send_buffer()
+    }
+}
+
+/// Threads gzip compressing shards, shard n on thread n % threads, so each
+/// shard is compressed by one thread in the order it was written.
+struct Compressors {
+    handles: Vec<JoinHandle<Result<(), String>>>,
+}
+
+impl Compressors {
+    fn start(
+        paths: &[PathBuf],
+        level: u32,
+        threads: u32,
+    ) -> Result<(Self, Vec<Box<dyn Write>>), String> {
+        let threads = threads.max(1) as usize;
+        let mut senders = Vec::with_capacity(threads);
+        let mut handles = Vec::with_capacity(threads);
+        for t in 0..threads {
+            let mut encoders = HashMap::new();
+            for (shard, path) in paths.iter().enumerate() {
+                if shard % threads == t {
+                    let f = File::create(path).map_err(|e| format!("{}, {}", path.display(), e))?;
+                    encoders.insert(shard, GzEncoder::new(f, Compression::new(level)));
+                }
+            }
+            let (sender, receiver) = sync_channel(QUEUED_CHUNKS);
+            handles.push(thread::spawn(move || compress_shards(receiver, encoders)));
+            senders.push(sender);
+        }
+        let writers = (0..paths.len())
+            .map(|shard| {
+                Box::new(ShardSender {
+                    shard,
+                    buffer: Vec::with_capacity(CHUNK_SIZE),
+                    sender: senders[shard % threads].clone(),
+                }) as Box<dyn Write>
+            })
+            .collect();
+        Ok((Self { handles }, writers))
+    }
+
+    /// Wait for every shard to be compressed and closed, which happens once
+    /// all of the shard writers are dropped.
+    fn finish(self) -> Result<(), String> {
+        for handle in self.handles {
+            handle
+                .join()
+                .map_err(|_| "shard compressor panicked".to_string())??;
+        }
+        Ok(())
+    }
+}
+
+fn compress_shards(
+    receiver: Receiver<(usize, Vec<u8>)>,
+    mut encoders: HashMap<usize, GzEncoder<File>>,
+) -> Result<(), String> {
+    // ends once every writer, and so every sender, is dropped
+    for (shard, chunk) in receiver {
+        let encoder = encoders.get_mut(&shard).expect("should own shard");
+        encoder.write_all(&chunk).map_err(|e| e.to_string())?;
+    }
+    for (_, encoder) in encoders {
+        encoder.finish().map_err(|e| e.to_string())?;
+    }
+    Ok(())
+}
+
+type ShardWriters = Vec<FqWriter<Box<dyn Write>>>;
 
 struct FqSplitter {
     bins: u32,
+    compression: ShardCompression,
 }
 
 impl FqSplitter {
     fn new(bins: u32) -> Self {
-        Self { bins }
+        Self::with_compression(bins, ShardCompression::plain())
     }
 
-    fn bin_record(&self, fq_record: &FqRecord) -> usize {
-        let s = murmur3::hash32(fq_record.id());
+    fn with_compression(bins: u32, compression: ShardCompression) -> Self {
+        Self { bins, compression }
+    }
+
+    fn bin_name(&self, name: &str) -> usize {
+        let s = murmur3::hash32(name);
         let bucket = s % self.bins;
         bucket as usize
     }
 
-    fn shard_file(&self, file_path: &str) -> Result<(String, Vec<String>), String> {
+    fn bin_record(&self, fq_record: &FqRecord) -> usize {
+        self.bin_name(fq_record.id())
+    }
+
+    /// A reader of gzipped fastq, decoded on its own thread when there are
+    /// threads to spare.
+    fn open_reads(&self, file_path: &str) -> Result<Box<dyn Read>, String> {
+        if self.compression.threads > 1 {
+            return Ok(Box::new(DecodedReads::open(file_path)?));
+        }
+        let f = File::open(Path::new(file_path)).map_err(|e| e.to_string())?;
+        Ok(Box::new(MultiGzDecoder::new(f)))
+    }
+
+    /// The names and paths of the shards of `file_path`, next to it.
+    fn shard_paths(&self, file_path: &str) -> Result<(String, Vec<String>, Vec<PathBuf>), String> {
         let path = Path::new(file_path);
         let parent_path = path.parent().expect("should not be root");
         let filename = path
@@ -30,21 +239,59 @@ impl FqSplitter {
             .ok_or("Failed to get input filename".to_string())?;
         let filename = filename.to_str().expect("should make string").to_string();
 
-        let mut file_shards = Vec::with_capacity(self.bins as usize);
-        let mut writers = (0..self.bins)
-            .map(|bin| {
-                let shard_filename = format!("{}-{:?}", &filename, bin);
-                let outpath = parent_path.join(&shard_filename);
-                let writer = File::create(outpath).expect("should make file");
-                file_shards.push(shard_filename);
-                Ok(FqWriter::new(writer))
-            })
-            .collect::<Result<Vec<FqWriter<File>>, String>>()?;
+        let suffix = if self.compression.level.is_some() {
+            ".gz"
+        } else {
+            ""
+        };
+        let file_shards = (0..self.bins)
+            .map(|bin| format!("{}-{:?}{}", &filename, bin, suffix))
+            .collect::<Vec<String>>();
+        let paths = file_shards.iter().map(|s| parent_path.join(s)).collect();
+        Ok((filename, file_shards, paths))
+    }
 
-        let path = Path::new(file_path);
-        let f = File::open(path).expect("file should be there");
-        let reader = MultiGzDecoder::new(f);
-        let reader = FqReader::new(reader);
+    /// Writers of the shards at `paths` and, when they are compressed, the
+    /// threads compressing them, to be finished once the writers are dropped.
+    fn open_shards(
+        &self,
+        paths: &[PathBuf],
+    ) -> Result<(ShardWriters, Option<Compressors>), String> {
+        match self.compression.level {
+            None => {
+                let writers = paths
+                    .iter()
+                    .map(|path| {
+                        let f = File::create(path).map_err(|e| e.to_string())?;
+                        Ok(FqWriter::new(Box::new(f) as Box<dyn Write>))
+                    })
+                    .collect::<Result<ShardWriters, String>>()?;
+                Ok((writers, None))
+            }
+            Some(level) => {
+                let (compressors, writers) =
+                    Compressors::start(paths, level, self.compression.threads)?;
+                let writers = writers.into_iter().map(FqWriter::new).collect();
+                Ok((writers, Some(compressors)))
+            }
+        }
+    }
+
+    fn shard_file(&self, file_path: &str) -> Result<(String, Vec<String>), String> {
+        let (filename, file_shards, paths) = self.shard_paths(file_path)?;
+        let (mut writers, compressors) = self.open_shards(&paths)?;
+        let written = self.write_records(file_path, &mut writers);
+        drop(writers);
+        // a compressor's error is why writing to it failed
+        finish(compressors)?;
+        let i = written?;
+
+        info!("wrote {:?} records for {}", i, file_path);
+        Ok((filename, file_shards))
+    }
+
+    fn write_records(&self, file_path: &str, writers: &mut ShardWriters) -> Result<u32, String> {
+        let reader = FqReader::new(self.open_reads(file_path)?);
 
         let mut i = 0u32;
         for record in reader.records() {
@@ -54,9 +301,114 @@ impl FqSplitter {
             writers[bin].write_record(&rec).map_err(|e| e.to_string())?;
             i += 1;
         }
+        flush_all(writers)?;
+        Ok(i)
+    }
 
-        info!("wrote {:?} records for {}", i, file_path);
-        Ok((filename, file_shards))
+    /// Shard both mates of a pair in one pass, reading the files in lockstep so
+    /// that record n of each file lands in the same bin. Mates must carry the
+    /// same read name (up to a trailing /1 or /2), anything else means the
+    /// files are out of sync and is an error.
+    fn shard_paired_files(
+        &self,
+        mate_1_path: &str,
+        mate_2_path: &str,
+    ) -> Result<Vec<(String, String)>, String> {
+        let (filename_1, file_shards_1, mut paths) = self.shard_paths(mate_1_path)?;
+        let (filename_2, file_shards_2, paths_2) = self.shard_paths(mate_2_path)?;
+        if filename_1 == filename_2 {
+            return Err(format!("mates have the same filename {}", filename_1));
+        }
+        // both mates' shards share the compressor threads
+        paths.extend(paths_2);
+        let (mut writers_1, compressors) = self.open_shards(&paths)?;
+        let mut writers_2 = writers_1.split_off(self.bins as usize);
+        let written = self.write_pairs(mate_1_path, mate_2_path, &mut writers_1, &mut writers_2);
+        drop(writers_1);
+        drop(writers_2);
+        // a compressor's error is why writing to it failed
+        finish(compressors)?;
+        let i = written?;
+
+        info!(
+            "wrote {:?} pairs for {} and {}",
+            i, mate_1_path, mate_2_path
+        );
+        Ok(file_shards_1.into_iter().zip(file_shards_2).collect())
+    }
+
+    fn write_pairs(
+        &self,
+        mate_1_path: &str,
+        mate_2_path: &str,
+        writers_1: &mut ShardWriters,
+        writers_2: &mut ShardWriters,
+    ) -> Result<u64, String> {
+        let mut records_1 = FqReader::new(self.open_reads(mate_1_path)?).records();
+        let mut records_2 = FqReader::new(self.open_reads(mate_2_path)?).records();
+
+        let mut i = 0u64;
+        loop {
+            match (records_1.next(), records_2.next()) {
+                (None, None) => break,
+                (Some(rec_1), Some(rec_2)) => {
+                    let rec_1 = rec_1.map_err(|e| e.to_string())?;
+                    let rec_2 = rec_2.map_err(|e| e.to_string())?;
+                    let name = mate_name(rec_1.id());
+                    if name != mate_name(rec_2.id()) {
+                        return Err(format!(
+                            "mates out of sync at record {}, {} and {}",
+                            i,
+                            rec_1.id(),
+                            rec_2.id()
+                        ));
+                    }
+                    let bin = self.bin_name(name);
+                    assert!(bin < writers_1.len());
+                    writers_1[bin]
+                        .write_record(&rec_1)
+                        .map_err(|e| e.to_string())?;
+                    writers_2[bin]
+                        .write_record(&rec_2)
+                        .map_err(|e| e.to_string())?;
+                    i += 1;
+                }
+                _ => {
+                    return Err(format!(
+                        "{} and {} have different numbers of records",
+                        mate_1_path, mate_2_path
+                    ))
+                }
+            }
+        }
+        flush_all(writers_1)?;
+        flush_all(writers_2)?;
+        Ok(i)
+    }
+}
+
+fn finish(compressors: Option<Compressors>) -> Result<(), String> {
+    match compressors {
+        Some(compressors) => compressors.finish(),
+        None => Ok(()),
+    }
+}
+
+/// Flush the shards' buffers, so write errors surface rather than being lost
+/// when the writers are dropped.
+fn flush_all(writers: &mut [FqWriter<Box<dyn Write>>]) -> Result<(), String> {
+    for writer in writers.iter_mut() {
+        writer.flush().map_err(|e| e.to_string())?;
+    }
+    Ok(())
+}
+
+/// The read name shared by both mates, i.e. without a trailing /1 or /2.
+fn mate_name(id: &str) -> &str {
+    if id.ends_with("/1") || id.ends_with("/2") {
+        &id[..id.len() - 2]
+    } else {
+        id
     }
 }
 
@@ -76,20 +428,68 @@ pub fn run_fastq_split(
     Ok(aggregator)
 }
 
+pub fn run_fastq_split_paired(
+    mate_1_file: &str,
+    mate_2_file: &str,
+    bins: u32,
+    compression: ShardCompression,
+) -> Result<Vec<(String, String)>, String> {
+    if bins % 2 != 0 {
+        warn!("bins is not a power of 2..")
+    }
+    FqSplitter::with_compression(bins, compression).shard_paired_files(mate_1_file, mate_2_file)
+}
+
 #[cfg(test)]
 mod fastq_split_tests {
-    use crate::fastq_split::FqSplitter;
+    use crate::fastq_split::{flush_all, mate_name, DecodedReads, FqSplitter, ShardCompression};
     use bio::io::fastq;
-    use flate2::read::GzDecoder;
+    use flate2::read::MultiGzDecoder;
+    use flate2::write::GzEncoder;
+    use flate2::Compression;
     use std::collections::HashMap;
     use std::fs::File;
-    use std::path::Path;
+    use std::io::{Read, Write};
+    use std::path::{Path, PathBuf};
+
+    /// A directory of the test's own, so concurrent runs never share files.
+    fn test_dir(test: &str) -> PathBuf {
+        let dir = std::env::temp_dir().join(format!("fastq_split_{}-{}", test, std::process::id()));
+        std::fs::create_dir_all(&dir).expect("should create test dir");
+        dir
+    }
+
+    /// Gzipped mates of `pairs` reads in `dir`, each file in two gzip members
+    /// like concatenated sequencer output.
+    fn write_reads(dir: &Path, pairs: usize) -> (PathBuf, PathBuf) {
+        let mates = (dir.join("reads_1.fastq.gz"), dir.join("reads_2.fastq.gz"));
+        for path in [&mates.0, &mates.1].iter() {
+            let mut f = File::create(path).expect("should create reads");
+            for half in [0..pairs / 2, pairs / 2..pairs].iter() {
+                let mut member = GzEncoder::new(&mut f, Compression::fast());
+                for i in half.clone() {
+                    write!(member, "@SRR1020524.{}\nACGTTGCA\n+\nIIIIIIII\n", i)
+                        .expect("should write read");
+                }
+                member.finish().expect("should finish member");
+            }
+        }
+        mates
+    }
+
+    #[test]
+    fn test_mate_name() {
+        assert_eq!(mate_name("SRR1020524.1"), "SRR1020524.1");
+        assert_eq!(mate_name("read_7/1"), "read_7");
+        assert_eq!(mate_name("read_7/2"), "read_7");
+    }
 
     #[test]
     fn test_fastq_splits_consistently() {
-        let file_path = Path::new("resources/reads_1.fastq.gz");
-        let f = File::open(file_path).expect("file should be there");
-        let reader = GzDecoder::new(f);
+        let dir = test_dir("test_fastq_splits_consistently");
+        let (mate_1, mate_2) = write_reads(&dir, 1000);
+        let f = File::open(mate_1).expect("file should be there");
+        let reader = MultiGzDecoder::new(f);
         let fq = fastq::Reader::new(reader);
         let mut counter = HashMap::<String, usize>::new();
 
@@ -101,10 +501,10 @@ mod fastq_split_tests {
             let added = counter.insert(rec.id().to_string(), bin);
             assert!(added.is_none());
         }
+        assert_eq!(counter.len(), 1000);
 
-        let file_path = Path::new("resources/reads_2.fastq.gz");
-        let f = File::open(file_path).expect("file should be there");
-        let reader = GzDecoder::new(f);
+        let f = File::open(mate_2).expect("file should be there");
+        let reader = MultiGzDecoder::new(f);
         let fq = fastq::Reader::new(reader);
 
         let splitter_b = FqSplitter::new(16);
@@ -114,5 +514,65 @@ mod fastq_split_tests {
             let expected = counter.get(rec.id()).expect("should have bin for record");
             assert_eq!(&bin, expected);
         }
+        std::fs::remove_dir_all(&dir).expect("should remove test dir");
+    }
+
+    #[test]
+    fn test_compressed_shards_read_as_gzip() {
+        let compression = ShardCompression {
+            level: Some(1),
+            threads: 2,
+        };
+        let splitter = FqSplitter::with_compression(3, compression);
+        let dir = test_dir("test_compressed_shards_read_as_gzip");
+        let paths = (0..3)
+            .map(|bin| dir.join(format!("shard-{}.gz", bin)))
+            .collect::<Vec<PathBuf>>();
+        // enough records for each shard to be compressed in several chunks
+        let records = (0..30_000)
+            .map(|i| format!("@read_{}\nACGTACGTACGT\n+\nIIIIIIIIIIII\n", i))
+            .collect::<String>();
+        let mut expected = vec![Vec::new(); paths.len()];
+        {
+            let (mut writers, compressors) = splitter.open_shards(&paths).expect("should open");
+            for (i, record) in fastq::Reader::new(records.as_bytes()).records().enumerate() {
+                let record = record.expect("should parse");
+                writers[i % 3].write_record(&record).expect("should write");
+                expected[i % 3].push(record.id().to_string());
+            }
+            flush_all(&mut writers).expect("should flush");
+            drop(writers);
+            compressors
+                .expect("should compress")
+                .finish()
+                .expect("should finish");
+        }
+
+        for (path, expected) in paths.iter().zip(expected) {
+            let f = File::open(path).expect("shard should be there");
+            let ids = fastq::Reader::new(MultiGzDecoder::new(f))
+                .records()
+                .map(|r| r.expect("should get record").id().to_string())
+                .collect::<Vec<String>>();
+            assert_eq!(ids, expected);
+        }
+        std::fs::remove_dir_all(&dir).expect("should remove test dir");
+    }
+
+    #[test]
+    fn test_decoded_reads() {
+        let dir = test_dir("test_decoded_reads");
+        let (mate_1, _) = write_reads(&dir, 1000);
+        let mut expected = Vec::new();
+        MultiGzDecoder::new(File::open(&mate_1).expect("file should be there"))
+            .read_to_end(&mut expected)
+            .expect("should decode");
+        let mut decoded = Vec::new();
+        DecodedReads::open(mate_1.to_str().unwrap())
+            .expect("should open")
+            .read_to_end(&mut decoded)
+            .expect("should decode");
+        assert_eq!(decoded, expected);
+        std::fs::remove_dir_all(&dir).expect("should remove test dir");
     }
 }
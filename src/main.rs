@@ -1,8 +1,9 @@
 mod bam_sort;
 mod fastq_split;
+mod methylation_call;
 
 use clap::{App, AppSettings, Arg, SubCommand};
-use fastq_split::run_fastq_split;
+use fastq_split::{run_fastq_split, run_fastq_split_paired, ShardCompression};
 use log::{error, info};
 use std::io::{stdout, Write};
 use std::process::exit;
@@ -38,14 +39,135 @@ fn main() {
                 ),
         )
         .subcommand(
-            SubCommand::with_name("bam-sort").arg(
-                Arg::with_name("input")
-                    .long("input")
-                    .short("i")
-                    .help("path to bam")
-                    .takes_value(true)
-                    .required(true),
-            ),
+            SubCommand::with_name("fastq-split-paired")
+                .arg(
+                    Arg::with_name("mate1")
+                        .long("mate1")
+                        .short("1")
+                        .help("fastq reads, first mates")
+                        .takes_value(true)
+                        .required(true),
+                )
+                .arg(
+                    Arg::with_name("mate2")
+                        .long("mate2")
+                        .short("2")
+                        .help("fastq reads, second mates")
+                        .takes_value(true)
+                        .required(true),
+                )
+                .arg(
+                    Arg::with_name("bins")
+                        .long("bins")
+                        .short("b")
+                        .help("number of bins to shard into")
+                        .takes_value(true)
+                        .required(true),
+                )
+                .arg(
+                    Arg::with_name("compression-level")
+                        .long("compression-level")
+                        .short("l")
+                        .help("gzip the shards at this level (1 is fastest), by default they are plain fastq")
+                        .takes_value(true)
+                        .required(false),
+                )
+                .arg(
+                    Arg::with_name("threads")
+                        .long("threads")
+                        .short("t")
+                        .help("threads compressing the shards, more than one also decodes each input on its own")
+                        .takes_value(true)
+                        .default_value("1"),
+                ),
+        )
+        .subcommand(
+            SubCommand::with_name("bam-sort")
+                .arg(
+                    Arg::with_name("input")
+                        .long("input")
+                        .short("i")
+                        .help("path to bam")
+                        .takes_value(true)
+                        .required(true),
+                )
+                .arg(
+                    Arg::with_name("window")
+                        .long("window")
+                        .short("w")
+                        .help("split into windows of this many bases, not whole chromosomes")
+                        .takes_value(true)
+                        .required(false),
+                )
+                .arg(
+                    Arg::with_name("contigs")
+                        .long("contigs")
+                        .short("c")
+                        .help("contigs to split out on their own, comma separated, by default those of at least --min-contig-length")
+                        .takes_value(true)
+                        .multiple(true)
+                        .use_delimiter(true)
+                        .required(false),
+                )
+                .arg(
+                    Arg::with_name("min-contig-length")
+                        .long("min-contig-length")
+                        .help("length of contigs split out on their own when none are named")
+                        .takes_value(true)
+                        .required(false),
+                )
+                .arg(
+                    Arg::with_name("misc-buckets")
+                        .long("misc-buckets")
+                        .short("m")
+                        .help("number of outputs the other contigs share, 0 drops them")
+                        .takes_value(true)
+                        .default_value("4"),
+                ),
+        )
+        .subcommand(
+            SubCommand::with_name("call-methylation")
+                .arg(
+                    Arg::with_name("input")
+                        .long("input")
+                        .short("i")
+                        .help("path to read name ordered bismark bam")
+                        .takes_value(true)
+                        .required(true),
+                )
+                .arg(
+                    Arg::with_name("ignore")
+                        .long("ignore")
+                        .help("bases to ignore at the 5' end of read 1")
+                        .takes_value(true)
+                        .default_value("0"),
+                )
+                .arg(
+                    Arg::with_name("ignore_3prime")
+                        .long("ignore_3prime")
+                        .help("bases to ignore at the 3' end of read 1")
+                        .takes_value(true)
+                        .default_value("0"),
+                )
+                .arg(
+                    Arg::with_name("ignore_r2")
+                        .long("ignore_r2")
+                        .help("bases to ignore at the 5' end of read 2")
+                        .takes_value(true)
+                        .default_value("0"),
+                )
+                .arg(
+                    Arg::with_name("ignore_3prime_r2")
+                        .long("ignore_3prime_r2")
+                        .help("bases to ignore at the 3' end of read 2")
+                        .takes_value(true)
+                        .default_value("0"),
+                )
+                .arg(
+                    Arg::with_name("no_overlap")
+                        .long("no_overlap")
+                        .help("ignore calls of read 2 where it overlaps read 1"),
+                ),
         )
         .get_matches();
 
@@ -77,11 +199,74 @@ fn main() {
                 }
             }
         }
+        Some("fastq-split-paired") => {
+            info!("running fastq-split-paired");
+            let sub_matches = matches.subcommand_matches("fastq-split-paired").unwrap();
+            let mate_1_path = sub_matches.value_of("mate1").unwrap();
+            let mate_2_path = sub_matches.value_of("mate2").unwrap();
+            let bins = sub_matches
+                .value_of("bins")
+                .unwrap()
+                .parse::<u32>()
+                .expect("failed to parse bins into valid i128");
+            let compression = ShardCompression {
+                level: sub_matches.value_of("compression-level").map(|l| {
+                    let level = l
+                        .parse::<u32>()
+                        .expect("failed to parse compression-level into valid u32");
+                    assert!(
+                        (0..=9).contains(&level),
+                        "illegal compression level {}",
+                        level
+                    );
+                    level
+                }),
+                threads: sub_matches
+                    .value_of("threads")
+                    .unwrap()
+                    .parse::<u32>()
+                    .expect("failed to parse threads into valid u32"),
+            };
+            match run_fastq_split_paired(mate_1_path, mate_2_path, bins, compression) {
+                Ok(written) => {
+                    let stdout = stdout();
+                    let mut handle = stdout.lock();
+                    writeln!(handle, "{}", serde_json::to_string(&written).unwrap())
+                        .expect("failed to return to stdout");
+                    exit(0);
+                }
+                Err(s) => {
+                    error!("fastq-split-paired failed, {}", s);
+                    exit(1);
+                }
+            }
+        }
         Some("bam-sort") => {
             info!("running bam sort");
             let sub_matches = matches.subcommand_matches("bam-sort").unwrap();
             let bam_path = sub_matches.value_of("input").unwrap();
-            match bam_sort::run_bam_sort(bam_path) {
+            let window_bp = sub_matches.value_of("window").map(|w| {
+                w.parse::<u64>()
+                    .expect("failed to parse window into valid u64")
+            });
+            let selection = bam_sort::ContigSelection {
+                contigs: sub_matches
+                    .values_of("contigs")
+                    .map(|c| c.map(|c| c.to_string()).collect()),
+                min_length: sub_matches
+                    .value_of("min-contig-length")
+                    .map(|l| {
+                        l.parse::<u64>()
+                            .expect("failed to parse min-contig-length into valid u64")
+                    })
+                    .unwrap_or(bam_sort::DEFAULT_MIN_CONTIG_LENGTH),
+                misc_buckets: sub_matches
+                    .value_of("misc-buckets")
+                    .unwrap()
+                    .parse::<usize>()
+                    .expect("failed to parse misc-buckets into valid usize"),
+            };
+            match bam_sort::run_bam_sort(bam_path, window_bp, &selection) {
                 Ok(bam_paths) => {
                     let stdout = stdout();
                     let mut handle = stdout.lock();
@@ -95,6 +280,38 @@ fn main() {
                 }
             }
         }
+        Some("call-methylation") => {
+            info!("running call-methylation");
+            let sub_matches = matches.subcommand_matches("call-methylation").unwrap();
+            let bam_path = sub_matches.value_of("input").unwrap();
+            let ignore = |name: &str| -> usize {
+                sub_matches
+                    .value_of(name)
+                    .unwrap()
+                    .parse::<usize>()
+                    .expect("failed to parse ignored bases into valid usize")
+            };
+            let options = methylation_call::CallOptions {
+                ignore_r1: ignore("ignore"),
+                ignore_3prime_r1: ignore("ignore_3prime"),
+                ignore_r2: ignore("ignore_r2"),
+                ignore_3prime_r2: ignore("ignore_3prime_r2"),
+                no_overlap: sub_matches.is_present("no_overlap"),
+            };
+            match methylation_call::run_methylation_call(bam_path, &options) {
+                Ok(written) => {
+                    let stdout = stdout();
+                    let mut handle = stdout.lock();
+                    writeln!(handle, "{}", serde_json::to_string(&written).unwrap())
+                        .expect("failed to return to stdout");
+                    exit(0);
+                }
+                Err(e) => {
+                    error!("call-methylation failed, {}", e);
+                    exit(1);
+                }
+            }
+        }
         _ => {
             error!("unknown command");
             exit(1);
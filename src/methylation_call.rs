@@ -0,0 +1,310 @@
+use std::collections::HashMap;
+use std::fs::File;
+use std::io::{BufWriter, Write};
+use std::path::Path;
+
+use flate2::write::GzEncoder;
+use flate2::Compression;
+use rust_htslib::{bam, bam::record::Aux, bam::record::Cigar, bam::Read, bam::Record};
+
+/// The read ends whose calls are ignored, as bismark_methylation_extractor's
+/// `--ignore`, `--ignore_3prime`, `--ignore_r2`, `--ignore_3prime_r2` and
+/// `--no_overlap`.
+pub struct CallOptions {
+    pub ignore_r1: usize,
+    pub ignore_3prime_r1: usize,
+    pub ignore_r2: usize,
+    pub ignore_3prime_r2: usize,
+    pub no_overlap: bool,
+}
+
+#[derive(Default, Clone, Copy)]
+struct Counts {
+    methylated: u32,
+    unmethylated: u32,
+}
+
+/// The 0-based reference position of every query base, `None` for inserted
+/// and soft clipped bases.
+fn reference_positions(record: &Record) -> Vec<Option<i64>> {
+    let mut positions = Vec::with_capacity(record.seq_len());
+    let mut pos = record.pos();
+    for op in record.cigar().iter() {
+        match op {
+            Cigar::Match(l) | Cigar::Equal(l) | Cigar::Diff(l) => {
+                for _ in 0..*l {
+                    positions.push(Some(pos));
+                    pos += 1;
+                }
+            }
+            Cigar::Ins(l) | Cigar::SoftClip(l) => {
+                for _ in 0..*l {
+                    positions.push(None);
+                }
+            }
+            Cigar::Del(l) | Cigar::RefSkip(l) => pos += *l as i64,
+            Cigar::HardClip(_) | Cigar::Pad(_) => {}
+        }
+    }
+    positions
+}
+
+/// The CpG calls of a read's XM string as (reference position, methylated),
+/// leaving out `ignore_5p` and `ignore_3p` bases at the read's ends (the
+/// right end of the string is the 5' end of reverse reads) and positions
+/// `skip`ped for overlapping its mate.
+fn cpg_calls(
+    xm: &[u8],
+    positions: &[Option<i64>],
+    reverse: bool,
+    ignore_5p: usize,
+    ignore_3p: usize,
+    skip: &dyn Fn(i64) -> bool,
+) -> Vec<(i64, bool)> {
+    let len = xm.len();
+    let mut calls = Vec::new();
+    for (i, &call) in xm.iter().enumerate() {
+        if call != b'z' && call != b'Z' {
+            continue;
+        }
+        let read_idx = if reverse { len - 1 - i } else { i };
+        if read_idx < ignore_5p || read_idx + ignore_3p >= len {
+            continue;
+        }
+        if let Some(Some(pos)) = positions.get(i) {
+            if !skip(*pos) {
+                calls.push((*pos, call == b'Z'));
+            }
+        }
+    }
+    calls
+}
+
+/// Perl's default number formatting, `%.15g`, as bismark2bedGraph writes
+/// its percentages.
+fn perl_number(x: f64) -> String {
+    if x == x.trunc() && x.abs() < 1e15 {
+        return format!("{}", x as i64);
+    }
+    let exponent = x.abs().log10().floor() as i32;
+    let decimals = (14 - exponent).max(0) as usize;
+    let formatted = format!("{:.*}", decimals, x);
+    formatted
+        .trim_end_matches('0')
+        .trim_end_matches('.')
+        .to_string()
+}
+
+fn xm_tag(record: &Record) -> Result<Vec<u8>, String> {
+    match record.aux(b"XM") {
+        Some(Aux::String(xm)) => Ok(xm.to_vec()),
+        _ => Err(format!(
+            "{} has no XM tag",
+            String::from_utf8_lossy(record.qname())
+        )),
+    }
+}
+
+struct Caller<'a> {
+    options: &'a CallOptions,
+    counts: HashMap<(i32, i64), Counts>,
+}
+
+impl<'a> Caller<'a> {
+    fn count(&mut self, tid: i32, calls: Vec<(i64, bool)>) {
+        for (pos, methylated) in calls {
+            let counts = self.counts.entry((tid, pos)).or_default();
+            if methylated {
+                counts.methylated += 1;
+            } else {
+                counts.unmethylated += 1;
+            }
+        }
+    }
+
+    fn call_read(&mut self, record: &Record, skip: &dyn Fn(i64) -> bool) -> Result<(), String> {
+        let (ignore_5p, ignore_3p) = if record.is_last_in_template() {
+            (self.options.ignore_r2, self.options.ignore_3prime_r2)
+        } else {
+            (self.options.ignore_r1, self.options.ignore_3prime_r1)
+        };
+        let xm = xm_tag(record)?;
+        let positions = reference_positions(record);
+        let calls = cpg_calls(
+            &xm,
+            &positions,
+            record.is_reverse(),
+            ignore_5p,
+            ignore_3p,
+            skip,
+        );
+        self.count(record.tid(), calls);
+        Ok(())
+    }
+
+    /// Count a pair's calls. With `no_overlap` read 2's calls on the part of
+    /// the reference read 1 covers are left out, like Bismark does: those
+    /// up to read 1's end when it is forward, from its start when reverse.
+    fn call_pair(&mut self, read_1: &Record, read_2: &Record) -> Result<(), String> {
+        self.call_read(read_1, &|_| false)?;
+        if !self.options.no_overlap || read_1.tid() != read_2.tid() {
+            return self.call_read(read_2, &|_| false);
+        }
+        let start = read_1.pos();
+        let end = read_1.cigar().end_pos() - 1;
+        if read_1.is_reverse() {
+            self.call_read(read_2, &|pos| pos >= start)
+        } else {
+            self.call_read(read_2, &|pos| pos <= end)
+        }
+    }
+}
+
+/// Count the methylated and unmethylated CpG calls of a read name ordered
+/// Bismark BAM and write them next to it as `<stem>.bismark.cov.gz` and
+/// `<stem>.bedGraph.gz`, in the formats of bismark2bedGraph.
+pub fn run_methylation_call(p: &str, options: &CallOptions) -> Result<Vec<String>, String> {
+    let mut bam_reader = bam::Reader::from_path(p).map_err(|e| e.to_string())?;
+    let targets = bam_reader
+        .header()
+        .target_names()
+        .iter()
+        .map(|t| String::from_utf8_lossy(t).to_string())
+        .collect::<Vec<String>>();
+    let path = Path::new(p);
+    let parent_path = path.parent().ok_or("should not be root".to_string())?;
+    let filename = path.file_stem().ok_or("should get filename".to_string())?;
+    let filename = filename.to_str().ok_or("should make string".to_string())?;
+
+    let mut caller = Caller {
+        options,
+        counts: HashMap::new(),
+    };
+    // mates are next to each other, read 1 first
+    let mut pending: Option<Record> = None;
+    let mut record = Record::new();
+    while let Some(result) = bam_reader.read(&mut record) {
+        result.map_err(|e| e.to_string())?;
+        if record.is_unmapped() {
+            continue;
+        }
+        match pending.take() {
+            Some(mate) if mate.qname() == record.qname() => {
+                if mate.is_first_in_template() {
+                    caller.call_pair(&mate, &record)?;
+                } else {
+                    caller.call_pair(&record, &mate)?;
+                }
+            }
+            previous => {
+                if let Some(single) = previous {
+                    caller.call_read(&single, &|_| false)?;
+                }
+                pending = Some(record.clone());
+            }
+        }
+    }
+    if let Some(single) = pending {
+        caller.call_read(&single, &|_| false)?;
+    }
+
+    let mut positions = caller.counts.into_iter().collect::<Vec<_>>();
+    positions.sort_by(|((tid_a, pos_a), _), ((tid_b, pos_b), _)| {
+        (&targets[*tid_a as usize], pos_a).cmp(&(&targets[*tid_b as usize], pos_b))
+    });
+
+    let cov_filename = format!("{}.bismark.cov.gz", filename);
+    let bed_graph_filename = format!("{}.bedGraph.gz", filename);
+    let gz_writer = |name: &str| -> Result<GzEncoder<BufWriter<File>>, String> {
+        let file = File::create(parent_path.join(name)).map_err(|e| e.to_string())?;
+        Ok(GzEncoder::new(BufWriter::new(file), Compression::default()))
+    };
+    let mut cov = gz_writer(&cov_filename)?;
+    let mut bed_graph = gz_writer(&bed_graph_filename)?;
+    writeln!(bed_graph, "track type=bedGraph").map_err(|e| e.to_string())?;
+    for ((tid, pos), counts) in positions {
+        let chrom = &targets[tid as usize];
+        let total = counts.methylated + counts.unmethylated;
+        let pct = perl_number(100.0 * counts.methylated as f64 / total as f64);
+        writeln!(
+            cov,
+            "{}\t{}\t{}\t{}\t{}\t{}",
+            chrom,
+            pos + 1,
+            pos + 1,
+            pct,
+            counts.methylated,
+            counts.unmethylated
+        )
+        .map_err(|e| e.to_string())?;
+        writeln!(bed_graph, "{}\t{}\t{}\t{}", chrom, pos, pos + 1, pct)
+            .map_err(|e| e.to_string())?;
+    }
+    cov.finish().map_err(|e| e.to_string())?;
+    bed_graph.finish().map_err(|e| e.to_string())?;
+    Ok(vec![cov_filename, bed_graph_filename])
+}
+
+#[cfg(test)]
+mod methylation_call_tests {
+    use super::{cpg_calls, perl_number, run_methylation_call, CallOptions};
+    use flate2::read::MultiGzDecoder;
+    use std::fs::File;
+    use std::io::Read;
+
+    #[test]
+    fn test_perl_number() {
+        assert_eq!(perl_number(100.0), "100");
+        assert_eq!(perl_number(0.0), "0");
+        assert_eq!(perl_number(50.0), "50");
+        assert_eq!(perl_number(200.0 / 3.0), "66.6666666666667");
+        assert_eq!(perl_number(100.0 / 3.0), "33.3333333333333");
+        assert_eq!(perl_number(100.0 / 7.0), "14.2857142857143");
+    }
+
+    #[test]
+    fn test_cpg_calls() {
+        let xm = b"Z..z.xZ.";
+        let positions = (100..108).map(Some).collect::<Vec<_>>();
+        let all = cpg_calls(xm, &positions, false, 0, 0, &|_| false);
+        assert_eq!(all, vec![(100, true), (103, false), (106, true)]);
+
+        // the 5' end of a reverse read is at the right
+        let reverse = cpg_calls(xm, &positions, true, 2, 0, &|_| false);
+        assert_eq!(reverse, vec![(100, true), (103, false)]);
+        let three_prime = cpg_calls(xm, &positions, true, 0, 1, &|_| false);
+        assert_eq!(three_prime, vec![(103, false), (106, true)]);
+
+        let no_overlap = cpg_calls(xm, &positions, true, 0, 0, &|pos| pos <= 103);
+        assert_eq!(no_overlap, vec![(106, true)]);
+    }
+
+    #[test]
+    fn test_calls_match_extractor() {
+        // resources/methylation_call.bismark.cov is what the extractor writes
+        // for the fixture with the pipeline's options
+        let dir = std::env::temp_dir().join(format!(
+            "methylation_call_test_calls_match_extractor-{}",
+            std::process::id()
+        ));
+        std::fs::create_dir_all(&dir).expect("should create test dir");
+        let sam = dir.join("methylation_call.sam");
+        std::fs::copy("resources/methylation_call.sam", &sam).expect("fixture should be there");
+        let options = CallOptions {
+            ignore_r1: 0,
+            ignore_3prime_r1: 0,
+            ignore_r2: 2,
+            ignore_3prime_r2: 2,
+            no_overlap: true,
+        };
+        let written = run_methylation_call(sam.to_str().unwrap(), &options).expect("should call");
+        let mut calls = String::new();
+        MultiGzDecoder::new(File::open(dir.join(&written[0])).expect("should write cov"))
+            .read_to_string(&mut calls)
+            .expect("should decode");
+        std::fs::remove_dir_all(&dir).expect("should remove test dir");
+        let expected = std::fs::read_to_string("resources/methylation_call.bismark.cov")
+            .expect("fixture should be there");
+        assert_eq!(calls, expected);
+    }
+}
@@ -1,6 +1,67 @@
-from domain import PairedEndReads, ArtifactResourceRequirements, ResourceRequirement
-from preprocessing import get_resource_requirements_for_reads
-from aws_utils import parse_s3_url_key_bucket_filename, estimate_resource_requirements
+import gzip
+import io
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+from toil.job import Job
+
+from domain import (
+    CallingEngine,
+    ContigSettings,
+    ExportKind,
+    ExportSettings,
+    GenomicRegion,
+    PairedEndReads,
+    ArtifactResourceRequirements,
+    ResourceRequirement,
+    GenomeCacheSettings,
+    ParallelismPolicy,
+    ResourceModel,
+    ResultCacheSettings,
+    S3OutputLocation,
+    ShardCompressionSettings,
+    Storage,
+    Stage,
+    TransferSettings,
+    GIB,
+)
+import alignment
+from alignment import _add_merge_tree, cached_bismark_genome
+from exports import OutputExporter
+from file_store import INPUTS_MOUNT, input_volumes
+import genome_cache
+from genome_cache import GenomeIndexCache, cache_key
+from main import parse_config
+from packing import pack_bams, pack_files, read_packed_bams
+from methylation_calling import (
+    IGNORE_3PRIME_R2,
+    IGNORE_R2,
+    merge_coverage,
+    partition_regions,
+    write_coverage,
+)
+import profiling
+from profiling import StageProfile, StageProfiler, fit_resource_model
+from result_cache import StageResultCache
+from preprocessing import (
+    get_resource_requirements_for_reads,
+    restore_shards,
+    shard_count,
+    MAX_BINS,
+)
+import aws_utils
+from aws_utils import (
+    parse_s3_url_key_bucket_filename,
+    estimate_resource_requirements,
+    probe_objects,
+)
 
 
 def test_s3_key_parse():
@@ -12,6 +73,40 @@ def test_s3_key_parse():
     assert filename == "happyness.json"
 
 
+def test_s3_output_for_sample():
+    s3_output = S3OutputLocation.parse("s3://bucket/runs/run_1/")
+    sample_output = s3_output.for_sample("SRR1020524")
+    assert sample_output.bucket == "bucket"
+    assert sample_output.key == "runs/run_1/SRR1020524"
+    assert (
+        sample_output.to_url("chr1.bismark.cov.gz")
+        == "s3://bucket/runs/run_1/SRR1020524/chr1.bismark.cov.gz"
+    )
+
+
+def test_result_cache_location_and_keys():
+    s3_output = S3OutputLocation.parse("s3://bucket/runs/run_1/")
+    assert s3_output.sibling_url("stage_cache") == "s3://bucket/runs/stage_cache"
+    top_level = S3OutputLocation.parse("s3://bucket/run_1")
+    assert top_level.sibling_url("stage_cache") == "s3://bucket/stage_cache"
+
+    assert not ResultCacheSettings.parse({}).enabled
+    with pytest.raises(ValueError):
+        ResultCacheSettings.parse({"enabled": True, "url": "/tmp/cache"})
+    disabled = StageResultCache.resolve(
+        ResultCacheSettings(), s3_output=s3_output, images=["apps:latest"]
+    )
+    assert disabled is None
+
+    cache = StageResultCache(url="s3://bucket/stage_cache", image_digests=["sha256:a"])
+    key = cache.key(Stage.SHARDING, ["etag_1", "etag_2", "16"])
+    assert key == cache.key(Stage.SHARDING, ["etag_1", "etag_2", "16"])
+    assert key != cache.key(Stage.SHARDING, ["etag_1", "etag_2", "32"])
+    assert key != cache.key(Stage.ALIGN, ["etag_1", "etag_2", "16"])
+    moved = StageResultCache(url=cache.url, image_digests=["sha256:b"])
+    assert key != moved.key(Stage.SHARDING, ["etag_1", "etag_2", "16"])
+
+
 def test_parse_config():
     test_reads = {
         "testdata": {
@@ -49,6 +144,29 @@ def test_parse_config():
     assert paired_end_reads.storage.value == 2
 
 
+def test_parse_config_merge_group_size(tmp_path):
+    shipped = os.path.join(
+        os.path.dirname(__file__),
+        os.pardir,
+        "toil_methylseq",
+        "toil-methylseq.config.json",
+    )
+    with open(shipped) as fh:
+        raw_config = json.load(fh)
+    path = tmp_path / "config.json"
+    for merge_group_size in (None, 2, 8):
+        path.write_text(
+            json.dumps({**raw_config, "merge_group_size": merge_group_size})
+        )
+        assert parse_config(str(path)).merge_group_size == merge_group_size
+    for merge_group_size in (0, 1):
+        path.write_text(
+            json.dumps({**raw_config, "merge_group_size": merge_group_size})
+        )
+        with pytest.raises(ValueError):
+            parse_config(str(path))
+
+
 def test_add_artifact_resource_requirements():
     reqs1 = ArtifactResourceRequirements(
         memory=ResourceRequirement(amount=10, unit="B"),
@@ -74,10 +192,10 @@ def test_add_artifact_resource_requirements():
 def test_resource_requirement_convert():
     a = ResourceRequirement(amount=1, unit="GB")
     b = a.convert_to("MB")
-    assert b == ResourceRequirement(amount=1000, unit="MB")
-    a = ResourceRequirement(amount=10, unit="MB")
+    assert b == ResourceRequirement(amount=1024, unit="MB")
+    a = ResourceRequirement(amount=512, unit="MB")
     b = a.convert_to("GB")
-    assert b == ResourceRequirement(amount=0.01, unit="GB")
+    assert b == ResourceRequirement(amount=0.5, unit="GB")
 
 
 def test_estimate_read_size():
@@ -96,3 +214,630 @@ def test_estimate_read_size():
     )
 
     assert resource_reqs == expected
+
+
+def test_genome_cache_fills_once_and_evicts(tmp_path):
+    cache = GenomeIndexCache(
+        GenomeCacheSettings(root=str(tmp_path / "cache"), max_bytes=150)
+    )
+    fills = []
+
+    def filler(contents: bytes):
+        def fill(path):
+            fills.append(path)
+            with open(os.path.join(path, "genome.fa"), "wb") as fh:
+                fh.write(contents)
+
+        return fill
+
+    key_a = cache_key(["index-a", "etag-1"])
+    with cache.acquire(key_a, filler(b"A" * 100)) as entry:
+        assert open(os.path.join(entry, "genome.fa"), "rb").read() == b"A" * 100
+    with cache.acquire(key_a, filler(b"A" * 100)) as entry:
+        assert os.path.exists(os.path.join(entry, "genome.fa"))
+    assert len(fills) == 1
+
+    # a new ETag is a different entry, and the old one no longer fits
+    key_b = cache_key(["index-a", "etag-2"])
+    with cache.acquire(key_b, filler(b"B" * 100)) as entry:
+        assert open(os.path.join(entry, "genome.fa"), "rb").read() == b"B" * 100
+    assert len(fills) == 2
+    assert not os.path.exists(tmp_path / "cache" / key_a)
+
+
+def test_cached_bismark_genome(tmp_path, monkeypatch):
+    index_files = [{"Key": "index/Bisulfite_Genome/CT.1.bt2", "ETag": "e1"}]
+    monkeypatch.setattr(
+        alignment, "list_bismark_index_files", lambda **kwargs: index_files
+    )
+    monkeypatch.setattr(
+        alignment, "probe_object", lambda uri, storage: SimpleNamespace(etag="g1")
+    )
+    fills = []
+
+    def download_bismark_files(*, tempdir, **kwargs):
+        fills.append(tempdir)
+        with open(os.path.join(tempdir, "CT.1.bt2"), "w") as fh:
+            fh.write("index")
+
+    def download_to_location(*, s3_url, temp_dir, transfer):
+        with open(os.path.join(temp_dir, "genome.fa"), "w") as fh:
+            fh.write(">chr1")
+
+    monkeypatch.setattr(alignment, "download_bismark_files", download_bismark_files)
+    monkeypatch.setattr(alignment, "download_to_location", download_to_location)
+    cache = GenomeIndexCache(
+        GenomeCacheSettings(root=str(tmp_path / "cache"), max_bytes=1000)
+    )
+    for _ in range(2):
+        with cached_bismark_genome(
+            cache=cache,
+            bismark_index_url="s3://bucket/index/",
+            bismark_genome_uri="s3://bucket/index/genome.fa",
+            transfer=TransferSettings(),
+        ) as genome_dir:
+            assert sorted(os.listdir(genome_dir)) == [
+                ".complete",
+                "CT.1.bt2",
+                "genome.fa",
+            ]
+    assert len(fills) == 1
+
+
+def test_genome_cache_refills_entry_evicted_while_locking(tmp_path, monkeypatch):
+    cache = GenomeIndexCache(
+        GenomeCacheSettings(root=str(tmp_path / "cache"), max_bytes=150)
+    )
+    key = cache_key(["index-a", "etag-1"])
+    fills = []
+
+    def fill(path):
+        fills.append(path)
+        with open(os.path.join(path, "genome.fa"), "wb") as fh:
+            fh.write(b"A")
+
+    flock = genome_cache.fcntl.flock
+    evicted = []
+
+    def flock_evicting_once(fh, operation):
+        # another job's eviction wins the gap of the first lock conversion
+        if operation == genome_cache.fcntl.LOCK_SH and fills and not evicted:
+            flock(fh, genome_cache.fcntl.LOCK_UN)
+            evicted.append(key)
+            os.remove(cache._marker_path(key))
+            shutil.rmtree(cache._entry_path(key))
+        flock(fh, operation)
+
+    monkeypatch.setattr(genome_cache.fcntl, "flock", flock_evicting_once)
+    with cache.acquire(key, fill) as entry:
+        assert os.path.exists(os.path.join(entry, "genome.fa"))
+    assert evicted and len(fills) == 2
+
+
+def test_genome_cache_evicts_around_other_jobs(tmp_path, monkeypatch):
+    cache = GenomeIndexCache(
+        GenomeCacheSettings(root=str(tmp_path / "cache"), max_bytes=150)
+    )
+
+    def filler(contents: bytes):
+        def fill(path):
+            with open(os.path.join(path, "genome.fa"), "wb") as fh:
+                fh.write(contents)
+
+        return fill
+
+    keys = [cache_key(["index", str(i)]) for i in range(3)]
+    for key in keys[:2]:
+        with cache.acquire(key, filler(b"A" * 50)):
+            pass
+    # another job evicted the first entry after it was listed
+    listed = cache._complete_entries()
+    os.remove(cache._marker_path(keys[0]))
+    shutil.rmtree(cache._entry_path(keys[0]))
+    monkeypatch.setattr(cache, "_complete_entries", lambda: listed)
+    with cache.acquire(keys[1], filler(b"A" * 50)):
+        # the second entry is in use, so it stays even over the limit
+        with cache.acquire(keys[2], filler(b"C" * 120)) as entry:
+            assert os.path.exists(os.path.join(entry, "genome.fa"))
+    assert os.path.exists(cache._marker_path(keys[1]))
+
+
+def test_genome_cache_shares_complete_entries(tmp_path):
+    cache = GenomeIndexCache(
+        GenomeCacheSettings(root=str(tmp_path / "cache"), max_bytes=150)
+    )
+    key = cache_key(["index-a", "etag-1"])
+
+    def fill(path):
+        with open(os.path.join(path, "genome.fa"), "wb") as fh:
+            fh.write(b"A")
+
+    with cache.acquire(key, fill):
+        pass
+    holding = threading.Event()
+
+    def second_holder():
+        with cache.acquire(key, fill):
+            holding.set()
+
+    with cache.acquire(key, fill):
+        # a second aligner on the node doesn't wait for the first one's run
+        thread = threading.Thread(target=second_holder)
+        thread.start()
+        assert holding.wait(timeout=5)
+    thread.join()
+
+
+def test_shard_count():
+    gb = 1024 * 1024 * 1024
+    assert shard_count(60 * gb, bins=16) == 16
+    assert shard_count(60 * gb, bins=16, target_shard_bytes=2 * gb) == 30
+    assert shard_count(3 * gb, bins=16, target_shard_bytes=2 * gb) == 2
+    assert shard_count(10, bins=16, target_shard_bytes=2 * gb) == 1
+    assert shard_count(10000 * gb, bins=16, target_shard_bytes=gb) == MAX_BINS
+
+
+def test_restore_shards_job():
+    class ResultCache:
+        def restore(self, job, key):
+            assert key == "shards-key"
+            return {"0_1.fq": "f1", "0_2.fq": "f2", "1_1.fq": "f3", "1_2.fq": "f4"}
+
+    # Toil takes `name` as the job's name, the sample is passed separately
+    restore = Job().addChildJobFn(
+        restore_shards,
+        name="sharding_s1",
+        sample="s1",
+        result_cache=ResultCache(),
+        result_key="shards-key",
+        compressed=False,
+    )
+    assert restore.description.unitName == "sharding_s1"
+    shards = restore.run(None)
+    assert [(s.name, s.mate1_fid, s.mate2_fid) for s in shards] == [
+        ("s1", "f1", "f2"),
+        ("s1", "f3", "f4"),
+    ]
+    assert shards[0].cache_key != shards[1].cache_key
+
+
+def test_resource_model_scales_with_inputs():
+    model = ResourceModel()
+    small = model.align_shard_job(shard_bytes=GIB, reference_bytes=3 * GIB)
+    large = model.align_shard_job(shard_bytes=8 * GIB, reference_bytes=3 * GIB)
+    assert small.cores == large.cores == model.align_cores
+    # the bowtie2 indices dominate memory, the reads dominate disk
+    assert small.memory > 10 * GIB
+    assert large.disk > 8 * small.disk // 2
+    # intermediates are deleted once consumed, so disk is the peak live set
+    # rather than everything the stages write
+    written = sum(
+        model.stage(s).disk(input_bytes=8 * GIB)
+        for s in (Stage.TRIM, Stage.ALIGN, Stage.SPLIT)
+    )
+    assert large.disk < 8 * GIB + written
+    plain = model.align_shard_job(
+        shard_bytes=8 * GIB, reference_bytes=3 * GIB, gzip_trimmed=False
+    )
+    assert plain.disk > large.disk
+
+    streamed = model.sharding_job(reads_bytes=10 * GIB, staged=False)
+    staged = model.sharding_job(reads_bytes=10 * GIB, staged=True)
+    assert staged.disk - streamed.disk == 10 * GIB
+    assert streamed.memory < streamed.disk
+    # streaming holds a few parts of each mate in memory
+    buffer_bytes = 2 * TransferSettings().stream_buffer_bytes
+    buffered = model.sharding_job(
+        reads_bytes=10 * GIB, staged=False, stream_buffer_bytes=buffer_bytes
+    )
+    assert buffered.memory == streamed.memory + buffer_bytes
+    assert buffered.memory < 2 * GIB
+    compressed = model.sharding_job(
+        reads_bytes=10 * GIB,
+        staged=False,
+        compression=ShardCompressionSettings(level=1, threads=4),
+    )
+    assert compressed.cores == 4
+    assert compressed.disk < streamed.disk // 2
+    # a compressed shard only differs in what the trimmer reads off disk
+    gzipped = model.align_shard_job(
+        shard_bytes=8 * GIB, reference_bytes=3 * GIB, compressed_shard=True
+    )
+    assert gzipped.memory == large.memory
+    assert gzipped.disk <= large.disk
+    # bam-sort holds every window's writer open, which only outweighs
+    # Bismark for very small windows
+    windowed = model.align_shard_job(
+        shard_bytes=8 * GIB, reference_bytes=3 * GIB, region_bp=10_000_000
+    )
+    assert windowed.memory == large.memory
+    tiny_windows = model.align_shard_job(
+        shard_bytes=8 * GIB, reference_bytes=3 * GIB, region_bp=10_000
+    )
+    assert tiny_windows.memory > 3 * GIB * model.split_window_bytes // 10_000
+
+    assert model.calling_job(alignment_bytes=0).disk == model.min_disk
+    # the native caller has none of the extractor's per-context intermediates
+    bismark = model.calling_job(alignment_bytes=10 * GIB)
+    native = model.calling_job(alignment_bytes=10 * GIB, engine=CallingEngine.NATIVE)
+    assert native.disk < bismark.disk
+    assert native.memory < bismark.memory
+
+    premerge = model.premerge_job(alignment_bytes=10 * GIB)
+    assert premerge.cores == model.premerge_cores
+    assert 20 * GIB <= premerge.disk < bismark.disk
+    # the extractor reads the deduplicated BAM the file store already holds
+    unexported = ResourceModel(exported_stages=(Stage.ALIGN,))
+    deduplicated = model.stage(Stage.MERGE).output_bytes(input_bytes=10 * GIB)
+    deduplicated = model.stage(Stage.DEDUP).output_bytes(input_bytes=deduplicated)
+    assert (
+        bismark.disk
+        < unexported.calling_job(alignment_bytes=10 * GIB).disk + deduplicated
+    )
+    assert model.aligned_bytes(shard_bytes=GIB) < GIB
+
+
+def test_docker_call_removes_container_on_failure(tmp_path, monkeypatch):
+    class Container:
+        id = "c0"
+        removed = False
+
+        def stats(self, decode, stream):
+            while not self.removed:
+                yield {"memory_stats": {"usage": 1}}
+                time.sleep(0.01)
+
+        def wait(self):
+            raise ConnectionError("docker went away")
+
+        def remove(self, force=False):
+            assert force
+            self.removed = True
+
+    container = Container()
+    monkeypatch.setattr(profiling, "apiDockerCall", lambda job, **kwargs: container)
+    job = SimpleNamespace(log=print)
+    with pytest.raises(ConnectionError):
+        StageProfiler(job, None).docker_call(
+            stage=Stage.SORT, work_dir=str(tmp_path), input_bytes=0
+        )
+    assert container.removed
+
+
+def test_fit_resource_model_covers_history():
+    def profile(stage, input_bytes, peak_memory, peak_disk):
+        return StageProfile(
+            stage=stage.value,
+            input_bytes=input_bytes,
+            reference_bytes=0,
+            threads=1,
+            peak_memory=peak_memory,
+            start_disk=0,
+            peak_disk=peak_disk,
+            end_disk=peak_disk // 2,
+            wall_seconds=1.0,
+        )
+
+    history = [
+        profile(Stage.DEDUP, GIB, 2 * GIB, 2 * GIB),
+        profile(Stage.DEDUP, 2 * GIB, 3 * GIB, 4 * GIB),
+        profile(Stage.DEDUP, 4 * GIB, 5 * GIB, 8 * GIB),
+        # too few observations to refit
+        profile(Stage.SPLIT, GIB, 100 * GIB, 100 * GIB),
+    ]
+    prior = ResourceModel()
+    fitted = fit_resource_model(history, prior)
+
+    dedup = fitted.stage(Stage.DEDUP)
+    for record in history[:3]:
+        assert dedup.memory(input_bytes=record.input_bytes) >= record.peak_memory
+        assert dedup.disk(input_bytes=record.input_bytes) >= record.peak_disk
+    assert dedup.memory(input_bytes=GIB) < 3 * GIB
+    assert fitted.stage(Stage.SPLIT) == prior.stage(Stage.SPLIT)
+
+
+def test_probe_objects(monkeypatch):
+    sizes = {"reads_0.fastq.gz": 10, "reads_1.fastq.gz": 2000}
+
+    def head_object(Bucket, Key):
+        return {"ContentLength": sizes[Key], "ETag": f'"{Key}-{sizes[Key]}"'}
+
+    monkeypatch.setattr(
+        aws_utils,
+        "get_s3_client",
+        lambda: SimpleNamespace(head_object=head_object),
+    )
+    uris = [(f"s3://probe-test/{name}", Storage.S3) for name in sizes]
+
+    metadata = probe_objects(uris)
+    assert [metadata[uri].size for uri, _ in uris] == [10, 2000]
+    assert metadata[uris[0][0]].etag != metadata[uris[1][0]].etag
+
+    resource_reqs = estimate_resource_requirements(*uris[1])
+    assert resource_reqs.disc == ResourceRequirement(amount=2, unit="KB")
+
+    # a replaced object is only seen once its probe has expired
+    sizes["reads_0.fastq.gz"] = 20
+    assert probe_objects(uris[:1])[uris[0][0]].size == 10
+    monkeypatch.setattr(aws_utils, "PROBE_TTL_SECONDS", -1)
+    assert probe_objects(uris[:1])[uris[0][0]].size == 20
+
+    # sharding can't read local inputs, so they aren't sized either
+    with pytest.raises(NotImplementedError):
+        probe_objects([("file:///data/reads_1.fastq.gz", Storage.Local)])
+
+
+def test_parallelism_policy():
+    policy = ParallelismPolicy(cores=4)
+    assert policy.trim_galore_parameters() == ["--cores", "1"]
+    assert policy.bismark_parameters() == ["-p", "1"]
+
+    policy = ParallelismPolicy(cores=16)
+    assert policy.trim_galore_parameters() == ["--cores", "5"]
+    assert policy.bismark_parameters() == ["-p", "3", "--multicore", "2"]
+
+    # every extra Bismark instance loads another copy of the indices
+    one_instance = ResourceModel(align_cores=8)
+    two_instances = ResourceModel(align_cores=16)
+    reference = 3 * GIB
+    resources_1 = one_instance.align_shard_job(
+        shard_bytes=GIB, reference_bytes=reference
+    )
+    resources_2 = two_instances.align_shard_job(
+        shard_bytes=GIB, reference_bytes=reference
+    )
+    assert resources_2.memory > 2 * reference * 3
+    assert resources_2.memory > 1.8 * resources_1.memory
+
+    policy = ParallelismPolicy(cores=12, memory=16 * GIB)
+    assert policy.extractor_parameters() == [
+        "--multicore",
+        "4",
+        "--buffer_size",
+        "12288M",
+    ]
+    # calling jobs get cores in proportion to their alignments
+    model = ResourceModel()
+    assert model.calling_job(alignment_bytes=100).cores == 1
+    assert model.calling_job(alignment_bytes=GIB).cores == 4
+    assert model.calling_job(alignment_bytes=100 * GIB).cores == model.extract_cores
+
+
+def test_partition_regions():
+    windows = [GenomicRegion.parse(f"chr1:{i * 10}-{(i + 1) * 10}") for i in range(10)]
+    windows.append(GenomicRegion.parse("chr21:0-10"))
+    regions = partition_regions(windows, partition_bp=60)
+    assert regions == {
+        GenomicRegion("chr1", 0, 60): [
+            GenomicRegion("chr1", i * 10, (i + 1) * 10) for i in range(6)
+        ],
+        GenomicRegion("chr1", 60, 100): [
+            GenomicRegion("chr1", i * 10, (i + 1) * 10) for i in range(6, 10)
+        ],
+        GenomicRegion("chr21", 0, 10): [GenomicRegion("chr21", 0, 10)],
+    }
+    assert GenomicRegion("chr1", 60, 100).label == "chr1_60-100"
+
+
+def test_stitch_coverage(tmpdir):
+    def cov(name, lines):
+        path = os.path.join(tmpdir, name)
+        with gzip.open(path, "wt") as fh:
+            fh.writelines(line + "\n" for line in lines)
+        return path
+
+    first = cov("a.cov.gz", ["chr1\t5\t5\t100\t2\t0", "chr1\t12\t12\t0\t0\t1"])
+    second = cov("b.cov.gz", ["chr1\t12\t12\t100\t2\t0", "chr1\t15\t15\t50\t1\t1"])
+    cov_path = os.path.join(tmpdir, "chr1.bismark.cov.gz")
+    bed_graph_path = os.path.join(tmpdir, "chr1.bedGraph.gz")
+    write_coverage(
+        merge_coverage([first, second]),
+        cov_path=cov_path,
+        bed_graph_path=bed_graph_path,
+    )
+    with gzip.open(cov_path, "rt") as fh:
+        assert fh.read().splitlines() == [
+            "chr1\t5\t5\t100\t2\t0",
+            "chr1\t12\t12\t66.6666666666667\t2\t1",
+            "chr1\t15\t15\t50\t1\t1",
+        ]
+    with gzip.open(bed_graph_path, "rt") as fh:
+        assert fh.read().splitlines()[:2] == [
+            "track type=bedGraph",
+            "chr1\t4\t5\t100",
+        ]
+
+
+RESOURCES = os.path.join(os.path.dirname(__file__), os.pardir, "resources")
+
+
+@pytest.mark.skipif(
+    shutil.which("bismark_methylation_extractor") is None, reason="needs Bismark"
+)
+def test_native_calling_fixture_matches_extractor(tmp_path):
+    # src/methylation_call.rs checks the native engine against the same file
+    subprocess.run(
+        [
+            "bismark_methylation_extractor",
+            "--ignore_r2",
+            str(IGNORE_R2),
+            "--ignore_3prime_r2",
+            str(IGNORE_3PRIME_R2),
+            "-p",
+            "--no_overlap",
+            "--bedGraph",
+            "--gzip",
+            "-o",
+            str(tmp_path),
+            os.path.join(RESOURCES, "methylation_call.sam"),
+        ],
+        check=True,
+    )
+    with gzip.open(tmp_path / "methylation_call.bismark.cov.gz", "rt") as fh:
+        calls = fh.read()
+    with open(os.path.join(RESOURCES, "methylation_call.bismark.cov")) as fh:
+        assert calls == fh.read()
+
+
+def test_contig_settings():
+    by_length = ContigSettings.parse({})
+    assert by_length.bam_sort_parameters() == [
+        "--min-contig-length",
+        "1000000",
+        "--misc-buckets",
+        "4",
+    ]
+    named = ContigSettings.parse({"names": [str(c) for c in range(1, 23)] + ["X"]})
+    assert named.bam_sort_parameters()[-2:] == [
+        "--contigs",
+        ",".join(named.contigs),
+    ]
+    with pytest.raises(ValueError):
+        ContigSettings.parse({"misc_buckets": -1})
+    with pytest.raises(ValueError):
+        GenomicRegion.parse("misc_0")
+
+
+def test_shard_compression_settings():
+    plain = ShardCompressionSettings.parse({})
+    assert not plain.enabled
+    assert plain.fastq_split_parameters() == []
+    fast = ShardCompressionSettings.parse({"level": 1, "threads": 4})
+    assert fast.fastq_split_parameters() == [
+        "--compression-level",
+        "1",
+        "--threads",
+        "4",
+    ]
+    # both may come in as strings, like the threads always could
+    assert ShardCompressionSettings.parse({"level": "1", "threads": "4"}) == fast
+    with pytest.raises(ValueError):
+        ShardCompressionSettings.parse({"level": 12})
+    with pytest.raises(ValueError):
+        ShardCompressionSettings.parse({"level": "12"})
+    with pytest.raises(ValueError):
+        ShardCompressionSettings.parse({"level": 1, "threads": 0})
+
+
+def test_export_manifest_follows_policy():
+    settings = ExportSettings.parse({"skip": ["alignment"]})
+    assert not settings.exports(ExportKind.ALIGNMENT)
+    assert settings.exports(ExportKind.CALLS)
+    with pytest.raises(ValueError):
+        ExportSettings.parse({"skip": ["everything"]})
+
+    exporter = OutputExporter(
+        settings=settings, transfer=TransferSettings(), resource_model=ResourceModel()
+    )
+    outputs = exporter.manifest(S3OutputLocation.parse("s3://bucket/run_1"))
+    outputs.register(ExportKind.ALIGNMENT, "0_mates.bam", "bam-id")
+    outputs.register_all(
+        ExportKind.CALLS, {"chr1.bedGraph.gz": "bg-id", "chr1.bismark.cov.gz": "cov-id"}
+    )
+    assert [o.url for o in outputs.outputs] == [
+        "s3://bucket/run_1/chr1.bedGraph.gz",
+        "s3://bucket/run_1/chr1.bismark.cov.gz",
+    ]
+
+    resources = ResourceModel().export_job(output_bytes=10 * GIB)
+    assert resources.cores == 1
+    assert resources.disk == 10 * GIB
+
+
+def test_merge_tree():
+    shards = [(Job.wrapFn(shard_count, GIB, bins=4), GIB) for _ in range(20)]
+    roots = _add_merge_tree(
+        shards,
+        group_size=4,
+        apps_image="apps",
+        resource_model=ResourceModel(),
+        profile_store=None,
+    )
+    # 5 premerges of 4 shards, then one of 4 of those next to the fifth
+    assert len(roots) == 2
+    assert roots[0].description.predecessorNumber == 4
+    assert roots[1].description.predecessorNumber == 4
+    assert all(shard.hasChild(roots[1]) for shard, _ in shards[16:])
+
+
+def test_packed_ranges(tmp_path):
+    members = []
+    for name, body in (("a.bam", b"alpha"), ("b.bam", b"beta")):
+        (tmp_path / name).write_bytes(body)
+        members.append(str(tmp_path / name))
+    packed = str(tmp_path / "alignments.packed")
+    assert pack_files(members, packed) == [(0, 5), (5, 4)]
+    assert not any(os.path.exists(m) for m in members)
+
+
+def test_packed_bams_by_partition(tmp_path):
+    class Unseekable(io.RawIOBase):
+        def __init__(self, path):
+            self.fh = open(path, "rb")
+
+        def readinto(self, b):
+            return self.fh.readinto(b)
+
+        def close(self):
+            self.fh.close()
+            super().close()
+
+    class FileStore:
+        def __init__(self):
+            self.objects = dict()
+            self.reads = []
+
+        def writeGlobalFile(self, path):
+            file_id = f"packed-{len(self.objects)}"
+            self.objects[file_id] = str(tmp_path / file_id)
+            shutil.copyfile(path, self.objects[file_id])
+            return file_id
+
+        def deleteLocalFile(self, file_id):
+            pass
+
+        @contextmanager
+        def readGlobalFileStream(self, file_id):
+            self.reads.append(file_id)
+            with Unseekable(self.objects[file_id]) as fh:
+                yield fh
+
+    bodies = {
+        "chr1:0-10": b"alpha",
+        "chr1:50-60": b"beta",
+        "chr1:60-70": b"gamma",
+        "misc_0": b"delta",
+    }
+    bam_paths = dict()
+    for region, body in bodies.items():
+        bam_paths[region] = str(tmp_path / f"{region.replace(':', '_')}.bam")
+        with open(bam_paths[region], "wb") as fh:
+            fh.write(body)
+    job = SimpleNamespace(fileStore=FileStore())
+    packed = pack_bams(job, bam_paths, str(tmp_path), partition_bp=60)
+    # one object per calling partition, not per region or per shard
+    assert packed["chr1:0-10"].packed_fid == packed["chr1:50-60"].packed_fid
+    assert len({p.packed_fid for p in packed.values()}) == 3
+
+    out = [str(tmp_path / "0.bam"), str(tmp_path / "1.bam")]
+    read_packed_bams(
+        job, [(packed["chr1:50-60"], out[0]), (packed["chr1:0-10"], out[1])]
+    )
+    assert job.fileStore.reads == [packed["chr1:0-10"].packed_fid]
+    with open(out[0], "rb") as fh:
+        assert fh.read() == b"beta"
+    with open(out[1], "rb") as fh:
+        assert fh.read() == b"alpha"
+
+
+def test_input_volumes_resolve_cache_links(tmp_path):
+    cached = tmp_path / "cache" / "shard"
+    cached.parent.mkdir()
+    cached.write_bytes(b"@read")
+    work = tmp_path / "work"
+    work.mkdir()
+    (work / "mates_1.fastq").symlink_to(cached)
+    volumes = input_volumes({"mates_1.fastq": str(work / "mates_1.fastq")})
+    assert volumes == {
+        str(cached): {"bind": f"{INPUTS_MOUNT}/mates_1.fastq", "mode": "ro"}
+    }
@@ -1,62 +1,93 @@
 import os
 import json
-from multiprocessing import Pool
+import shlex
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
 from pathlib import Path
-from typing import List
-
-import boto3
-from toil.lib.docker import apiDockerCall
-
-from aws_utils import parse_prefix_and_bucket, download_to_location
-from domain import PairedEndReadShard, S3OutputLocation, ResourceRequirement
+from typing import Iterator, List, Optional, Tuple
+
+from toil.fileStores import FileID
+from toil.job import Job
+
+from aws_utils import (
+    parse_prefix_and_bucket,
+    download_to_location,
+    get_content_length,
+    probe_object,
+    list_s3_objects,
+)
+from domain import (
+    ContigSettings,
+    ExportKind,
+    GenomeCacheSettings,
+    GenomicRegion,
+    PackedBam,
+    PairedEndReadShard,
+    ShardAlignments,
+    ParallelismPolicy,
+    S3OutputLocation,
+    ResourceModel,
+    Stage,
+    Storage,
+    TransferSettings,
+)
+from exports import OutputExporter
+from file_store import INPUTS_MOUNT, input_volumes, read_input
+from genome_cache import GenomeIndexCache, cache_key
+from packing import pack_bams, read_packed_bams
+from profiling import ResourceProfileStore, StageProfiler
+from result_cache import StageResultCache
+from transfer import S3TransferEngine
 
 
 class AlignmentConsts:
     mates_1_raw_fq = "mates_1.fastq"
     mates_2_raw_fq = "mates_2.fastq"
+    mates_1_raw_gz_fq = "mates_1.fastq.gz"
+    mates_2_raw_gz_fq = "mates_2.fastq.gz"
     #  TODO change this name?
     mates_1_trimmed_fq = "mates_1_val_1.fq.gz"
     mates_2_trimmed_fq = "mates_2_val_2.fq.gz"
+    mates_1_trimmed_plain_fq = "mates_1_val_1.fq"
+    mates_2_trimmed_plain_fq = "mates_2_val_2.fq"
     bismark_output_bam = "mates_1_val_1_bismark_bt2_pe.bam"
     bismark_output_report = "mates_1_val_1_bismark_bt2_PE_report.txt"
-    bismark_deduplicated_bam = "mates_1_val_1_bismark_bt2_pe.deduplicated.bam"
-    bismark_deduplication_report = (
-        "mates_1_val_1_bismark_bt2_pe.deduplication_report.txt"
-    )
+    sorted_bam = "mates_1_val_1_bismark_bt2_pe.sorted.bam"
+    premerge_script = "premerge.sh"
+    packed_alignments = "alignments.packed"
+    packed_regions = "regions.json"
 
 
-def download_file_from_s3(work):
-    bucket, key, destination = work
-    client = boto3.client("s3")
-    client.download_file(bucket, key, destination)
-
-
-def download_bismark_files(*, tempdir: str, bismark_index: str, bucket: str):
-    client = boto3.client("s3")
+def list_bismark_index_files(*, bismark_index: str, bucket: str) -> List[dict]:
     ga_conversion_files = []
     ct_conversion_files = []
-    next_token = ""
-
-    base_kwargs = {
-        "Bucket": bucket,
-        "Prefix": bismark_index,
-    }
-    while next_token is not None:
-        kwargs = base_kwargs.copy()
-        if next_token != "":
-            kwargs.update({"ContinuationToken": next_token})
-        results = client.list_objects_v2(**kwargs)
-        contents = results.get("Contents")
-        for i in contents:
-            k = i.get("Key")
-            assert k is not None
-            if "GA_conversion" in k:
-                ga_conversion_files.append(k)
-            if "CT_conversion" in k:
-                ct_conversion_files.append(k)
-        next_token = results.get("NextContinuationToken")
+    for i in list_s3_objects(bucket=bucket, prefix=bismark_index):
+        k = i.get("Key")
+        assert k is not None
+        if "GA_conversion" in k:
+            ga_conversion_files.append(i)
+        if "CT_conversion" in k:
+            ct_conversion_files.append(i)
 
     assert len(ga_conversion_files) == len(ct_conversion_files)
+    return ga_conversion_files + ct_conversion_files
+
+
+def download_bismark_files(
+    *,
+    tempdir: str,
+    bismark_index: str,
+    bucket: str,
+    index_files: List[dict] = None,
+    transfer: TransferSettings = None,
+):
+    if index_files is None:
+        index_files = list_bismark_index_files(
+            bismark_index=bismark_index, bucket=bucket
+        )
+    ga_conversion_files = [i["Key"] for i in index_files if "GA_conversion" in i["Key"]]
+    ct_conversion_files = [i["Key"] for i in index_files if "CT_conversion" in i["Key"]]
 
     bismark_genome_path = os.path.join(tempdir, "Bisulfite_Genome")
     ga_genome_path = Path(os.path.join(bismark_genome_path, "GA_conversion"))
@@ -76,8 +107,91 @@ def download_bismark_files(*, tempdir: str, bismark_index: str, bucket: str):
         work.append((bucket, ct_key, ct_file))
         print(ga_file, ct_file, bucket)
 
-    with Pool(processes=4) as pool:
-        pool.map(download_file_from_s3, work)
+    S3TransferEngine(transfer).download_many(work)
+
+
+def genome_key_parts(
+    *, bismark_index_url: str, bismark_genome_uri: str, index_files: List[dict]
+) -> List[str]:
+    genome_etag = probe_object(bismark_genome_uri, Storage.S3).etag
+    key_parts = [bismark_index_url, bismark_genome_uri, genome_etag]
+    key_parts.extend(
+        f"{i['Key']}:{i['ETag']}" for i in sorted(index_files, key=lambda i: i["Key"])
+    )
+    return key_parts
+
+
+@contextmanager
+def cached_bismark_genome(
+    *,
+    cache: GenomeIndexCache,
+    bismark_index_url: str,
+    bismark_genome_uri: str,
+    transfer: TransferSettings,
+) -> Iterator[str]:
+    """
+    Yield a node-local directory holding `Bisulfite_Genome/` and the genome
+    fasta, downloading them only if no job on this node has done so already.
+    The cache key covers the object ETags so a re-uploaded index isn't reused.
+    """
+    bucket, prefix = parse_prefix_and_bucket(bismark_index_url)
+    index_files = list_bismark_index_files(bismark_index=prefix, bucket=bucket)
+    key_parts = genome_key_parts(
+        bismark_index_url=bismark_index_url,
+        bismark_genome_uri=bismark_genome_uri,
+        index_files=index_files,
+    )
+
+    def fill(genome_dir: str):
+        download_bismark_files(
+            tempdir=genome_dir,
+            bismark_index=prefix,
+            bucket=bucket,
+            index_files=index_files,
+            transfer=transfer,
+        )
+        download_to_location(
+            s3_url=bismark_genome_uri, temp_dir=genome_dir, transfer=transfer
+        )
+
+    with cache.acquire(cache_key(key_parts), fill) as genome_dir:
+        yield genome_dir
+
+
+class IntermediateFiles:
+    """
+    Files the stages of a shard alignment leave in the job's temp dir. Each is
+    registered with the stages that read it and deleted as soon as the last of
+    them has finished, so the job's disk only holds the live set of the stage
+    that is running. Files that came from or went to the file store are
+    released through it so its cache accounting stays right.
+    """
+
+    def __init__(self, job, tempdir: str):
+        self.job = job
+        self.tempdir = tempdir
+        self.consumers = dict()
+        self.file_ids = dict()
+
+    def add(self, filename: str, *, consumers: List[Stage], file_id: FileID = None):
+        assert os.path.exists(os.path.join(self.tempdir, filename)), filename
+        self.consumers[filename] = set(consumers)
+        if file_id is not None:
+            self.file_ids[filename] = file_id
+
+    def finished(self, stage: Stage):
+        for filename, consumers in list(self.consumers.items()):
+            consumers.discard(stage)
+            if not consumers:
+                self._delete(filename)
+
+    def _delete(self, filename: str):
+        del self.consumers[filename]
+        file_id = self.file_ids.pop(filename, None)
+        if file_id is not None:
+            self.job.fileStore.deleteLocalFile(file_id)
+        else:
+            os.remove(os.path.join(self.tempdir, filename))
 
 
 class BismarkShardAligner:
@@ -92,6 +206,15 @@ class BismarkShardAligner:
         bismark_genome_uri: str,
         shard_idx: int,
         s3_location: S3OutputLocation,
+        genome_cache: GenomeCacheSettings,
+        transfer: TransferSettings,
+        profile_store: ResourceProfileStore,
+        exporter: OutputExporter,
+        fastq_bytes: int,
+        stream: bool = False,
+        region_bp: Optional[int] = None,
+        contigs: ContigSettings = None,
+        calling_region_bp: int = GenomicRegion.default_partition_bp,
     ):
         self.job = job
         self.apps_image = apps_image
@@ -101,33 +224,84 @@ class BismarkShardAligner:
         self.shard = shard
         self.shard_idx = shard_idx
         self.s3_output = s3_location
+        self.genome_cache = GenomeIndexCache(genome_cache)
+        self.transfer = transfer
         self.tempdir = job.fileStore.getLocalTempDir()
+        self.profiler = StageProfiler(job, profile_store)
+        self.parallelism = ParallelismPolicy.for_job(job)
+        self.intermediates = IntermediateFiles(job, self.tempdir)
+        self.outputs = exporter.manifest(s3_location)
+        # streaming skips compressing the trimmed reads Bismark reads straight
+        # back, and fetches the genome index while trimming runs
+        self.stream = stream
+        self.region_bp = region_bp
+        self.contigs = contigs if contigs is not None else ContigSettings()
+        self.calling_region_bp = calling_region_bp
+        self.fastq_bytes = fastq_bytes
+        if shard.compressed:
+            self.raw_fqs = (
+                AlignmentConsts.mates_1_raw_gz_fq,
+                AlignmentConsts.mates_2_raw_gz_fq,
+            )
+        else:
+            self.raw_fqs = (
+                AlignmentConsts.mates_1_raw_fq,
+                AlignmentConsts.mates_2_raw_fq,
+            )
+        if stream:
+            self.trimmed_fqs = (
+                AlignmentConsts.mates_1_trimmed_plain_fq,
+                AlignmentConsts.mates_2_trimmed_plain_fq,
+            )
+        else:
+            self.trimmed_fqs = (
+                AlignmentConsts.mates_1_trimmed_fq,
+                AlignmentConsts.mates_2_trimmed_fq,
+            )
 
         # these are filled in as the processing progresses
         self.mates_1_trimmed_path = None
         self.mates_2_trimmed_path = None
         self.bismark_alignment_path = None
-        self.bismark_deduplicated_bam_path = None
+
+    def _local_size(self, *filenames: str) -> int:
+        return sum(os.path.getsize(os.path.join(self.tempdir, f)) for f in filenames)
+
+    def _raw_fq_volumes(self) -> dict:
+        return input_volumes(
+            {
+                filename: os.path.join(self.tempdir, filename)
+                for filename in self.raw_fqs
+            }
+        )
 
     def _run_trim_galore(self):
-        _output = apiDockerCall(
-            self.job,
+        _output = self.profiler.docker_call(
+            stage=Stage.TRIM,
+            work_dir=self.tempdir,
+            # in plain fastq bytes, what the trim model is in terms of
+            input_bytes=self.fastq_bytes,
+            threads=self.parallelism.trim_galore_cores,
             user="root",
             image=self.apps_image,
-            volumes={self.tempdir: {"bind": "/io", "mode": "rw"}},
+            volumes={
+                self.tempdir: {"bind": "/io", "mode": "rw"},
+                **self._raw_fq_volumes(),
+            },
             parameters=[
                 "trim_galore",
+                *self.parallelism.trim_galore_parameters(),
                 "--fastqc",
-                "--gzip",
+                "--dont_gzip" if self.stream else "--gzip",
                 "--paired",
-                f"/io/{AlignmentConsts.mates_1_raw_fq}",
-                f"/io/{AlignmentConsts.mates_2_raw_fq}",
+                f"{INPUTS_MOUNT}/{self.raw_fqs[0]}",
+                f"{INPUTS_MOUNT}/{self.raw_fqs[1]}",
                 "-o",
                 "/io/",
             ],
         )
-        trimmed_1 = os.path.join(self.tempdir, AlignmentConsts.mates_1_trimmed_fq)
-        trimmed_2 = os.path.join(self.tempdir, AlignmentConsts.mates_2_trimmed_fq)
+        trimmed_1 = os.path.join(self.tempdir, self.trimmed_fqs[0])
+        trimmed_2 = os.path.join(self.tempdir, self.trimmed_fqs[1])
 
         assert os.path.exists(
             trimmed_1
@@ -137,27 +311,59 @@ class BismarkShardAligner:
         ), f"trimmed 2 missing, {os.listdir(self.tempdir)}"
         self.mates_1_trimmed_path = trimmed_1
         self.mates_2_trimmed_path = trimmed_2
+        for trimmed in self.trimmed_fqs:
+            self.intermediates.add(trimmed, consumers=[Stage.ALIGN])
+        self.intermediates.finished(Stage.TRIM)
+
+    def _cached_genome(self):
+        return cached_bismark_genome(
+            cache=self.genome_cache,
+            bismark_index_url=self.bismark_index_url,
+            bismark_genome_uri=self.bismark_genome_uri,
+            transfer=self.transfer,
+        )
 
-    def _run_bismark_alignment(self):
+    def _trim_with_genome(self, stack: ExitStack) -> str:
+        """
+        Trim the shard's reads and make the genome index available, returning
+        its directory, which stays held until `stack` is closed. Streaming
+        fetches the index (on a cache miss) while trimming runs. Bismark reads
+        its mate files more than once, so it can't consume trim_galore's
+        output through a pipe as it's written.
+        """
+        if not self.stream:
+            self._run_trim_galore()
+            return stack.enter_context(self._cached_genome())
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            genome_dir = pool.submit(stack.enter_context, self._cached_genome())
+            self._run_trim_galore()
+            return genome_dir.result()
+
+    def _run_bismark_alignment(self, genome_dir: str):
         assert self.mates_1_trimmed_path is not None
         assert self.mates_2_trimmed_path is not None
 
-        bucket, prefix = parse_prefix_and_bucket(self.bismark_index_url)
-        genome_dir = os.path.join(self.tempdir, "genome")
-        download_bismark_files(tempdir=genome_dir, bismark_index=prefix, bucket=bucket)
-        download_to_location(s3_url=self.bismark_genome_uri, temp_dir=genome_dir)
-
-        _ouput = apiDockerCall(
-            self.job,
+        genome_fasta = self.bismark_genome_uri.split("/")[-1]
+        _ouput = self.profiler.docker_call(
+            stage=Stage.ALIGN,
+            work_dir=self.tempdir,
+            input_bytes=self._local_size(*self.trimmed_fqs),
+            reference_bytes=os.path.getsize(os.path.join(genome_dir, genome_fasta)),
+            threads=self.parallelism.bowtie2_threads,
             user="root",
             image=self.apps_image,
-            volumes={self.tempdir: {"bind": "/io", "mode": "rw"}},
+            volumes={
+                self.tempdir: {"bind": "/io", "mode": "rw"},
+                genome_dir: {"bind": "/io/genome", "mode": "ro"},
+            },
             parameters=[
                 "bismark",
+                *self.parallelism.bismark_parameters(),
                 "-1",
-                f"/io/{AlignmentConsts.mates_1_trimmed_fq}",
+                f"/io/{self.trimmed_fqs[0]}",
                 "-2",
-                f"/io/{AlignmentConsts.mates_2_trimmed_fq}",
+                f"/io/{self.trimmed_fqs[1]}",
                 "--genome",
                 "/io/genome/",
                 "-o",
@@ -179,112 +385,111 @@ class BismarkShardAligner:
             output_alignment_report
         ), f"missing alignment {os.listdir(self.tempdir)}"
 
-        alignment_file_id = self.job.fileStore.writeGlobalFile(output_alignment_path)
-        report_file_id = self.job.fileStore.writeGlobalFile(output_alignment_report)
-
-        self.job.fileStore.exportFile(
-            alignment_file_id,
-            self.s3_output.to_url(
-                f"{self.shard_idx}_{AlignmentConsts.bismark_output_bam}"
-            ),
-        )
-        self.job.fileStore.exportFile(
-            report_file_id,
-            self.s3_output.to_url(
-                f"{self.shard_idx}_{AlignmentConsts.bismark_output_report}"
-            ),
+        # the unsorted BAM only goes to the file store to be exported
+        alignment_file_id = None
+        if self.outputs.wants(ExportKind.ALIGNMENT):
+            alignment_file_id = self.job.fileStore.writeGlobalFile(
+                output_alignment_path
+            )
+            self.outputs.register(
+                ExportKind.ALIGNMENT,
+                f"{self.shard_idx}_{AlignmentConsts.bismark_output_bam}",
+                alignment_file_id,
+            )
+        self.outputs.register(
+            ExportKind.REPORT,
+            f"{self.shard_idx}_{AlignmentConsts.bismark_output_report}",
+            self.job.fileStore.writeGlobalFile(output_alignment_report),
         )
         self.bismark_alignment_path = output_alignment_path
+        self.intermediates.add(
+            AlignmentConsts.bismark_output_bam,
+            consumers=[Stage.SORT],
+            file_id=alignment_file_id,
+        )
+        self.intermediates.finished(Stage.ALIGN)
 
-    def _run_bismark_deduplicate(self):
+    def _sort_alignment(self):
         assert self.bismark_alignment_path is not None
-
-        _ouput = apiDockerCall(
-            self.job,
+        _output = self.profiler.docker_call(
+            stage=Stage.SORT,
+            work_dir=self.tempdir,
+            input_bytes=self._local_size(AlignmentConsts.bismark_output_bam),
+            threads=self.parallelism.cores,
             user="root",
             image=self.apps_image,
             volumes={self.tempdir: {"bind": "/io", "mode": "rw"}},
+            # by read name, which keeps the mates of a pair next to each other
+            # through bam-sort and the merges into calling
             parameters=[
-                "deduplicate_bismark",
-                "-p",
+                "samtools",
+                "sort",
+                "-n",
+                *self.parallelism.samtools_sort_parameters(),
+                "-T",
+                "/io/sort_tmp",
+                "-o",
+                f"/io/{AlignmentConsts.sorted_bam}",
                 f"/io/{AlignmentConsts.bismark_output_bam}",
-                "--output_dir",
-                "/io/",
             ],
         )
-        deduplicated_bam_path = os.path.join(
-            self.tempdir, AlignmentConsts.bismark_deduplicated_bam
-        )
-        deduplication_report_path = os.path.join(
-            self.tempdir, AlignmentConsts.bismark_deduplication_report
-        )
-
-        assert os.path.exists(
-            deduplicated_bam_path
-        ), f"missing deduped alignment {os.listdir(self.tempdir)}"
-        assert os.path.exists(
-            deduplication_report_path
-        ), f"missing deduped alignment report {os.listdir(self.tempdir)}"
-
-        deduplication_report_file_id = self.job.fileStore.writeGlobalFile(
-            deduplication_report_path
-        )
-        self.job.fileStore.exportFile(
-            deduplication_report_file_id,
-            self.s3_output.to_url(
-                f"{self.shard_idx}_{AlignmentConsts.bismark_deduplication_report}"
-            ),
-        )
-        self.bismark_deduplicated_bam_path = deduplicated_bam_path
+        sorted_path = os.path.join(self.tempdir, AlignmentConsts.sorted_bam)
+        assert os.path.exists(sorted_path), f"missing sorted {os.listdir(self.tempdir)}"
+        self.intermediates.add(AlignmentConsts.sorted_bam, consumers=[Stage.SPLIT])
+        self.intermediates.finished(Stage.SORT)
 
     def _shard_alignment_by_chrom(self) -> dict:
-        assert self.bismark_deduplicated_bam_path is not None
-        chrom_files = apiDockerCall(
-            self.job,
+        """
+        Split the alignment by chromosome or, with `region_bp`, by windows of
+        that many bases, keyed `chrom:start-end`, into read name sorted
+        PackedBams, packed in one file store object per calling partition
+        (see packing) rather than one per region. Contigs not
+        selected to be split out on their own are bucketed into `misc_N`
+        outputs. Duplicates are removed per chromosome (or window) once every
+        shard's reads are together, see methylation_calling.
+        """
+        window = [] if self.region_bp is None else ["-w", str(self.region_bp)]
+        chrom_files = self.profiler.docker_call(
+            stage=Stage.SPLIT,
+            work_dir=self.tempdir,
+            input_bytes=self._local_size(AlignmentConsts.sorted_bam),
             user="root",
             image=self.utils_image,
             volumes={self.tempdir: {"bind": "/io", "mode": "rw"}},
             parameters=[
                 "bam-sort",
                 "-i",
-                f"/io/{AlignmentConsts.bismark_deduplicated_bam}",
+                f"/io/{AlignmentConsts.sorted_bam}",
+                *window,
+                *self.contigs.bam_sort_parameters(),
             ],
         )
         chrom_files = json.loads(chrom_files)
+        self.intermediates.finished(Stage.SPLIT)
 
-        results = dict()
+        bam_paths = dict()
         for chrom, alignment_file in chrom_files:
-            alignment_file_path = os.path.join(self.tempdir, alignment_file)
-            chrom_file_id = self.job.fileStore.writeGlobalFile(alignment_file_path)
-            # self.job.fileStore.exportFile(
-            #     chrom_file_id,
-            #     self.s3_output.to_url(
-            #         f"{self.shard_idx}_{chrom}_{AlignmentConsts.bismark_deduplicated_bam}"
-            #     ),
-            # )
-            assert chrom not in results, f"repeat of {chrom}?, output {chrom_files}"
-            results[chrom] = chrom_file_id
-        return results
+            assert chrom not in bam_paths, f"repeat of {chrom}?, output {chrom_files}"
+            bam_paths[chrom] = os.path.join(self.tempdir, alignment_file)
+        return pack_bams(
+            self.job, bam_paths, self.tempdir, partition_bp=self.calling_region_bp
+        )
 
     def run_alignment_on_shard(self):
-        self.job.fileStore.readGlobalFile(
-            fileStoreID=self.shard.mate1_fid,
-            userPath=os.path.join(self.tempdir, AlignmentConsts.mates_1_raw_fq),
-        )
-        self.job.fileStore.readGlobalFile(
-            fileStoreID=self.shard.mate2_fid,
-            userPath=os.path.join(self.tempdir, AlignmentConsts.mates_2_raw_fq),
-        )
-        assert os.path.exists(
-            os.path.join(self.tempdir, AlignmentConsts.mates_1_raw_fq)
-        )
-        assert os.path.exists(
-            os.path.join(self.tempdir, AlignmentConsts.mates_2_raw_fq)
-        )
-        self._run_trim_galore()
-        self._run_bismark_alignment()
-        self._run_bismark_deduplicate()
+        # trim_galore only reads the shard, so it is linked from the cache
+        for filename, file_id in zip(
+            self.raw_fqs, (self.shard.mate1_fid, self.shard.mate2_fid)
+        ):
+            read_input(self.job, file_id, os.path.join(self.tempdir, filename))
+            assert os.path.exists(os.path.join(self.tempdir, filename))
+            self.intermediates.add(filename, consumers=[Stage.TRIM], file_id=file_id)
+        with ExitStack() as stack:
+            genome_dir = self._trim_with_genome(stack)
+            self._run_bismark_alignment(genome_dir)
+        self._sort_alignment()
         chrom_file_ids = self._shard_alignment_by_chrom()
+        self.profiler.flush()
+        self.outputs.schedule(self.job, name=f"alignment-{self.shard_idx}")
         return chrom_file_ids
 
 
@@ -298,6 +503,17 @@ def align_shard(
     bismark_index_url: str,
     bismark_genome_uri: str,
     s3_location: S3OutputLocation,
+    genome_cache: GenomeCacheSettings,
+    transfer: TransferSettings,
+    profile_store: ResourceProfileStore,
+    exporter: OutputExporter,
+    fastq_bytes: int,
+    stream: bool = False,
+    region_bp: Optional[int] = None,
+    contigs: ContigSettings = None,
+    calling_region_bp: int = GenomicRegion.default_partition_bp,
+    result_cache: Optional[StageResultCache] = None,
+    result_key: Optional[str] = None,
 ):
     shard_aligner = BismarkShardAligner(
         job,
@@ -308,10 +524,69 @@ def align_shard(
         bismark_genome_uri=bismark_genome_uri,
         shard_idx=shard_idx,
         s3_location=s3_location,
+        genome_cache=genome_cache,
+        transfer=transfer,
+        profile_store=profile_store,
+        exporter=exporter,
+        fastq_bytes=fastq_bytes,
+        stream=stream,
+        region_bp=region_bp,
+        contigs=contigs,
+        calling_region_bp=calling_region_bp,
     )
     result = shard_aligner.run_alignment_on_shard()
-
-    return result
+    if result_key is not None:
+        for region, packed_bam in result.items():
+            packed_bam.cache_key = cache_key([result_key, region])
+    if result_cache is not None and result:
+        # the packed objects are stored as `<i>_alignments.packed`, regions.json
+        # maps each region to its object's name and byte range
+        names = dict()
+        for packed_bam in result.values():
+            names.setdefault(
+                packed_bam.packed_fid,
+                f"{len(names)}_{AlignmentConsts.packed_alignments}",
+            )
+        regions_path = os.path.join(
+            job.fileStore.getLocalTempDir(), AlignmentConsts.packed_regions
+        )
+        with open(regions_path, "w") as fh:
+            json.dump(
+                {
+                    region: [names[packed_bam.packed_fid], *packed_bam.byte_range]
+                    for region, packed_bam in result.items()
+                },
+                fh,
+            )
+        files = {name: packed_fid for packed_fid, name in names.items()}
+        files[AlignmentConsts.packed_regions] = job.fileStore.writeGlobalFile(
+            regions_path
+        )
+        result_cache.schedule_store(job, result_key, files)
+
+    return ShardAlignments(sample=shard.name, alignments=result)
+
+
+def restore_shard_alignments(
+    job, *, sample: str, result_cache: StageResultCache, result_key: str
+) -> ShardAlignments:
+    """
+    The alignments of an earlier run's alignment of the same shard.
+    """
+    files = result_cache.restore(job, result_key)
+    with job.fileStore.readGlobalFileStream(
+        files[AlignmentConsts.packed_regions], encoding="utf-8"
+    ) as fh:
+        regions = json.load(fh)
+    alignments = {
+        region: PackedBam(
+            packed_fid=files[name],
+            byte_range=(offset, length),
+            cache_key=cache_key([result_key, region]),
+        )
+        for region, (name, offset, length) in regions.items()
+    }
+    return ShardAlignments(sample=sample, alignments=alignments)
 
 
 def dummy_align_shard(
@@ -324,12 +599,22 @@ def dummy_align_shard(
     bismark_index_url: str,
     bismark_genome_uri: str,
     s3_location: S3OutputLocation,
+    genome_cache: GenomeCacheSettings,
+    transfer: TransferSettings,
+    profile_store: ResourceProfileStore,
+    exporter: OutputExporter,
+    stream: bool = False,
+    region_bp: Optional[int] = None,
+    contigs: ContigSettings = None,
 ):
     import time
 
     print("DUMMY")
     time.sleep(3)
-    return {"chr1": f"{shard_idx}-foo", "chr2": f"{shard_idx}-bar"}
+    return ShardAlignments(
+        sample=shard.name,
+        alignments={"chr1": f"{shard_idx}-foo", "chr2": f"{shard_idx}-bar"},
+    )
 
 
 def alignment_root_job(
@@ -340,21 +625,75 @@ def alignment_root_job(
     bismark_index_url: str,
     bismark_genome_uri: str,
     s3_location: S3OutputLocation,
+    genome_cache: GenomeCacheSettings,
+    transfer: TransferSettings,
+    stream: bool,
+    region_bp: Optional[int],
+    contigs: ContigSettings,
+    resource_model: ResourceModel,
+    profile_store: ResourceProfileStore,
+    exporter: OutputExporter,
+    result_cache: Optional[StageResultCache] = None,
+    merge_group_size: Optional[int] = None,
+    calling_region_bp: int = GenomicRegion.default_partition_bp,
 ):
-    results = []
-    for i, shard in enumerate(shards):
-        memory = ResourceRequirement.convert_size(int(shard.mate1_fid.size * 1.25))
-        disc = ResourceRequirement.convert_size(int(shard.mate1_fid.size * 1.1))
+    """
+    Align every shard of a sample. With `merge_group_size` the shards'
+    alignments are merged region by region in a tree as groups of that many
+    complete, so calling reads a few premerged BAMs per region rather than
+    one per shard.
+    """
+    reference_bytes = get_content_length(bismark_genome_uri, Storage.S3)
+    result_keys = [None] * len(shards)
+    cached = dict()
+    if result_cache is not None:
+        bucket, prefix = parse_prefix_and_bucket(bismark_index_url)
+        alignment_parts = genome_key_parts(
+            bismark_index_url=bismark_index_url,
+            bismark_genome_uri=bismark_genome_uri,
+            index_files=list_bismark_index_files(bismark_index=prefix, bucket=bucket),
+        )
+        alignment_parts.extend([str(region_bp), str(calling_region_bp)])
+        alignment_parts.extend(contigs.bam_sort_parameters())
+        result_keys = [
+            (
+                None
+                if shard.cache_key is None
+                else result_cache.key(Stage.ALIGN, [shard.cache_key, *alignment_parts])
+            )
+            for shard in shards
+        ]
+        cached = result_cache.contains([k for k in result_keys if k is not None])
 
-        raise NotImplementedError("add disc and memory reqs for reference")
+    results = []
+    aligned_bytes = []
+    for i, (shard, result_key) in enumerate(zip(shards, result_keys)):
+        fastq_bytes = resource_model.shard_fastq_bytes(shard)
+        aligned_bytes.append(resource_model.aligned_bytes(shard_bytes=fastq_bytes))
+        if cached.get(result_key, False):
+            job.log(f"reusing alignment-{i} from the result cache")
+            results.append(
+                job.addChildJobFn(
+                    restore_shard_alignments,
+                    name=f"alignment-{i}",
+                    sample=shard.name,
+                    result_cache=result_cache,
+                    result_key=result_key,
+                )
+            )
+            continue
+        resources = resource_model.align_shard_job(
+            shard_bytes=fastq_bytes,
+            reference_bytes=reference_bytes,
+            gzip_trimmed=not stream,
+            compressed_shard=shard.compressed,
+            region_bp=region_bp,
+        )
+        job.log(f"alignment-{i} requests {resources}")
 
         shard_alignment = job.addChildJobFn(
             align_shard,
-            cores=4,
             # dummy_align_shard,
-            # cores=0.1,
-            memory=memory.to_string(),
-            disk=disc.to_string(),
             name=f"alignment-{i}",
             shard=shard,
             shard_idx=i,
@@ -363,7 +702,165 @@ def alignment_root_job(
             bismark_index_url=bismark_index_url,
             bismark_genome_uri=bismark_genome_uri,
             s3_location=s3_location,
+            genome_cache=genome_cache,
+            transfer=transfer,
+            stream=stream,
+            region_bp=region_bp,
+            contigs=contigs,
+            calling_region_bp=calling_region_bp,
+            profile_store=profile_store,
+            exporter=exporter,
+            fastq_bytes=fastq_bytes,
+            result_cache=result_cache if result_key is not None else None,
+            result_key=result_key,
+            **resources.to_job_kwargs(),
         )
         results.append(shard_alignment)
 
+    if merge_group_size is not None:
+        results = _add_merge_tree(
+            list(zip(results, aligned_bytes)),
+            group_size=merge_group_size,
+            apps_image=apps_image,
+            calling_region_bp=calling_region_bp,
+            resource_model=resource_model,
+            profile_store=profile_store,
+        )
     return [r.rv() for r in results]
+
+
+def _add_merge_tree(
+    nodes: List[Tuple[Job, int]],
+    *,
+    group_size: int,
+    apps_image: str,
+    resource_model: ResourceModel,
+    profile_store: ResourceProfileStore,
+    calling_region_bp: int = GenomicRegion.default_partition_bp,
+) -> List[Job]:
+    """
+    Add premerges of `group_size` of `nodes`, (job, estimated alignment
+    bytes) pairs, each a child of every job it merges so it starts as soon as
+    they are done, then of groups of those, until at most `group_size` jobs
+    are left. These are returned.
+    """
+    assert group_size > 1, f"illegal merge group size {group_size}"
+    level = 0
+    while len(nodes) > group_size:
+        merged = []
+        for g in range(0, len(nodes), group_size):
+            group = nodes[g : g + group_size]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+            group_bytes = sum(alignment_bytes for _, alignment_bytes in group)
+            resources = resource_model.premerge_job(alignment_bytes=group_bytes)
+            premerge = Job.wrapJobFn(
+                premerge_shard_alignments,
+                name=f"premerge-{level}-{g // group_size}",
+                alignments=[parent.rv() for parent, _ in group],
+                apps_image=apps_image,
+                profile_store=profile_store,
+                calling_region_bp=calling_region_bp,
+                **resources.to_job_kwargs(),
+            )
+            for parent, _ in group:
+                parent.addChild(premerge)
+            merged.append((premerge, group_bytes))
+        nodes = merged
+        level += 1
+    return [node for node, _ in nodes]
+
+
+def premerge_shard_alignments(
+    job,
+    *,
+    alignments: List[ShardAlignments],
+    apps_image: str,
+    profile_store: ResourceProfileStore,
+    calling_region_bp: int = GenomicRegion.default_partition_bp,
+) -> ShardAlignments:
+    """
+    Merge a group of one sample's shard alignments region by region into read
+    name sorted BAMs, in a single container running a merge per region, and
+    pack them by calling partition as the shards were.
+    """
+    temp_dir = job.fileStore.getLocalTempDir()
+    profiler = StageProfiler(job, profile_store)
+    parallelism = ParallelismPolicy.for_job(job)
+    samples = {shard.sample for shard in alignments}
+    assert len(samples) == 1, f"premerging alignments of samples {samples}"
+
+    regions = defaultdict(list)
+    for shard in alignments:
+        for region, packed_bam in shard.alignments.items():
+            regions[region].append(packed_bam)
+
+    members = []
+    outputs = dict()
+    script = ["set -euo pipefail"]
+    for j, (region, packed_bams) in enumerate(sorted(regions.items())):
+        inputs = [f"{j}_{i}.bam" for i in range(len(packed_bams))]
+        members.extend(
+            (packed_bam, os.path.join(temp_dir, bam))
+            for packed_bam, bam in zip(packed_bams, inputs)
+        )
+        if len(packed_bams) == 1:
+            # repacked as it is, so every output object holds whole partitions
+            outputs[region] = (inputs[0], [], packed_bams)
+            continue
+        output = f"{j}.bam"
+        script.append(
+            shlex.join(
+                [
+                    "samtools",
+                    "merge",
+                    "-n",
+                    "-f",
+                    "-@",
+                    str(parallelism.cores),
+                    f"/io/{output}",
+                    *[f"/io/{bam}" for bam in inputs],
+                ]
+            )
+        )
+        outputs[region] = (output, inputs, packed_bams)
+    # every input object is read whole, once
+    read_packed_bams(job, members)
+    if len(script) > 1:
+        with open(os.path.join(temp_dir, AlignmentConsts.premerge_script), "w") as fh:
+            fh.write("\n".join(script) + "\n")
+        _premerge_output = profiler.docker_call(
+            stage=Stage.PREMERGE,
+            work_dir=temp_dir,
+            input_bytes=sum(
+                packed_bam.size
+                for _, inputs, packed_bams in outputs.values()
+                if inputs
+                for packed_bam in packed_bams
+            ),
+            threads=parallelism.cores,
+            user="root",
+            image=apps_image,
+            volumes={temp_dir: {"bind": "/io", "mode": "rw"}},
+            parameters=["bash", f"/io/{AlignmentConsts.premerge_script}"],
+        )
+        profiler.flush()
+
+    output_paths = dict()
+    for region, (output, inputs, _) in outputs.items():
+        output_path = os.path.join(temp_dir, output)
+        assert os.path.exists(output_path), f"missing merge of {region}"
+        output_paths[region] = output_path
+        for bam in inputs:
+            os.remove(os.path.join(temp_dir, bam))
+    packed = pack_bams(job, output_paths, temp_dir, partition_bp=calling_region_bp)
+    for region, (_, inputs, packed_bams) in outputs.items():
+        input_keys = [packed_bam.cache_key for packed_bam in packed_bams]
+        if not inputs:
+            packed[region].cache_key = input_keys[0]
+        elif None not in input_keys:
+            packed[region].cache_key = cache_key(
+                [Stage.PREMERGE.value, *sorted(input_keys)]
+            )
+    return ShardAlignments(sample=samples.pop(), alignments=packed)
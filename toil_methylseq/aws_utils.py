@@ -1,10 +1,17 @@
-import math
 import os
-from typing import List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
 
-import boto3
-
-from domain import Storage, ArtifactResourceRequirements, ResourceRequirement
+from domain import (
+    Storage,
+    ArtifactResourceRequirements,
+    ResourceRequirement,
+    TransferSettings,
+)
+from transfer import S3TransferEngine, get_s3_client
 
 
 def _split_s3_url(s3_url) -> (str, List[str]):
@@ -31,30 +38,110 @@ def parse_s3_url_key_bucket_filename(s3_url) -> (str, str, str):
         raise ValueError("illegal s3 url") from e
 
 
-def download_to_location(*, s3_url: str, temp_dir: str) -> (str, str):
-    s3 = boto3.client("s3")
+def list_s3_objects(*, bucket: str, prefix: str) -> List[dict]:
+    client = get_s3_client()
+    objects = []
+    next_token = ""
+
+    base_kwargs = {
+        "Bucket": bucket,
+        "Prefix": prefix,
+    }
+    while next_token is not None:
+        kwargs = base_kwargs.copy()
+        if next_token != "":
+            kwargs.update({"ContinuationToken": next_token})
+        results = client.list_objects_v2(**kwargs)
+        objects.extend(results.get("Contents", []))
+        next_token = results.get("NextContinuationToken")
+    return objects
+
+
+def download_to_location(
+    *, s3_url: str, temp_dir: str, transfer: TransferSettings = None
+) -> (str, str):
     bucket, key, filename = parse_s3_url_key_bucket_filename(s3_url)
     temp_filepath = os.path.join(temp_dir, filename)
-    s3.download_file(bucket, key, temp_filepath)
+    S3TransferEngine(transfer).download(
+        bucket=bucket, key=key, destination=temp_filepath
+    )
     return temp_filepath, filename
 
 
+@dataclass
+class ObjectMetadata:
+    uri: str
+    size: int
+    etag: str
+
+
+# how long a probe is trusted, an object can be replaced under the same uri
+PROBE_TTL_SECONDS = 300
+
+_metadata_lock = threading.Lock()
+# uri -> (ObjectMetadata, monotonic time it was probed)
+_metadata = dict()
+
+
+def _probe_object(uri: str, storage: Storage) -> ObjectMetadata:
+    if storage.value == Storage.S3.value:
+        bucket, key, _ = parse_s3_url_key_bucket_filename(uri)
+        head = get_s3_client().head_object(Bucket=bucket, Key=key)
+        return ObjectMetadata(uri=uri, size=head["ContentLength"], etag=head["ETag"])
+    else:
+        # sharding only downloads from S3, see preprocessing._staged_reads
+        raise NotImplementedError(f"local inputs aren't supported, {uri}")
+
+
+def probe_objects(
+    uris: List[Tuple[str, Storage]], concurrency: int = 32
+) -> Dict[str, ObjectMetadata]:
+    """
+    Size and ETag of every (uri, storage) in `uris`, fetched with concurrent
+    HEAD requests. Probes are memoized in this worker process only, not
+    across the workflow, so each job (and the jobs Toil chains into its
+    process) probes an object once. They are trusted for `PROBE_TTL_SECONDS`,
+    after which an object that was replaced is seen with its new size and
+    ETag.
+    """
+    now = time.monotonic()
+    with _metadata_lock:
+        missing = list(
+            {
+                uri: storage
+                for uri, storage in uris
+                if uri not in _metadata or now - _metadata[uri][1] > PROBE_TTL_SECONDS
+            }.items()
+        )
+    probed = dict()
+    if missing:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for metadata in pool.map(lambda u: _probe_object(*u), missing):
+                probed[metadata.uri] = metadata
+        with _metadata_lock:
+            for metadata in probed.values():
+                _metadata[metadata.uri] = (metadata, now)
+    with _metadata_lock:
+        return {
+            uri: probed[uri] if uri in probed else _metadata[uri][0] for uri, _ in uris
+        }
+
+
+def probe_object(uri: str, storage: Storage) -> ObjectMetadata:
+    return probe_objects([(uri, storage)])[uri]
+
+
+def get_content_length(uri: str, storage: Storage) -> int:
+    return probe_object(uri, storage).size
+
+
 def estimate_resource_requirements(
     uri: str,
     storage: Storage,
     mem_expand_buffer: float = 1.25,
     disc_expand_buffer: float = 1.1,
 ) -> ArtifactResourceRequirements:
-    if storage.value == Storage.S3.value:
-        s3 = boto3.client("s3")
-        bucket, key, _ = parse_s3_url_key_bucket_filename(uri)
-        content_length = s3.get_object(Bucket=bucket, Key=key)["ContentLength"]
-        disc = ResourceRequirement.convert_size(
-            int(disc_expand_buffer * content_length)
-        )
-        memory = ResourceRequirement.convert_size(
-            int(mem_expand_buffer * content_length)
-        )
-        return ArtifactResourceRequirements(memory=memory, disc=disc)
-    else:
-        raise NotImplementedError("local file estimate?")
+    content_length = get_content_length(uri, storage)
+    disc = ResourceRequirement.convert_size(int(disc_expand_buffer * content_length))
+    memory = ResourceRequirement.convert_size(int(mem_expand_buffer * content_length))
+    return ArtifactResourceRequirements(memory=memory, disc=disc)
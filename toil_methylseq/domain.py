@@ -1,7 +1,10 @@
 import math
-from enum import IntEnum
-from dataclasses import dataclass
-from typing import List
+import os
+import re
+import tempfile
+from enum import Enum, IntEnum
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
 
 from toil.fileStores import FileID
 
@@ -36,7 +39,7 @@ class ResourceRequirement:
         x = self.size_name.index(self.unit)
         y = self.size_name.index(other_unit)
         diff = x - y
-        mul = 1000 ** diff
+        mul = 1024 ** diff
         new_amount = self.amount * mul
         return ResourceRequirement(amount=new_amount, unit=other_unit)
 
@@ -76,6 +79,518 @@ class ArtifactResourceRequirements:
         )
 
 
+GIB = 1024 * 1024 * 1024
+MIB = 1024 * 1024
+
+
+class Stage(Enum):
+    SHARDING = "sharding"
+    TRIM = "trim"
+    ALIGN = "align"
+    SORT = "sort"
+    DEDUP = "dedup"
+    SPLIT = "split"
+    PREMERGE = "premerge"
+    MERGE = "merge"
+    EXTRACT = "extract"
+    CALL = "call"
+
+
+class CallingEngine(Enum):
+    # bismark_methylation_extractor and bismark2bedGraph
+    BISMARK = "bismark"
+    # `tmu call-methylation`, counting CpG calls from the XM tags in memory
+    # (the utils image only builds if it matches the extractor's calls on
+    # resources/methylation_call.sam)
+    NATIVE = "native"
+
+
+class ExportKind(Enum):
+    # a shard's Bismark BAM, before sorting and deduplication
+    ALIGNMENT = "alignment"
+    # Bismark alignment and deduplication reports
+    REPORT = "report"
+    # a region's deduplicated BAM, as the caller read it
+    METHYLATION_INPUT = "methylation_input"
+    # coverage and bedGraph files
+    CALLS = "calls"
+
+
+@dataclass
+class JobResources:
+    """
+    A Toil resource request, memory and disk in bytes.
+    """
+
+    memory: int
+    disk: int
+    cores: int
+
+    def __str__(self):
+        memory = ResourceRequirement.convert_size(self.memory).to_string()
+        disk = ResourceRequirement.convert_size(self.disk).to_string()
+        return f"memory: {memory}, disk: {disk}, cores: {self.cores}"
+
+    def __repr__(self):
+        return str(self)
+
+    def to_job_kwargs(self) -> dict:
+        return {"memory": self.memory, "disk": self.disk, "cores": self.cores}
+
+
+@dataclass
+class StageResourceModel:
+    """
+    Linear model of one stage's footprint in terms of the bytes it reads, the
+    size of the reference genome and the number of threads it runs. `disk` is
+    what the stage writes (outputs and scratch), not counting its inputs, and
+    `output_per_input` is the part of that left behind for the next stage.
+    """
+
+    memory_base: int
+    memory_per_input: float = 0.0
+    memory_per_reference: float = 0.0
+    memory_per_thread: int = 0
+    disk_base: int = 0
+    disk_per_input: float = 0.0
+    output_per_input: float = 0.0
+
+    def memory(
+        self, *, input_bytes: int, reference_bytes: int = 0, threads: int = 1
+    ) -> int:
+        return int(
+            self.memory_base
+            + self.memory_per_input * input_bytes
+            + self.memory_per_reference * reference_bytes
+            + self.memory_per_thread * max(0, threads - 1)
+        )
+
+    def disk(self, *, input_bytes: int) -> int:
+        return int(self.disk_base + self.disk_per_input * input_bytes)
+
+    def output_bytes(self, *, input_bytes: int) -> int:
+        return int(self.output_per_input * input_bytes)
+
+    def estimate(
+        self, *, input_bytes: int, reference_bytes: int = 0, threads: int = 1
+    ) -> JobResources:
+        """
+        Resources for a job running just this stage, its inputs on local disk.
+        """
+        memory = self.memory(
+            input_bytes=input_bytes, reference_bytes=reference_bytes, threads=threads
+        )
+        disk = input_bytes + self.disk(input_bytes=input_bytes)
+        return JobResources(memory=memory, disk=disk, cores=threads)
+
+
+def _default_stage_models() -> dict:
+    # sharding reads gzipped fastq and writes it back out uncompressed, Bismark
+    # loads one bowtie2 index per conversion (two for directional libraries)
+    # and writes uncompressed converted reads next to its BAM, the extractor
+    # writes gzipped per-context calls before building the coverage files
+    return {
+        Stage.SHARDING: StageResourceModel(
+            memory_base=GIB, disk_per_input=4.0, output_per_input=4.0
+        ),
+        Stage.TRIM: StageResourceModel(
+            memory_base=GIB,
+            memory_per_thread=256 * MIB,
+            disk_per_input=0.35,
+            output_per_input=0.3,
+        ),
+        Stage.ALIGN: StageResourceModel(
+            memory_base=GIB,
+            memory_per_reference=3.5,
+            memory_per_thread=256 * MIB,
+            disk_base=GIB,
+            disk_per_input=5.0,
+            output_per_input=1.0,
+        ),
+        Stage.SORT: StageResourceModel(
+            memory_base=GIB,
+            memory_per_thread=512 * MIB,
+            disk_per_input=2.0,
+            output_per_input=0.9,
+        ),
+        Stage.DEDUP: StageResourceModel(
+            memory_base=GIB,
+            memory_per_input=0.5,
+            disk_per_input=1.0,
+            output_per_input=0.9,
+        ),
+        Stage.SPLIT: StageResourceModel(
+            memory_base=512 * MIB, disk_per_input=1.0, output_per_input=1.0
+        ),
+        Stage.PREMERGE: StageResourceModel(
+            memory_base=512 * MIB,
+            memory_per_thread=128 * MIB,
+            disk_per_input=1.0,
+            output_per_input=1.0,
+        ),
+        Stage.MERGE: StageResourceModel(
+            memory_base=512 * MIB,
+            memory_per_thread=128 * MIB,
+            disk_per_input=1.0,
+            output_per_input=1.0,
+        ),
+        Stage.EXTRACT: StageResourceModel(
+            memory_base=2 * GIB,
+            memory_per_input=0.25,
+            memory_per_thread=GIB,
+            disk_base=GIB,
+            disk_per_input=6.0,
+            output_per_input=0.5,
+        ),
+        Stage.CALL: StageResourceModel(
+            memory_base=512 * MIB,
+            memory_per_input=0.1,
+            disk_per_input=0.3,
+            output_per_input=0.3,
+        ),
+    }
+
+
+@dataclass
+class ParallelismPolicy:
+    """
+    How the tools of the alignment stages use a job's cores. trim_galore's
+    `--cores N` runs about 3N processes (cutadapt plus pigz in and out), and
+    every Bismark instance runs two bowtie2 processes of `-p` threads each
+    plus a Perl process. `--multicore` instances each hold their own copy of
+    the bowtie2 indices, so threads are preferred and another instance is only
+    added per `bismark_cores_per_instance` cores. deduplicate_bismark is
+    single threaded and samtools is given every core of its job, sort taking
+    `samtools_sort_memory` per thread. Each `--multicore` instance of the
+    methylation extractor runs about 3 processes (itself, samtools and gzip),
+    and bismark2bedGraph sorts its calls once they are done, so the sort
+    buffer gets most of the job's `memory`.
+    """
+
+    cores: int
+    bismark_cores_per_instance: int = 8
+    memory: int = 0
+
+    samtools_sort_memory = "512M"
+
+    @classmethod
+    def for_job(cls, job):
+        return ParallelismPolicy(cores=max(1, int(job.cores)), memory=int(job.memory))
+
+    @property
+    def trim_galore_cores(self) -> int:
+        return max(1, self.cores // 3)
+
+    @property
+    def bismark_instances(self) -> int:
+        return max(1, self.cores // self.bismark_cores_per_instance)
+
+    @property
+    def bowtie2_threads(self) -> int:
+        instance_cores = self.cores // self.bismark_instances
+        return max(1, (instance_cores - 1) // 2)
+
+    def stage_threads(self, stage: Stage) -> int:
+        if stage == Stage.TRIM:
+            return self.trim_galore_cores
+        if stage == Stage.ALIGN:
+            return self.bowtie2_threads
+        if stage in (Stage.SORT, Stage.PREMERGE, Stage.MERGE, Stage.EXTRACT):
+            return self.cores
+        return 1
+
+    def stage_instances(self, stage: Stage) -> int:
+        return self.bismark_instances if stage == Stage.ALIGN else 1
+
+    def trim_galore_parameters(self) -> List[str]:
+        return ["--cores", str(self.trim_galore_cores)]
+
+    def samtools_sort_parameters(self) -> List[str]:
+        return ["-@", str(self.cores), "-m", self.samtools_sort_memory]
+
+    @property
+    def extractor_instances(self) -> int:
+        return max(1, self.cores // 3)
+
+    def extractor_parameters(self) -> List[str]:
+        buffer_size = max(256 * MIB, self.memory * 3 // 4)
+        return [
+            "--multicore",
+            str(self.extractor_instances),
+            "--buffer_size",
+            f"{buffer_size // MIB}M",
+        ]
+
+    def bismark_parameters(self) -> List[str]:
+        parameters = ["-p", str(self.bowtie2_threads)]
+        if self.bismark_instances > 1:
+            parameters.extend(["--multicore", str(self.bismark_instances)])
+        return parameters
+
+
+@dataclass
+class ShardCompressionSettings:
+    """
+    Whether fastq-split writes read shards gzip compressed at `level`,
+    with `threads` compressing them, rather than as plain fastq. trim_galore
+    reads compressed shards as they are.
+    """
+
+    level: Optional[int] = None
+    threads: int = 1
+
+    @classmethod
+    def parse(cls, raw: dict):
+        level = raw.get("level")
+        level = None if level is None else int(level)
+        threads = int(raw.get("threads", 1))
+        if (level is not None and not 0 <= level <= 9) or threads < 1:
+            raise ValueError(
+                f"illegal shard compression, level {level} threads {threads}"
+            )
+        return ShardCompressionSettings(level=level, threads=threads)
+
+    @property
+    def enabled(self) -> bool:
+        return self.level is not None
+
+    def fastq_split_parameters(self) -> List[str]:
+        if not self.enabled:
+            return []
+        return ["--compression-level", str(self.level), "--threads", str(self.threads)]
+
+
+@dataclass
+class ResourceModel:
+    """
+    Per-stage resource estimators used to size every job the workflow
+    schedules, so that jobs pack densely without running out of memory or disk.
+    """
+
+    stages: dict = field(default_factory=_default_stage_models)
+    align_cores: int = 4
+    # stages whose output is written to the file store by the job running them
+    exported_stages: tuple = (Stage.ALIGN, Stage.DEDUP)
+    # gzip shrinks fastq to about this fraction of its size
+    fastq_gzip_ratio: float = 0.3
+    # a calling job gets a core per `extract_bytes_per_core` of alignments,
+    # up to `extract_cores`
+    extract_cores: int = 12
+    extract_bytes_per_core: int = 256 * MIB
+    premerge_cores: int = 2
+    # bam-sort keeps a BGZF writer (and a file descriptor) open per window of
+    # `region_bp` until the shard is split, its blocks and buffers take about
+    # this much
+    split_window_bytes: int = 256 * 1024
+    min_memory: int = 512 * MIB
+    min_disk: int = GIB
+
+    def stage(self, stage: Stage) -> StageResourceModel:
+        return self.stages[stage]
+
+    def _floor(self, resources: JobResources) -> JobResources:
+        return JobResources(
+            memory=max(self.min_memory, resources.memory),
+            disk=max(self.min_disk, resources.disk),
+            cores=resources.cores,
+        )
+
+    def sharding_job(
+        self,
+        *,
+        reads_bytes: int,
+        staged: bool,
+        compression: ShardCompressionSettings = None,
+        stream_buffer_bytes: int = 0,
+    ) -> JobResources:
+        """
+        `reads_bytes` is the compressed size of both mates, `staged` whether
+        they are downloaded to the job's disk rather than streamed, in which
+        case up to `stream_buffer_bytes` of them are held in memory. Compressed
+        shards take a core per compression thread and a fraction of the disk.
+        """
+        sharding = self.stage(Stage.SHARDING)
+        memory = sharding.memory(input_bytes=reads_bytes)
+        disk = sharding.disk(input_bytes=reads_bytes)
+        cores = 1
+        if compression is not None and compression.enabled:
+            disk = int(disk * self.fastq_gzip_ratio)
+            cores = compression.threads
+        if staged:
+            disk += reads_bytes
+        else:
+            memory += stream_buffer_bytes
+        return self._floor(JobResources(memory=memory, disk=disk, cores=cores))
+
+    def shard_fastq_bytes(self, shard: "PairedEndReadShard") -> int:
+        """
+        Uncompressed size of a shard's reads, which the alignment stages are
+        modelled in terms of.
+        """
+        size = shard.mate1_fid.size + shard.mate2_fid.size
+        return int(size / self.fastq_gzip_ratio) if shard.compressed else size
+
+    @staticmethod
+    def split_windows(*, reference_bytes: int, region_bp: Optional[int]) -> int:
+        """
+        Number of windows bam-sort splits a shard into, about one per
+        `region_bp` of the reference, none when it splits by chromosome.
+        """
+        return 0 if region_bp is None else reference_bytes // region_bp + 1
+
+    def _run_stages(
+        self,
+        stages: List[Stage],
+        *,
+        input_bytes: int,
+        reference_bytes: int,
+        parallelism: ParallelismPolicy,
+        gzip_trimmed: bool = True,
+        gzipped_input: bool = False,
+        split_windows: int = 0,
+    ) -> (int, int):
+        """
+        Memory and disk of a job running `stages` one after the other. Its
+        memory is that of the hungriest stage, with every Bismark instance
+        counted. Each intermediate is deleted once the stage reading it is done,
+        so its disk is the peak over stages of the stage's input plus what it
+        writes, plus files that have been written to the file store, which
+        stay in its cache until the job's outputs are committed. A stage reading
+        a file the previous one wrote to the file store reads the cached file
+        itself, so that input isn't counted again. With `gzipped_input` the
+        job's input is gzipped on disk, `input_bytes` being its plain size.
+        The split holds `split_windows` open outputs on top of its model.
+        """
+        memory = 0
+        disk = 0
+        in_file_store = 0
+        cached_input = 0
+        input_on_disk = (
+            int(input_bytes * self.fastq_gzip_ratio) if gzipped_input else input_bytes
+        )
+        for stage in stages:
+            model = self.stage(stage)
+            instances = parallelism.stage_instances(stage)
+            stage_memory = instances * model.memory(
+                input_bytes=input_bytes // instances,
+                reference_bytes=reference_bytes,
+                threads=parallelism.stage_threads(stage),
+            )
+            if stage == Stage.SPLIT:
+                stage_memory += split_windows * self.split_window_bytes
+            memory = max(memory, stage_memory)
+            stage_disk = model.disk(input_bytes=input_bytes)
+            output_bytes = model.output_bytes(input_bytes=input_bytes)
+            if stage == Stage.TRIM and not gzip_trimmed:
+                stage_disk = int(stage_disk / self.fastq_gzip_ratio)
+                output_bytes = int(output_bytes / self.fastq_gzip_ratio)
+            disk = max(disk, in_file_store + input_on_disk - cached_input + stage_disk)
+            cached_input = 0
+            if stage in self.exported_stages:
+                in_file_store += output_bytes
+                cached_input = output_bytes
+            input_bytes = input_on_disk = output_bytes
+        return memory, disk
+
+    def aligned_bytes(self, *, shard_bytes: int) -> int:
+        """
+        Estimated size of a shard's alignments once split by region.
+        """
+        for stage in [Stage.TRIM, Stage.ALIGN, Stage.SORT, Stage.SPLIT]:
+            shard_bytes = self.stage(stage).output_bytes(input_bytes=shard_bytes)
+        return shard_bytes
+
+    def align_shard_job(
+        self,
+        *,
+        shard_bytes: int,
+        reference_bytes: int,
+        gzip_trimmed: bool = True,
+        compressed_shard: bool = False,
+        region_bp: Optional[int] = None,
+    ) -> JobResources:
+        """
+        An alignment job trims, aligns, sorts and splits one shard by
+        chromosome, or into windows of `region_bp`. The genome index lives in
+        the node-local cache, outside the job's disk. Without `gzip_trimmed`
+        the trimmed reads are left uncompressed. `shard_bytes` is the plain
+        size of the shard's reads, see `shard_fastq_bytes`, also when it is a
+        `compressed_shard`.
+        """
+        parallelism = ParallelismPolicy(cores=self.align_cores)
+        memory, disk = self._run_stages(
+            [Stage.TRIM, Stage.ALIGN, Stage.SORT, Stage.SPLIT],
+            input_bytes=shard_bytes,
+            reference_bytes=reference_bytes,
+            parallelism=parallelism,
+            gzip_trimmed=gzip_trimmed,
+            gzipped_input=compressed_shard,
+            split_windows=self.split_windows(
+                reference_bytes=reference_bytes, region_bp=region_bp
+            ),
+        )
+        return self._floor(
+            JobResources(memory=memory, disk=disk, cores=self.align_cores)
+        )
+
+    def calling_job(
+        self, *, alignment_bytes: int, engine: CallingEngine = CallingEngine.BISMARK
+    ) -> JobResources:
+        """
+        Methylation calling reads the per-shard alignments of a chromosome,
+        merges them into read name order, deduplicates them and runs the
+        calling `engine` on the result, with cores in proportion to the
+        alignments.
+        """
+        calling = Stage.EXTRACT if engine == CallingEngine.BISMARK else Stage.CALL
+        cores = min(
+            self.extract_cores,
+            max(1, math.ceil(alignment_bytes / self.extract_bytes_per_core)),
+        )
+        memory, disk = self._run_stages(
+            [Stage.MERGE, Stage.DEDUP, calling],
+            input_bytes=alignment_bytes,
+            reference_bytes=0,
+            parallelism=ParallelismPolicy(cores=cores),
+        )
+        return self._floor(JobResources(memory=memory, disk=disk, cores=cores))
+
+    def premerge_job(self, *, alignment_bytes: int) -> JobResources:
+        """
+        A premerge merges a group of shards' read name sorted alignments
+        region by region, with a few threads for compression.
+        """
+        parallelism = ParallelismPolicy(cores=self.premerge_cores)
+        memory, disk = self._run_stages(
+            [Stage.PREMERGE],
+            input_bytes=alignment_bytes,
+            reference_bytes=0,
+            parallelism=parallelism,
+        )
+        return self._floor(
+            JobResources(memory=memory, disk=disk, cores=self.premerge_cores)
+        )
+
+    def stitch_job(self, *, alignment_bytes: int) -> JobResources:
+        """
+        Stitching streams a chromosome's per-region calls into its coverage
+        file and the bedGraph made from it.
+        """
+        calls = self.stage(Stage.EXTRACT).output_bytes(input_bytes=alignment_bytes)
+        return self._floor(
+            JobResources(memory=self.min_memory, disk=3 * calls, cores=1)
+        )
+
+    def export_job(self, *, output_bytes: int) -> JobResources:
+        """
+        Exporting reads the outputs out of the file store and uploads them,
+        which takes threads but barely any CPU.
+        """
+        return self._floor(
+            JobResources(memory=self.min_memory, disk=output_bytes, cores=1)
+        )
+
+
 class Storage(IntEnum):
     S3 = 1
     Local = 2
@@ -103,6 +618,25 @@ class S3OutputLocation:
         except ValueError as e:
             raise ValueError(f"failed to parse s3 location {raw}") from e
 
+    def for_sample(self, sample: str):
+        """
+        Where a sample's own results go, under a prefix named after it.
+        """
+        key = self.key.rstrip("/")
+        return S3OutputLocation(
+            bucket=self.bucket, key=f"{key}/{sample.replace('/', '')}"
+        )
+
+    def sibling_url(self, name: str) -> str:
+        """
+        The url of `name` next to the output prefix, rather than in it.
+        """
+        parent = os.path.dirname(self.key.strip("/"))
+        name = name.replace("/", "")
+        if not parent:
+            return f"s3://{self.bucket}/{name}"
+        return f"s3://{self.bucket}/{parent}/{name}"
+
     def to_url(self, filename: str) -> str:
         key = self.key if self.key.startswith("/") else f"/{self.key}"
         filename = filename.replace("/", "")
@@ -146,6 +680,210 @@ class PairedEndReadShard:
     mate1_fid: FileID
     mate2_fid: FileID
     name: str
+    # identifies the shard's content in the stage result cache, when it's used
+    cache_key: Optional[str] = None
+    # whether the mates are gzipped fastq, see ShardCompressionSettings
+    compressed: bool = False
+
+
+@dataclass
+class PackedBam:
+    """
+    A read name sorted BAM, as the (offset, length) byte range of a packed
+    file store object that holds the other regions of the same shard (or
+    premerge) too, see packing.
+    """
+
+    packed_fid: FileID
+    byte_range: Tuple[int, int]
+    cache_key: Optional[str] = None
+
+    @property
+    def size(self) -> int:
+        return self.byte_range[1]
+
+
+@dataclass
+class ShardAlignments:
+    """
+    A shard's alignments by chromosome (or window, or misc bucket) and the
+    sample its reads came from.
+    """
+
+    sample: str
+    alignments: Dict[str, PackedBam]
+
+
+@dataclass(frozen=True)
+class GenomicRegion:
+    """
+    A window of a chromosome, 0-based and half open, as bam-sort names them
+    (`chrom:start-end`).
+    """
+
+    chrom: str
+    start: int
+    end: int
+
+    pattern = re.compile(r"^(.+):(\d+)-(\d+)$")
+    # windows are called in partitions of about an average human chromosome
+    default_partition_bp = 128_000_000
+
+    @classmethod
+    def parse(cls, raw: str):
+        match = cls.pattern.match(raw)
+        if match is None:
+            raise ValueError(f"{raw} is not a region")
+        chrom, start, end = match.groups()
+        return GenomicRegion(chrom=chrom, start=int(start), end=int(end))
+
+    @classmethod
+    def spanning(cls, regions: List["GenomicRegion"]):
+        assert len({r.chrom for r in regions}) == 1, f"{regions} span chromosomes"
+        return GenomicRegion(
+            chrom=regions[0].chrom,
+            start=min(r.start for r in regions),
+            end=max(r.end for r in regions),
+        )
+
+    def partition(self, partition_bp: int) -> "GenomicRegion":
+        """
+        The span of `partition_bp` bases of the chromosome the window starts
+        in, which it is packed and called with.
+        """
+        start = self.start // partition_bp * partition_bp
+        return GenomicRegion(chrom=self.chrom, start=start, end=start + partition_bp)
+
+    @property
+    def label(self) -> str:
+        """
+        The region as a file name.
+        """
+        return f"{self.chrom}_{self.start}-{self.end}"
+
+
+@dataclass
+class ContigSettings:
+    """
+    Which contigs bam-sort splits alignments into. Named `contigs`, or by
+    default every contig of at least `min_length` bases, get their own output
+    and the rest (unplaced, alt and decoy contigs, and chrM by length) share
+    `misc_buckets`, or are dropped if that is 0.
+    """
+
+    default_misc_buckets = 4
+    default_min_length = 1000000
+
+    contigs: Optional[List[str]] = None
+    min_length: int = default_min_length
+    misc_buckets: int = default_misc_buckets
+
+    @classmethod
+    def parse(cls, raw: dict):
+        contigs = raw.get("names")
+        min_length = int(raw.get("min_length", cls.default_min_length))
+        misc_buckets = int(raw.get("misc_buckets", cls.default_misc_buckets))
+        if misc_buckets < 0 or min_length < 0:
+            raise ValueError(
+                f"illegal contig settings, min length {min_length} "
+                f"misc buckets {misc_buckets}"
+            )
+        if contigs is not None and any("," in c for c in contigs):
+            raise ValueError(f"contig names can't contain commas, {contigs}")
+        return ContigSettings(
+            contigs=contigs, min_length=min_length, misc_buckets=misc_buckets
+        )
+
+    def bam_sort_parameters(self) -> List[str]:
+        parameters = [
+            "--min-contig-length",
+            str(self.min_length),
+            "--misc-buckets",
+            str(self.misc_buckets),
+        ]
+        if self.contigs is not None:
+            parameters.extend(["--contigs", ",".join(self.contigs)])
+        return parameters
+
+
+@dataclass
+class GenomeCacheSettings:
+    root: str
+    max_bytes: int
+
+    default_max_bytes = 64 * 1024 * 1024 * 1024
+
+    @classmethod
+    def parse(cls, raw: dict):
+        root = raw.get(
+            "root", os.path.join(tempfile.gettempdir(), "toil-methylseq-genome-cache")
+        )
+        max_bytes = int(raw.get("max_bytes", cls.default_max_bytes))
+        if max_bytes <= 0:
+            raise ValueError(f"genome cache max_bytes should be positive, {max_bytes}")
+        return GenomeCacheSettings(root=root, max_bytes=max_bytes)
+
+
+@dataclass
+class ResultCacheSettings:
+    """
+    Whether stage results are reused across runs, and where they are kept,
+    by default in `stage_cache` next to the output prefix.
+    """
+
+    enabled: bool = False
+    url: Optional[str] = None
+
+    @classmethod
+    def parse(cls, raw: dict):
+        url = raw.get("url")
+        if url is not None and not url.startswith("s3://"):
+            raise ValueError(f"result cache url should be on s3, {url}")
+        return ResultCacheSettings(enabled=bool(raw.get("enabled", False)), url=url)
+
+
+@dataclass
+class ExportSettings:
+    """
+    Which kinds of outputs are exported to `s3_output`, the others are only
+    used within the workflow.
+    """
+
+    skip: List[ExportKind] = field(default_factory=list)
+
+    @classmethod
+    def parse(cls, raw: dict):
+        return ExportSettings(skip=[ExportKind(kind) for kind in raw.get("skip", [])])
+
+    def exports(self, kind: ExportKind) -> bool:
+        return kind not in self.skip
+
+
+@dataclass
+class TransferSettings:
+    default_concurrency = 10
+    default_part_size = 64 * 1024 * 1024
+    # a streamed object is read this many parts ahead of its consumer at most
+    stream_buffer_parts = 4
+
+    concurrency: int = default_concurrency
+    part_size: int = default_part_size
+
+    @property
+    def stream_buffer_bytes(self) -> int:
+        return self.stream_buffer_parts * self.part_size
+
+    @classmethod
+    def parse(cls, raw: dict):
+        concurrency = int(raw.get("concurrency", cls.default_concurrency))
+        part_size = int(raw.get("part_size", cls.default_part_size))
+        # S3 rejects multipart parts under 5MB
+        if concurrency < 1 or part_size < 5 * 1024 * 1024:
+            raise ValueError(
+                f"illegal transfer settings, concurrency {concurrency} "
+                f"part size {part_size}"
+            )
+        return TransferSettings(concurrency=concurrency, part_size=part_size)
 
 
 @dataclass
@@ -157,3 +895,18 @@ class ToilMethylseqConfig:
     bismark_index_url: str
     bismark_genome_uri: str
     bins: int
+    genome_cache: GenomeCacheSettings
+    transfer: TransferSettings
+    stream_sharding: bool
+    stream_alignment: bool
+    target_shard_bytes: Optional[int]
+    region_bp: Optional[int]
+    contigs: ContigSettings
+    shard_compression: ShardCompressionSettings
+    calling_engine: CallingEngine
+    pool_samples: bool
+    result_cache: ResultCacheSettings
+    exports: ExportSettings
+    merge_group_size: Optional[int]
+    calling_region_bp: int
+    resource_model: ResourceModel
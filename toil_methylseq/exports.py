@@ -0,0 +1,101 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List
+
+from toil.fileStores import FileID
+
+from aws_utils import parse_s3_url_key_bucket_filename
+from domain import (
+    ExportKind,
+    ExportSettings,
+    ResourceModel,
+    S3OutputLocation,
+    TransferSettings,
+)
+from file_store import read_input
+from transfer import S3TransferEngine
+
+
+@dataclass
+class OutputFile:
+    file_id: FileID
+    url: str
+
+
+@dataclass
+class OutputExporter:
+    """
+    What a compute job needs to hand its outputs over to an export job rather
+    than uploading them itself.
+    """
+
+    settings: ExportSettings
+    transfer: TransferSettings
+    resource_model: ResourceModel
+
+    def manifest(self, s3_output: S3OutputLocation) -> "OutputManifest":
+        return OutputManifest(self, s3_output)
+
+
+class OutputManifest:
+    """
+    The outputs one job registers for export. `schedule` adds a follow-on
+    that uploads them once the job is done, so its cores aren't held while
+    they upload, and outputs the export settings skip are left out.
+    """
+
+    def __init__(self, exporter: OutputExporter, s3_output: S3OutputLocation):
+        self.exporter = exporter
+        self.s3_output = s3_output
+        self.outputs: List[OutputFile] = []
+
+    def wants(self, kind: ExportKind) -> bool:
+        return self.exporter.settings.exports(kind)
+
+    def register(self, kind: ExportKind, filename: str, file_id: FileID):
+        if self.wants(kind):
+            self.outputs.append(
+                OutputFile(file_id=file_id, url=self.s3_output.to_url(filename))
+            )
+
+    def register_all(self, kind: ExportKind, files: Dict[str, FileID]):
+        for filename, file_id in files.items():
+            self.register(kind, filename, file_id)
+
+    def schedule(self, job, *, name: str):
+        if not self.outputs:
+            return
+        resources = self.exporter.resource_model.export_job(
+            output_bytes=sum(output.file_id.size for output in self.outputs)
+        )
+        job.addFollowOnJobFn(
+            export_outputs,
+            name=f"{name}_export",
+            outputs=self.outputs,
+            transfer=self.exporter.transfer,
+            **resources.to_job_kwargs(),
+        )
+        self.outputs = []
+
+
+def export_outputs(job, *, outputs: List[OutputFile], transfer: TransferSettings):
+    """
+    Upload `outputs` with multipart transfers, each as soon as it has been
+    read out of the file store while the next ones are being read.
+    """
+    temp_dir = job.fileStore.getLocalTempDir()
+    engine = S3TransferEngine(transfer)
+    with ThreadPoolExecutor(max_workers=transfer.concurrency) as pool:
+        uploads = []
+        for i, output in enumerate(outputs):
+            bucket, key, filename = parse_s3_url_key_bucket_filename(output.url)
+            path = read_input(
+                job, output.file_id, os.path.join(temp_dir, f"{i}_{filename}")
+            )
+            uploads.append(
+                pool.submit(engine.upload, source=path, bucket=bucket, key=key)
+            )
+        stats = [upload.result() for upload in uploads]
+    job.log(f"exported {len(stats)} outputs, {sum(s.size for s in stats)} bytes")
+    return "ok"
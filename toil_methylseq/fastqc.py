@@ -5,14 +5,16 @@ from typing import List, Tuple
 from toil.fileStores import FileID
 from toil.lib.docker import apiDockerCall
 
-from domain import PairedEndReads, S3OutputLocation
+from domain import PairedEndReads, S3OutputLocation, TransferSettings
 from aws_utils import download_to_location
 
 
-def _run_on_reads(job, s3_url: str, apps_image: str) -> List[Tuple[str, FileID]]:
+def _run_on_reads(
+    job, s3_url: str, apps_image: str, transfer: TransferSettings
+) -> List[Tuple[str, FileID]]:
     temp_dir = job.fileStore.getLocalTempDir()
     reads_file_path, reads_filename = download_to_location(
-        s3_url=s3_url, temp_dir=temp_dir
+        s3_url=s3_url, temp_dir=temp_dir, transfer=transfer
     )
     stdout = apiDockerCall(
         job,
@@ -37,7 +39,7 @@ def _run_on_reads(job, s3_url: str, apps_image: str) -> List[Tuple[str, FileID]]
 
 
 def run_fastqc_on_files(
-    job, reads: List[PairedEndReads], apps_image: str
+    job, reads: List[PairedEndReads], apps_image: str, transfer: TransferSettings
 ) -> List[List[tuple]]:
     s3_uris = itertools.chain(*[[r.uri_1, r.uri_2] for r in reads])
     results = [
@@ -45,6 +47,7 @@ def run_fastqc_on_files(
             _run_on_reads,
             s3_url=uri,
             apps_image=apps_image,
+            transfer=transfer,
             name=f"fastqc_on_{uri}",
             disk="20G",
             memory="10G",
@@ -84,12 +87,18 @@ def publish_results_job(job, results: list, s3_output: S3OutputLocation):
 
 
 def run_fastqc_root(
-    job, reads: List[PairedEndReads], *, s3_output: S3OutputLocation, apps_image: str
+    job,
+    reads: List[PairedEndReads],
+    *,
+    s3_output: S3OutputLocation,
+    apps_image: str,
+    transfer: TransferSettings,
 ):
     run_fastqc_job = job.addChildJobFn(
         run_fastqc_on_files,
         reads=reads,
         apps_image=apps_image,
+        transfer=transfer,
         name="run_fastqc_on_files",
     )
     job.addFollowOnJobFn(
@@ -0,0 +1,31 @@
+import os
+from typing import Dict
+
+from toil.fileStores import FileID
+
+# where read-only inputs are mounted in the containers
+INPUTS_MOUNT = "/inputs"
+
+
+def read_input(job, file_id: FileID, path: str) -> str:
+    """
+    Make a file store object that is only read available at `path`, linked to
+    the node's file cache rather than copied out of it. It must be released
+    with `deleteLocalFile`, never modified.
+    """
+    return job.fileStore.readGlobalFile(
+        file_id, path, cache=True, mutable=False, symlink=True
+    )
+
+
+def input_volumes(paths: Dict[str, str]) -> dict:
+    """
+    Docker volumes mounting each of `paths` read-only at
+    `INPUTS_MOUNT/<name>`. A symlink into the file cache would dangle inside a
+    container that only mounts the job's temp dir, so the file it resolves to
+    is mounted instead.
+    """
+    return {
+        os.path.realpath(path): {"bind": f"{INPUTS_MOUNT}/{name}", "mode": "ro"}
+        for name, path in paths.items()
+    }
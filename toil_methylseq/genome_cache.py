@@ -0,0 +1,176 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import stat
+import time
+from contextlib import ExitStack, contextmanager
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from domain import GenomeCacheSettings
+
+
+class GenomeCacheConsts:
+    complete_marker = ".complete"
+    lock_suffix = ".lock"
+    fill_suffix = ".filling"
+
+
+def cache_key(parts: List[str]) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _directory_size(path: str) -> int:
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for f in files:
+            total += os.lstat(os.path.join(root, f)).st_size
+    return total
+
+
+def _make_read_only(path: str):
+    read_only = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+    for root, _dirs, files in os.walk(path):
+        for f in files:
+            os.chmod(os.path.join(root, f), read_only)
+
+
+class GenomeIndexCache:
+    """
+    Node-local cache of genome indices shared by every job on a host.
+
+    Entries are directories named by a content key (callers hash the source
+    URLs together with their ETags). Each entry has a sibling lock file: the
+    job that fills an entry holds it exclusively, readers hold it shared for as
+    long as they use the entry, so eviction never removes an index that a
+    running container has mounted. Entries are evicted least-recently-used
+    first once the cache would exceed `max_bytes`.
+    """
+
+    def __init__(self, settings: GenomeCacheSettings):
+        self.root = settings.root
+        self.max_bytes = settings.max_bytes
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def _lock_path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}{GenomeCacheConsts.lock_suffix}")
+
+    def _marker_path(self, key: str) -> str:
+        return os.path.join(self._entry_path(key), GenomeCacheConsts.complete_marker)
+
+    def _is_complete(self, key: str) -> bool:
+        return os.path.exists(self._marker_path(key))
+
+    def _entry_size(self, key: str) -> int:
+        with open(self._marker_path(key), "r") as fh:
+            return json.load(fh)["size"]
+
+    def _entry_stat(self, key: str) -> Optional[Tuple[int, float]]:
+        """
+        The entry's size and last use, None once another job evicted it.
+        """
+        try:
+            return self._entry_size(key), os.path.getmtime(self._marker_path(key))
+        except FileNotFoundError:
+            return None
+
+    def _touch(self, key: str):
+        os.utime(self._marker_path(key))
+
+    def _fill(self, key: str, fill: Callable[[str], None]) -> int:
+        fill_path = os.path.join(
+            self.root, f"{key}.{os.getpid()}{GenomeCacheConsts.fill_suffix}"
+        )
+        shutil.rmtree(fill_path, ignore_errors=True)
+        os.makedirs(fill_path)
+        try:
+            fill(fill_path)
+            size = _directory_size(fill_path)
+            _make_read_only(fill_path)
+            entry_path = self._entry_path(key)
+            # a previous fill may have died between the rename and the marker
+            shutil.rmtree(entry_path, ignore_errors=True)
+            os.rename(fill_path, entry_path)
+        except BaseException:
+            shutil.rmtree(fill_path, ignore_errors=True)
+            raise
+
+        # renamed into place, so other jobs never read a partial marker
+        marker_path = self._marker_path(key)
+        with open(f"{marker_path}{GenomeCacheConsts.fill_suffix}", "w") as fh:
+            json.dump({"size": size, "filled": time.time()}, fh)
+        os.rename(f"{marker_path}{GenomeCacheConsts.fill_suffix}", marker_path)
+        return size
+
+    def _complete_entries(self) -> List[str]:
+        return [
+            key
+            for key in os.listdir(self.root)
+            if os.path.isdir(self._entry_path(key)) and self._is_complete(key)
+        ]
+
+    def evict(self, *, keep: str, incoming_bytes: int):
+        with ExitStack() as locks:
+            in_use_bytes = 0
+            candidates = []
+            for key in self._complete_entries():
+                if key == keep:
+                    continue
+                lock_fh = locks.enter_context(open(self._lock_path(key), "a"))
+                try:
+                    fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                except BlockingIOError:
+                    # in use (or being evicted) by another job on this node
+                    locked = False
+                entry = self._entry_stat(key)
+                if entry is None:
+                    continue
+                size, last_use = entry
+                if locked:
+                    candidates.append((last_use, size, key))
+                else:
+                    in_use_bytes += size
+            total = (
+                in_use_bytes + sum(size for _, size, _ in candidates) + incoming_bytes
+            )
+            for _, size, key in sorted(candidates):
+                if total <= self.max_bytes:
+                    break
+                os.remove(self._marker_path(key))
+                shutil.rmtree(self._entry_path(key))
+                total -= size
+
+    @contextmanager
+    def acquire(self, key: str, fill: Callable[[str], None]) -> Iterator[str]:
+        """
+        Yield the path of the cache entry for `key`, calling `fill` with an
+        empty directory first if the entry isn't on this node yet. Any number
+        of callers hold a complete entry at once, callers for a missing entry
+        block until the first one has filled it.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(self._lock_path(key), "a") as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_SH)
+            while not self._is_complete(key):
+                # only filling needs the entry to itself
+                fcntl.flock(lock_fh, fcntl.LOCK_UN)
+                fcntl.flock(lock_fh, fcntl.LOCK_EX)
+                if not self._is_complete(key):
+                    size = self._fill(key, fill)
+                    self.evict(keep=key, incoming_bytes=size)
+                # flock drops the exclusive lock before taking the shared one,
+                # an eviction in between leaves no entry to hand out
+                fcntl.flock(lock_fh, fcntl.LOCK_SH)
+            self._touch(key)
+            try:
+                yield self._entry_path(key)
+            finally:
+                fcntl.flock(lock_fh, fcntl.LOCK_UN)
@@ -1,16 +1,35 @@
+import itertools
 import json
 from argparse import ArgumentParser
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 from toil.common import Toil
 from toil.job import Job
 
-from domain import PairedEndReads, S3OutputLocation, ToilMethylseqConfig
+from domain import (
+    CallingEngine,
+    ContigSettings,
+    ExportSettings,
+    GenomeCacheSettings,
+    GenomicRegion,
+    PairedEndReads,
+    ResourceModel,
+    ResultCacheSettings,
+    S3OutputLocation,
+    ShardAlignments,
+    ShardCompressionSettings,
+    ToilMethylseqConfig,
+    TransferSettings,
+)
+from exports import OutputExporter
 from fastqc import run_fastqc_root
-from preprocessing import shard_input_fastq
+from aws_utils import probe_objects
+from preprocessing import add_sharding_job
 from methylation_calling import methylation_calling_root_job
 from alignment import alignment_root_job
+from profiling import ResourceProfileStore, fit_resource_model
+from result_cache import StageResultCache
 
 
 def parse_config(path: str) -> ToilMethylseqConfig:
@@ -36,40 +55,122 @@ def parse_config(path: str) -> ToilMethylseqConfig:
             config["bismark_genome_uri"] = raw_config["bismark_reference_genome_fasta"]
             config["bismark_index_url"] = raw_config["bismark_genome_index"]
             config["bins"] = raw_config.get("bins", 4)
+            config["genome_cache"] = GenomeCacheSettings.parse(
+                raw_config.get("genome_cache", {})
+            )
+            config["transfer"] = TransferSettings.parse(raw_config.get("transfer", {}))
+            config["stream_sharding"] = raw_config.get("stream_sharding", False)
+            config["stream_alignment"] = raw_config.get("stream_alignment", False)
+            config["target_shard_bytes"] = raw_config.get("target_shard_bytes")
+            config["region_bp"] = raw_config.get("region_bp")
+            config["contigs"] = ContigSettings.parse(raw_config.get("contigs", {}))
+            config["shard_compression"] = ShardCompressionSettings.parse(
+                raw_config.get("shard_compression", {})
+            )
+            config["calling_region_bp"] = raw_config.get(
+                "calling_region_bp", GenomicRegion.default_partition_bp
+            )
+            config["calling_engine"] = CallingEngine(
+                raw_config.get("calling_engine", CallingEngine.BISMARK.value)
+            )
+            config["pool_samples"] = raw_config.get("pool_samples", False)
+            config["result_cache"] = ResultCacheSettings.parse(
+                raw_config.get("result_cache", {})
+            )
+            config["exports"] = ExportSettings.parse(raw_config.get("exports", {}))
+            merge_group_size = raw_config.get("merge_group_size")
+            if merge_group_size is not None and merge_group_size < 2:
+                raise ValueError(
+                    f"merge_group_size should be at least 2, {merge_group_size}"
+                )
+            config["merge_group_size"] = merge_group_size
+            config["resource_model"] = ResourceModel()
         except KeyError as e:
             raise KeyError(f"config missing field {e}")
 
         return ToilMethylseqConfig(**config)
 
 
-def root_alignment_job(job, config: ToilMethylseqConfig):
-    # read sharding
-    fastq_shards = job.addChildJobFn(
-        shard_input_fastq,
-        reads=config.paired_reads,
+def add_sample_jobs(
+    job,
+    *,
+    reads: PairedEndReads,
+    config: ToilMethylseqConfig,
+    exporter: OutputExporter,
+    result_cache: Optional[StageResultCache],
+    profile_store: ResourceProfileStore,
+) -> Job:
+    """
+    Shard and align one sample, and call it too unless samples are pooled.
+    Each stage follows on from the sample's own previous one, so a sample's
+    shards start aligning as soon as it has been split, whatever the rest of
+    the cohort is doing. Returns the sample's alignment job.
+    """
+    sharding = add_sharding_job(
+        job,
+        paired_end_reads=reads,
         utils_image=config.utils_image,
         bins=config.bins,
-    ).rv()
-
-    alignments: List[dict] = job.addFollowOnJobFn(
+        transfer=config.transfer,
+        stream=config.stream_sharding,
+        target_shard_bytes=config.target_shard_bytes,
+        resource_model=config.resource_model,
+        profile_store=profile_store,
+        compression=config.shard_compression,
+        result_cache=result_cache,
+    )
+    alignment = sharding.addFollowOnJobFn(
         alignment_root_job,
-        shards=fastq_shards,
+        shards=sharding.rv(),
         apps_image=config.apps_image,
         utils_image=config.utils_image,
         bismark_index_url=config.bismark_index_url,
         bismark_genome_uri=config.bismark_genome_uri,
         s3_location=config.s3_output,
-    ).rv()
-
-    return alignments
+        genome_cache=config.genome_cache,
+        transfer=config.transfer,
+        stream=config.stream_alignment,
+        region_bp=config.region_bp,
+        contigs=config.contigs,
+        resource_model=config.resource_model,
+        profile_store=profile_store,
+        exporter=exporter,
+        result_cache=result_cache,
+        merge_group_size=config.merge_group_size,
+        calling_region_bp=config.calling_region_bp,
+    )
+    if not config.pool_samples:
+        alignment.addFollowOnJobFn(
+            run_methylation_calling,
+            alignments=[alignment.rv()],
+            config=config,
+            exporter=exporter,
+            result_cache=result_cache,
+        )
+    return alignment
 
 
-def run_methylation_calling(job, alignments: List[dict], config: ToilMethylseqConfig):
+def run_methylation_calling(
+    job,
+    alignments: List[List[ShardAlignments]],
+    config: ToilMethylseqConfig,
+    exporter: OutputExporter,
+    result_cache: Optional[StageResultCache],
+):
     job.addChildJobFn(
         methylation_calling_root_job,
         apps_image=config.apps_image,
-        chrom_file_ids=alignments,
+        utils_image=config.utils_image,
+        calling_engine=config.calling_engine,
+        shard_alignments=list(itertools.chain(*alignments)),
         s3_output=config.s3_output,
+        pool_samples=config.pool_samples,
+        partitioned=config.region_bp is not None,
+        calling_region_bp=config.calling_region_bp,
+        resource_model=config.resource_model,
+        profile_store=ResourceProfileStore.for_output(config.s3_output),
+        exporter=exporter,
+        result_cache=result_cache,
     )
     return "OK"
 
@@ -80,13 +181,52 @@ def run_methylseq(job: Job, config: ToilMethylseqConfig):
     #     reads=config.paired_reads,
     #     s3_output=config.s3_output,
     #     apps_image=config.apps_image,
+    #     transfer=config.transfer,
     #     name="fastqc_root_job",
     # ).rv()
 
-    alignments = job.addChildJobFn(root_alignment_job, config=config).rv()
+    # image digests are resolved once, on a worker with docker
+    result_cache = StageResultCache.resolve(
+        config.result_cache,
+        s3_output=config.s3_output,
+        images=[config.apps_image, config.utils_image],
+    )
+    exporter = OutputExporter(
+        settings=config.exports,
+        transfer=config.transfer,
+        resource_model=config.resource_model,
+    )
+    profile_store = ResourceProfileStore.for_output(config.s3_output)
+    # one concurrent round of HEAD requests for the cohort, each sample's
+    # sharding job is then sized from the probe cache
+    probe_objects(
+        [
+            (uri, reads.storage)
+            for reads in config.paired_reads
+            for uri in (reads.uri_1, reads.uri_2)
+        ]
+    )
+    alignments = [
+        add_sample_jobs(
+            job,
+            reads=reads,
+            config=config,
+            exporter=exporter,
+            result_cache=result_cache,
+            profile_store=profile_store,
+        ).rv()
+        for reads in config.paired_reads
+    ]
+    if not config.pool_samples:
+        return "OK"
 
+    # pooled calling needs every sample's alignments
     methylation_calling = job.addFollowOnJobFn(
-        run_methylation_calling, alignments=alignments, config=config
+        run_methylation_calling,
+        alignments=alignments,
+        config=config,
+        exporter=exporter,
+        result_cache=result_cache,
     ).rv()
 
     return methylation_calling
@@ -97,10 +237,23 @@ def main():
     parser.add_argument(
         "--config", required=True, action="store", help="run configuration"
     )
+    parser.add_argument(
+        "--resource-profile",
+        required=False,
+        action="store",
+        default=None,
+        help="s3 url of the resource_profile of previous runs, fits resource "
+        "requests to the usage recorded there",
+    )
     Job.Runner.addToilOptions(parser)
     options = parser.parse_args()
 
     toil_config = parse_config(options.config)
+    if options.resource_profile is not None:
+        history = ResourceProfileStore(url=options.resource_profile).load()
+        toil_config.resource_model = fit_resource_model(
+            history, toil_config.resource_model
+        )
     with Toil(options) as workflow:
         if not workflow.options.restart:
             root_job = Job.wrapJobFn(run_methylseq, config=toil_config)
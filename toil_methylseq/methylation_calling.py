@@ -1,48 +1,168 @@
+import gzip
+import heapq
 import os
 from collections import defaultdict
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 from toil.fileStores import FileID
-from toil.lib.docker import apiDockerCall
 
-from domain import S3OutputLocation
+from domain import (
+    CallingEngine,
+    ExportKind,
+    GenomicRegion,
+    PackedBam,
+    ParallelismPolicy,
+    ResourceModel,
+    S3OutputLocation,
+    ShardAlignments,
+    Stage,
+)
+from exports import OutputExporter, OutputManifest
+from file_store import read_input
+from packing import read_packed_bams
+from profiling import ResourceProfileStore, StageProfiler
+from result_cache import StageResultCache
 
+# name of the one "sample" calls are made for when samples are pooled
+POOLED_SAMPLE = "pooled"
 
-def run_methylation_extractor(
-    job, *, chrom: str, apps_image: str, temp_dir: str, s3_output: S3OutputLocation
-) -> dict:
-    chrom_bam = f"{chrom}.bam"
-    _samtools_cat_output = apiDockerCall(
-        job,
+# read 2 bases left out of the calls at its 5' and 3' ends, by either engine
+IGNORE_R2 = 2
+IGNORE_3PRIME_R2 = 2
+
+
+def merge_region_alignments(
+    *,
+    region: str,
+    inputs: List[str],
+    apps_image: str,
+    temp_dir: str,
+    profiler: StageProfiler,
+    parallelism: ParallelismPolicy,
+    input_bytes: int,
+) -> str:
+    """
+    Merge the region's read name sorted per-shard alignments, `inputs` in the
+    temp dir, into `{region}.bam`. Mates of a pair stay next to each other, as
+    deduplicate_bismark and the extractor need, without sorting again.
+    """
+    region_bam = f"{region}.bam"
+    _samtools_merge_output = profiler.docker_call(
+        stage=Stage.MERGE,
+        work_dir=temp_dir,
+        input_bytes=input_bytes,
+        threads=parallelism.cores,
         user="root",
         image=apps_image,
         volumes={temp_dir: {"bind": "/io", "mode": "rw"}},
         parameters=[
             "samtools",
-            "cat",
-            "/io/*.bam",
-            "-o" f"/io/{chrom_bam}",
+            "merge",
+            "-n",
+            "-@",
+            str(parallelism.cores),
+            f"/io/{region_bam}",
+            *[f"/io/{i}" for i in inputs],
         ],
     )
-    merged_bam_path = os.path.join(temp_dir, chrom_bam)
+    merged_bam_path = os.path.join(temp_dir, region_bam)
     assert os.path.exists(merged_bam_path), f"missing merged bam {os.listdir(temp_dir)}"
+    return merged_bam_path
+
 
-    chrom_bam_file_id = job.fileStore.writeGlobalFile(merged_bam_path)
-    job.fileStore.exportFile(
-        chrom_bam_file_id, s3_output.to_url(f"{chrom}_methylation_input.bam")
+def deduplication_report_name(region: str) -> str:
+    return f"{region}.deduplication_report.txt"
+
+
+def methylation_input_name(region: str) -> str:
+    return f"{region}_methylation_input.bam"
+
+
+def deduplicate_region_alignment(
+    job,
+    *,
+    region: str,
+    apps_image: str,
+    temp_dir: str,
+    outputs: OutputManifest,
+    profiler: StageProfiler,
+) -> Dict[str, FileID]:
+    """
+    Remove PCR duplicates from the region's merged alignment, replacing
+    `{region}.bam` with the deduplicated one, which is registered for export
+    with its report. Reads are sharded by name, so duplicates of a fragment
+    are only all in one place once the shards have been merged. Every pair
+    maps to a single chromosome, and bam-sort places pairs in windows by where
+    their fragment starts, which duplicates share.
+    """
+    region_bam = f"{region}.bam"
+    merged_bam_path = os.path.join(temp_dir, region_bam)
+    _deduplicate_output = profiler.docker_call(
+        stage=Stage.DEDUP,
+        work_dir=temp_dir,
+        input_bytes=os.path.getsize(merged_bam_path),
+        user="root",
+        image=apps_image,
+        volumes={temp_dir: {"bind": "/io", "mode": "rw"}},
+        parameters=[
+            "deduplicate_bismark",
+            "-p",
+            f"/io/{region_bam}",
+            "--output_dir",
+            "/io/",
+        ],
+    )
+    deduplicated_bam_path = os.path.join(temp_dir, f"{region}.deduplicated.bam")
+    deduplication_report_path = os.path.join(
+        temp_dir, f"{region}.deduplication_report.txt"
     )
+    assert os.path.exists(
+        deduplicated_bam_path
+    ), f"missing deduped alignment {os.listdir(temp_dir)}"
+    assert os.path.exists(
+        deduplication_report_path
+    ), f"missing deduped alignment report {os.listdir(temp_dir)}"
 
-    _bismark_methylation_calling_output = apiDockerCall(
-        job,
+    # the extractor names its outputs after its input
+    os.replace(deduplicated_bam_path, merged_bam_path)
+    report_name = deduplication_report_name(region)
+    input_name = methylation_input_name(region)
+    exports = {
+        report_name: job.fileStore.writeGlobalFile(deduplication_report_path),
+        input_name: job.fileStore.writeGlobalFile(merged_bam_path),
+    }
+    outputs.register(ExportKind.REPORT, report_name, exports[report_name])
+    outputs.register(ExportKind.METHYLATION_INPUT, input_name, exports[input_name])
+    return exports
+
+
+def run_methylation_extractor(
+    job,
+    *,
+    region: str,
+    apps_image: str,
+    temp_dir: str,
+    profiler: StageProfiler,
+    parallelism: ParallelismPolicy,
+) -> dict:
+    region_bam = f"{region}.bam"
+    merged_bam_path = os.path.join(temp_dir, region_bam)
+
+    _bismark_methylation_calling_output = profiler.docker_call(
+        stage=Stage.EXTRACT,
+        work_dir=temp_dir,
+        input_bytes=os.path.getsize(merged_bam_path),
+        threads=parallelism.cores,
         user="root",
         image=apps_image,
         volumes={temp_dir: {"bind": "/io", "mode": "rw"}},
         parameters=[
             "bismark_methylation_extractor",
+            *parallelism.extractor_parameters(),
             "--ignore_r2",
-            "2",
+            str(IGNORE_R2),
             "--ignore_3prime_r2",
-            "2",
+            str(IGNORE_3PRIME_R2),
             "--bedGraph",
             "--gzip",
             "-p",
@@ -52,12 +172,50 @@ def run_methylation_extractor(
             "--o",
             "/io",
             "--report",
-            f"/io/{chrom_bam}",
+            f"/io/{region_bam}",
         ],
     )
+    return _write_calls(job, region=region, temp_dir=temp_dir)
 
-    bed_graph_filename = f"{chrom}.bedGraph.gz"
-    bismark_cov_filename = f"{chrom}.bismark.cov.gz"
+
+def run_native_methylation_caller(
+    job,
+    *,
+    region: str,
+    utils_image: str,
+    temp_dir: str,
+    profiler: StageProfiler,
+) -> dict:
+    """
+    Count the CpG calls of `{region}.bam`'s XM tags with `tmu call-methylation`
+    into the same coverage and bedGraph files as the extractor, without its
+    per-context intermediates.
+    """
+    region_bam = f"{region}.bam"
+    _call_methylation_output = profiler.docker_call(
+        stage=Stage.CALL,
+        work_dir=temp_dir,
+        input_bytes=os.path.getsize(os.path.join(temp_dir, region_bam)),
+        user="root",
+        image=utils_image,
+        volumes={temp_dir: {"bind": "/io", "mode": "rw"}},
+        parameters=[
+            "call-methylation",
+            "-i",
+            f"/io/{region_bam}",
+            "--ignore_r2",
+            str(IGNORE_R2),
+            "--ignore_3prime_r2",
+            str(IGNORE_3PRIME_R2),
+            "--no_overlap",
+        ],
+    )
+    return _write_calls(job, region=region, temp_dir=temp_dir)
+
+
+def _write_calls(job, *, region: str, temp_dir: str) -> dict:
+    bed_graph_filename = f"{region}.bedGraph.gz"
+    bismark_cov_filename = f"{region}.bismark.cov.gz"
     bed_graph_path = os.path.join(temp_dir, bed_graph_filename)
     bismark_cov_path = os.path.join(temp_dir, bismark_cov_filename)
     assert os.path.exists(bed_graph_path), f"missing bedGraph {os.listdir(temp_dir)}"
@@ -75,47 +233,375 @@ def run_methylation_extractor(
 
 def call_methylation(
     job,
-    chrom: str,
-    file_ids: List[FileID],
+    region: str,
+    file_ids: List[PackedBam],
     apps_image: str,
+    utils_image: str,
+    calling_engine: CallingEngine,
     s3_output: S3OutputLocation,
+    profile_store: ResourceProfileStore,
+    exporter: OutputExporter,
+    export_calls: bool = True,
+    result_cache: Optional[StageResultCache] = None,
+    result_key: Optional[str] = None,
+) -> dict:
+    """
+    Merge, deduplicate and call methylation with `calling_engine` on the
+    shards' alignments of one chromosome or group of windows, returning the
+    calls' file ids by name. Calls are exported unless they are to be
+    stitched together first.
+    """
+    temp_dir = job.fileStore.getLocalTempDir()
+    profiler = StageProfiler(job, profile_store)
+    outputs = exporter.manifest(s3_output)
+    parallelism = ParallelismPolicy.for_job(job)
+    inputs = [f"{i}_{region}.bam" for i in range(len(file_ids))]
+    # the shards pack by calling partition, so each of their objects is read
+    # whole, once
+    read_packed_bams(
+        job,
+        [(f, os.path.join(temp_dir, bam)) for f, bam in zip(file_ids, inputs)],
+    )
+
+    merge_region_alignments(
+        apps_image=apps_image,
+        region=region,
+        inputs=inputs,
+        temp_dir=temp_dir,
+        profiler=profiler,
+        parallelism=parallelism,
+        input_bytes=sum(packed_bam.size for packed_bam in file_ids),
+    )
+    for bam in inputs:
+        os.remove(os.path.join(temp_dir, bam))
+    exports = deduplicate_region_alignment(
+        job,
+        apps_image=apps_image,
+        region=region,
+        temp_dir=temp_dir,
+        outputs=outputs,
+        profiler=profiler,
+    )
+    if calling_engine == CallingEngine.NATIVE:
+        bismark_reslts = run_native_methylation_caller(
+            job,
+            utils_image=utils_image,
+            region=region,
+            temp_dir=temp_dir,
+            profiler=profiler,
+        )
+    else:
+        bismark_reslts = run_methylation_extractor(
+            job,
+            apps_image=apps_image,
+            region=region,
+            temp_dir=temp_dir,
+            profiler=profiler,
+            parallelism=parallelism,
+        )
+    profiler.flush()
+    if export_calls:
+        outputs.register_all(ExportKind.CALLS, bismark_reslts)
+    outputs.schedule(job, name=f"{region}_methylation_calling")
+    if result_cache is not None:
+        result_cache.schedule_store(job, result_key, {**exports, **bismark_reslts})
+    return bismark_reslts
+
+
+def restore_region_calls(
+    job,
+    *,
+    region: str,
+    result_cache: StageResultCache,
+    result_key: str,
+    s3_output: S3OutputLocation,
+    exporter: OutputExporter,
+    export_calls: bool = True,
+) -> dict:
+    """
+    The calls of an earlier run's calling of the same alignments, exported
+    along with the deduplicated alignment and its report like call_methylation
+    does.
+    """
+    calls = result_cache.restore(job, result_key)
+    outputs = exporter.manifest(s3_output)
+    report_name = deduplication_report_name(region)
+    input_name = methylation_input_name(region)
+    outputs.register(ExportKind.REPORT, report_name, calls.pop(report_name))
+    outputs.register(ExportKind.METHYLATION_INPUT, input_name, calls.pop(input_name))
+    if export_calls:
+        outputs.register_all(ExportKind.CALLS, calls)
+    outputs.schedule(job, name=f"{region}_methylation_calling")
+    return calls
+
+
+def merge_coverage(paths: List[str]) -> Iterator[Tuple[str, int, int, int]]:
+    """
+    Merge position sorted, gzipped bismark coverage files of one chromosome
+    into (chrom, position, methylated, unmethylated) records. A pair that
+    crosses a window boundary is called with the window it starts in, so a
+    position can be in more than one file; its counts are summed.
+    """
+
+    def records(path: str):
+        with gzip.open(path, "rt") as fh:
+            for line in fh:
+                chrom, start, _end, _pct, meth, unmeth = line.rstrip("\n").split("\t")
+                yield int(start), chrom, int(meth), int(unmeth)
+
+    current = None
+    for position, chrom, meth, unmeth in heapq.merge(*[records(p) for p in paths]):
+        if current is not None and current[1] == position:
+            current = (chrom, position, current[2] + meth, current[3] + unmeth)
+            continue
+        if current is not None:
+            yield current
+        current = (chrom, position, meth, unmeth)
+    if current is not None:
+        yield current
+
+
+def write_coverage(
+    records: Iterator[Tuple[str, int, int, int]], *, cov_path: str, bed_graph_path: str
+):
+    """
+    Write records as bismark2bedGraph does, a coverage file with 1-based
+    positions and a bedGraph with 0-based starts.
+    """
+    with gzip.open(cov_path, "wt") as cov, gzip.open(bed_graph_path, "wt") as bed:
+        bed.write("track type=bedGraph\n")
+        for chrom, position, meth, unmeth in records:
+            pct = f"{100 * meth / (meth + unmeth):.15g}"
+            cov.write(f"{chrom}\t{position}\t{position}\t{pct}\t{meth}\t{unmeth}\n")
+            bed.write(f"{chrom}\t{position - 1}\t{position}\t{pct}\n")
+
+
+def stitch_chrom_calls(
+    job,
+    *,
+    chrom: str,
+    region_calls: List[Tuple[GenomicRegion, dict]],
+    s3_output: S3OutputLocation,
+    exporter: OutputExporter,
 ):
+    """
+    Stitch the calls of a chromosome's windows into the files calling it whole
+    would have made, and export them.
+    """
     temp_dir = job.fileStore.getLocalTempDir()
-    for i, file_id in enumerate(file_ids):
-        file_id_path = os.path.join(temp_dir, f"{i}_{chrom}.bam")
-        job.fileStore.readGlobalFile(file_id, file_id_path)
-        assert os.path.exists(file_id_path)
+    cov_paths = []
+    for region, calls in region_calls:
+        cov_file_id = calls[f"{region.label}.bismark.cov.gz"]
+        cov_paths.append(
+            read_input(
+                job,
+                cov_file_id,
+                os.path.join(temp_dir, f"{region.label}.bismark.cov.gz"),
+            )
+        )
 
-    bismark_reslts = run_methylation_extractor(
-        job, apps_image=apps_image, chrom=chrom, temp_dir=temp_dir, s3_output=s3_output
+    bed_graph_filename = f"{chrom}.bedGraph.gz"
+    bismark_cov_filename = f"{chrom}.bismark.cov.gz"
+    bed_graph_path = os.path.join(temp_dir, bed_graph_filename)
+    bismark_cov_path = os.path.join(temp_dir, bismark_cov_filename)
+    write_coverage(
+        merge_coverage(cov_paths),
+        cov_path=bismark_cov_path,
+        bed_graph_path=bed_graph_path,
     )
-    for filename, file_id in bismark_reslts.items():
-        job.fileStore.exportFile(file_id, s3_output.to_url(filename))
+    outputs = exporter.manifest(s3_output)
+    for filename, path in (
+        (bed_graph_filename, bed_graph_path),
+        (bismark_cov_filename, bismark_cov_path),
+    ):
+        outputs.register(
+            ExportKind.CALLS, filename, job.fileStore.writeGlobalFile(path)
+        )
+    outputs.schedule(job, name=f"{chrom}_stitch_calls")
     return "ok"
 
 
-def methylation_calling_root_job(
-    job, *, apps_image: str, chrom_file_ids: List[dict], s3_output: S3OutputLocation
+def partition_regions(
+    windows: Iterable[GenomicRegion], *, partition_bp: int
+) -> Dict[GenomicRegion, List[GenomicRegion]]:
+    """
+    Group each chromosome's windows into the calling partitions of
+    `partition_bp` bases the shards packed them by, so large chromosomes are
+    called in parallel pieces and none sets the makespan. Returns each
+    region's windows, keyed by the region they span.
+    """
+    partitions = defaultdict(list)
+    for window in sorted(windows, key=lambda r: (r.chrom, r.start)):
+        partitions[window.partition(partition_bp)].append(window)
+    return {GenomicRegion.spanning(group): group for group in partitions.values()}
+
+
+def call_sample_methylation(
+    job,
+    *,
+    sample: str,
+    apps_image: str,
+    utils_image: str,
+    calling_engine: CallingEngine,
+    chrom_file_ids: Dict[str, List[PackedBam]],
+    s3_output: S3OutputLocation,
+    partitioned: bool,
+    calling_region_bp: int,
+    resource_model: ResourceModel,
+    profile_store: ResourceProfileStore,
+    exporter: OutputExporter,
+    result_cache: Optional[StageResultCache] = None,
 ):
-    chrom_to_file_ids = defaultdict(list)
-    for mapping in chrom_file_ids:
-        for chrom, file_id in mapping.items():
-            chrom_to_file_ids[chrom].append(file_id)
+    """
+    `chrom_file_ids` are a sample's per-shard alignments by chromosome, or
+    misc bucket of small contigs, or when `partitioned` by window. Windows are
+    grouped into regions of `calling_region_bp` bases, called separately and
+    stitched back together per chromosome.
+    """
+    chrom_to_file_ids = dict(chrom_file_ids)
+    calling = dict()
+    windows = dict()
+    for key in list(chrom_to_file_ids):
+        try:
+            window = GenomicRegion.parse(key) if partitioned else None
+        except ValueError:
+            window = None
+        if window is None:
+            calling[key] = [key]
+        else:
+            windows[window] = chrom_to_file_ids.pop(key)
+    chrom_to_file_ids.update(windows)
+    calling.update(partition_regions(windows, partition_bp=calling_region_bp))
+
+    result_keys = dict()
+    if result_cache is not None:
+        for region, keys in calling.items():
+            input_keys = [f.cache_key for key in keys for f in chrom_to_file_ids[key]]
+            if None not in input_keys:
+                label = region.label if isinstance(region, GenomicRegion) else region
+                result_keys[region] = result_cache.key(
+                    Stage.CALL,
+                    [
+                        label,
+                        calling_engine.value,
+                        str(IGNORE_R2),
+                        str(IGNORE_3PRIME_R2),
+                        *sorted(input_keys),
+                    ],
+                )
+    cached = result_cache.contains(list(result_keys.values())) if result_keys else {}
 
     results = []
-    for chrom, file_ids in chrom_to_file_ids.items():
+    region_calls = defaultdict(list)
+    for region, keys in calling.items():
+        file_ids = [f for key in keys for f in chrom_to_file_ids[key]]
+        stitched = isinstance(region, GenomicRegion)
+        label = region.label if stitched else region
+        result_key = result_keys.get(region)
+        if cached.get(result_key, False):
+            job.log(f"reusing {sample}_{label} calls from the result cache")
+            calls = job.addChildJobFn(
+                restore_region_calls,
+                name=f"{sample}_{label}_methylation_calling",
+                region=label,
+                result_cache=result_cache,
+                result_key=result_key,
+                s3_output=s3_output,
+                exporter=exporter,
+                export_calls=not stitched,
+            )
+            results.append(calls)
+            if stitched:
+                region_calls[region.chrom].append((region, calls.rv(), file_ids))
+            continue
+        resources = resource_model.calling_job(
+            alignment_bytes=sum(file_id.size for file_id in file_ids),
+            engine=calling_engine,
+        )
+        job.log(f"{sample}_{label}_methylation_calling requests {resources}")
+        calls = job.addChildJobFn(
+            call_methylation,
+            name=f"{sample}_{label}_methylation_calling",
+            region=label,
+            file_ids=file_ids,
+            apps_image=apps_image,
+            utils_image=utils_image,
+            calling_engine=calling_engine,
+            s3_output=s3_output,
+            profile_store=profile_store,
+            exporter=exporter,
+            export_calls=not stitched,
+            result_cache=result_cache if result_key is not None else None,
+            result_key=result_key,
+            **resources.to_job_kwargs(),
+        )
+        results.append(calls)
+        if stitched:
+            region_calls[region.chrom].append((region, calls.rv(), file_ids))
+
+    for chrom, calls in region_calls.items():
+        resources = resource_model.stitch_job(
+            alignment_bytes=sum(f.size for _, _, file_ids in calls for f in file_ids)
+        )
         results.append(
-            job.addChildJobFn(
-                call_methylation,
-                name=f"{chrom}_methylation_calling",
+            job.addFollowOnJobFn(
+                stitch_chrom_calls,
+                name=f"{sample}_{chrom}_stitch_calls",
                 chrom=chrom,
-                file_ids=file_ids,
-                apps_image=apps_image,
+                region_calls=[(region, rv) for region, rv, _ in calls],
                 s3_output=s3_output,
-                disk="40G",
-                memory="40G",
-                cores=4,
+                exporter=exporter,
+                **resources.to_job_kwargs(),
             )
         )
 
     return [r.rv() for r in results]
+
+
+def methylation_calling_root_job(
+    job,
+    *,
+    apps_image: str,
+    utils_image: str,
+    calling_engine: CallingEngine,
+    shard_alignments: List[ShardAlignments],
+    s3_output: S3OutputLocation,
+    pool_samples: bool,
+    partitioned: bool,
+    calling_region_bp: int,
+    resource_model: ResourceModel,
+    profile_store: ResourceProfileStore,
+    exporter: OutputExporter,
+    result_cache: Optional[StageResultCache] = None,
+):
+    """
+    Call every sample separately, each under its own output prefix, or with
+    `pool_samples` all of them together.
+    """
+    samples = defaultdict(lambda: defaultdict(list))
+    for shard in shard_alignments:
+        sample = POOLED_SAMPLE if pool_samples else shard.sample
+        for chrom, packed_bam in shard.alignments.items():
+            samples[sample][chrom].append(packed_bam)
+
+    results = []
+    for sample, chrom_file_ids in samples.items():
+        results.append(
+            job.addChildJobFn(
+                call_sample_methylation,
+                name=f"{sample}_methylation_calling",
+                sample=sample,
+                apps_image=apps_image,
+                utils_image=utils_image,
+                calling_engine=calling_engine,
+                chrom_file_ids=dict(chrom_file_ids),
+                s3_output=s3_output if pool_samples else s3_output.for_sample(sample),
+                partitioned=partitioned,
+                calling_region_bp=calling_region_bp,
+                resource_model=resource_model,
+                profile_store=profile_store,
+                exporter=exporter,
+                result_cache=result_cache,
+            )
+        )
+    return [r.rv() for r in results]
@@ -0,0 +1,91 @@
+import os
+import shutil
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from domain import GenomicRegion, PackedBam
+
+COPY_BUFFER = 1024 * 1024
+
+
+def pack_files(paths: List[str], packed_path: str) -> List[Tuple[int, int]]:
+    """
+    Concatenate `paths` into `packed_path`, deleting each once it is copied so
+    packing takes no more disk than its largest member, and return their
+    (offset, length) byte ranges in it.
+    """
+    ranges = []
+    offset = 0
+    with open(packed_path, "wb") as packed:
+        for path in paths:
+            with open(path, "rb") as member:
+                shutil.copyfileobj(member, packed, COPY_BUFFER)
+            length = os.path.getsize(path)
+            ranges.append((offset, length))
+            offset += length
+            os.remove(path)
+    return ranges
+
+
+def calling_partition(region: str, partition_bp: int) -> str:
+    """
+    The calling partition a region's alignments are packed and called with,
+    the `partition_bp` span its window starts in. Whole chromosomes and misc
+    buckets are partitions of their own.
+    """
+    try:
+        window = GenomicRegion.parse(region)
+    except ValueError:
+        return region
+    partition = window.partition(partition_bp)
+    return f"{partition.chrom}:{partition.start}-{partition.end}"
+
+
+def pack_bams(
+    job, bam_paths: Dict[str, str], temp_dir: str, *, partition_bp: int
+) -> Dict[str, PackedBam]:
+    """
+    Pack the regions' BAMs into one file store object per calling partition,
+    rather than one per region, so a calling job reads whole objects.
+    """
+    partitions = defaultdict(list)
+    for region in sorted(bam_paths):
+        partitions[calling_partition(region, partition_bp)].append(region)
+    packed = dict()
+    for i, (_, regions) in enumerate(sorted(partitions.items())):
+        packed_path = os.path.join(temp_dir, f"{i}.packed")
+        ranges = pack_files([bam_paths[region] for region in regions], packed_path)
+        packed_fid = job.fileStore.writeGlobalFile(packed_path)
+        # the file store keeps its own copy until the job's outputs are committed
+        job.fileStore.deleteLocalFile(packed_fid)
+        for region, byte_range in zip(regions, ranges):
+            packed[region] = PackedBam(packed_fid=packed_fid, byte_range=byte_range)
+    return packed
+
+
+def read_packed_bams(job, members: List[Tuple[PackedBam, str]]) -> List[str]:
+    """
+    Copy each of `members`, (PackedBam, path) pairs, to its path, reading
+    every packed file they are in once, front to back.
+    """
+    by_packed_fid = defaultdict(list)
+    for packed_bam, path in members:
+        by_packed_fid[packed_bam.packed_fid].append((packed_bam.byte_range, path))
+    for packed_fid, ranges in by_packed_fid.items():
+        position = 0
+        with job.fileStore.readGlobalFileStream(packed_fid) as stream:
+            for (offset, length), path in sorted(ranges):
+                assert offset >= position, f"{packed_fid} members overlap"
+                while position < offset:
+                    skipped = len(stream.read(min(offset - position, COPY_BUFFER)))
+                    assert skipped > 0, f"{packed_fid} ends before {offset}"
+                    position += skipped
+                with open(path, "wb") as out:
+                    remaining = length
+                    while remaining > 0:
+                        chunk = stream.read(min(remaining, COPY_BUFFER))
+                        assert chunk, f"{packed_fid} ends within {offset}, {length}"
+                        out.write(chunk)
+                        remaining -= len(chunk)
+                position += length
+    return [path for _, path in members]
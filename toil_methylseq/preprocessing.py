@@ -1,79 +1,180 @@
 import json
-import itertools
+import math
 import os
-import boto3
-from typing import List
+from contextlib import contextmanager, ExitStack
+from typing import Iterator, List, Optional
+
+
+from aws_utils import (
+    download_to_location,
+    estimate_resource_requirements,
+    get_content_length,
+    parse_s3_url_key_bucket_filename,
+    probe_objects,
+)
+from domain import (
+    PairedEndReads,
+    PairedEndReadShard,
+    ArtifactResourceRequirements,
+    ResourceModel,
+    ShardCompressionSettings,
+    Stage,
+    TransferSettings,
+)
+from genome_cache import cache_key
+from profiling import ResourceProfileStore, StageProfiler
+from result_cache import StageResultCache
+from transfer import S3TransferEngine
+
+MAX_BINS = 256
+
+
+@contextmanager
+def _staged_reads(
+    *, uris: List[str], temp_dir: str, transfer: TransferSettings, stream: bool
+) -> Iterator[List[str]]:
+    """
+    Yield the filenames, relative to `temp_dir`, the reads at `uris` can be read
+    from. When streaming these are named pipes fed from S3 while the body of the
+    `with` block runs, so only the output shards touch the disk.
+    """
+    if not stream:
+        yield [
+            download_to_location(s3_url=uri, temp_dir=temp_dir, transfer=transfer)[1]
+            for uri in uris
+        ]
+        return
+
+    engine = S3TransferEngine(transfer)
+    with ExitStack() as stack:
+        filenames = []
+        for uri in uris:
+            bucket, key, filename = parse_s3_url_key_bucket_filename(uri)
+            stack.enter_context(
+                engine.stream_to_fifo(
+                    bucket=bucket, key=key, fifo_path=os.path.join(temp_dir, filename)
+                )
+            )
+            filenames.append(filename)
+        yield filenames
 
-from toil.fileStores import FileID
-from toil.lib.docker import apiDockerCall
 
-from aws_utils import download_to_location, estimate_resource_requirements
-from domain import PairedEndReads, PairedEndReadShard, ArtifactResourceRequirements
-
-
-def _run_sharding(job, *, uri: str, utils_image: str, bins: int) -> List[FileID]:
+def shard_reads(
+    job,
+    paired_end_reads: PairedEndReads,
+    utils_image: str,
+    bins: int,
+    transfer: TransferSettings,
+    stream: bool,
+    reads_bytes: int,
+    profile_store: ResourceProfileStore,
+    compression: ShardCompressionSettings,
+    result_cache: Optional[StageResultCache] = None,
+    result_key: Optional[str] = None,
+) -> List[PairedEndReadShard]:
     temp_dir = job.fileStore.getLocalTempDir()
-    _, reads_filename = download_to_location(s3_url=uri, temp_dir=temp_dir)
-    sharding_output = apiDockerCall(
-        job,
-        user="root",
-        image=utils_image,
-        volumes={temp_dir: {"bind": "/io", "mode": "rw"}},
-        parameters=["fastq-split", "-i", f"/io/{reads_filename}", "-b", str(bins)],
-    )
-    sharding_output = json.loads(sharding_output)
-    output_files = list(sharding_output.values())
-    assert len(output_files) == 1
-    output_files = output_files[0]
-    file_ids = [
-        job.fileStore.writeGlobalFile(os.path.join(temp_dir, shard))
-        for shard in output_files
+    profiler = StageProfiler(job, profile_store)
+    uris = [paired_end_reads.uri_1, paired_end_reads.uri_2]
+    with _staged_reads(
+        uris=uris, temp_dir=temp_dir, transfer=transfer, stream=stream
+    ) as (mate_1_filename, mate_2_filename):
+        # both mates are split in one pass, fastq-split-paired fails if the
+        # read names of the mates ever disagree
+        sharding_output = profiler.docker_call(
+            stage=Stage.SHARDING,
+            work_dir=temp_dir,
+            input_bytes=reads_bytes,
+            threads=compression.threads,
+            user="root",
+            image=utils_image,
+            volumes={temp_dir: {"bind": "/io", "mode": "rw"}},
+            parameters=[
+                "fastq-split-paired",
+                "-1",
+                f"/io/{mate_1_filename}",
+                "-2",
+                f"/io/{mate_2_filename}",
+                "-b",
+                str(bins),
+                *compression.fastq_split_parameters(),
+            ],
+        )
+    profiler.flush()
+    shard_pairs = json.loads(sharding_output)
+    assert len(shard_pairs) == bins, f"expected {bins} shards, got {shard_pairs}"
+    shards = [
+        PairedEndReadShard(
+            mate1_fid=job.fileStore.writeGlobalFile(os.path.join(temp_dir, mate_1)),
+            mate2_fid=job.fileStore.writeGlobalFile(os.path.join(temp_dir, mate_2)),
+            name=paired_end_reads.name,
+            cache_key=_shard_key(result_key, i),
+            compressed=compression.enabled,
+        )
+        for i, (mate_1, mate_2) in enumerate(shard_pairs)
     ]
-    return file_ids
+    if result_cache is not None:
+        suffix = _shard_suffix(compression.enabled)
+        files = dict()
+        for i, shard in enumerate(shards):
+            files[f"{i}_1{suffix}"] = shard.mate1_fid
+            files[f"{i}_2{suffix}"] = shard.mate2_fid
+        result_cache.schedule_store(job, result_key, files)
+    return shards
+
+
+def _shard_key(result_key: Optional[str], shard_idx: int) -> Optional[str]:
+    if result_key is None:
+        return None
+    return cache_key([result_key, str(shard_idx)])
+
 
+def _shard_suffix(compressed: bool) -> str:
+    return ".fq.gz" if compressed else ".fq"
 
-def coalesce_shards(
-    mate1_shards: List[FileID], mate2_shards: List[FileID], reads_name: str
+
+def restore_shards(
+    job,
+    *,
+    sample: str,
+    result_cache: StageResultCache,
+    result_key: str,
+    compressed: bool,
 ) -> List[PairedEndReadShard]:
-    assert len(mate1_shards) == len(mate2_shards)
+    """
+    The shards of an earlier run's sharding of the same reads.
+    """
+    files = result_cache.restore(job, result_key)
+    suffix = _shard_suffix(compressed)
     return [
-        PairedEndReadShard(mate1_fid=x, mate2_fid=y, name=reads_name)
-        for x, y in zip(mate1_shards, mate2_shards)
+        PairedEndReadShard(
+            mate1_fid=files[f"{i}_1{suffix}"],
+            mate2_fid=files[f"{i}_2{suffix}"],
+            name=sample,
+            cache_key=_shard_key(result_key, i),
+            compressed=compressed,
+        )
+        for i in range(len(files) // 2)
     ]
 
 
-def shard_reads(
-    job, paired_end_reads: PairedEndReads, utils_image: str, bins: int
-) -> List[PairedEndReadShard]:
-    mates_1_shards = job.addChildJobFn(
-        _run_sharding,
-        uri=paired_end_reads.uri_1,
-        utils_image=utils_image,
-        name=f"sharding_{paired_end_reads.uri_1}",
-        bins=bins,
-    )
-    mates_2_shards = job.addChildJobFn(
-        _run_sharding,
-        uri=paired_end_reads.uri_2,
-        utils_image=utils_image,
-        name=f"sharding_{paired_end_reads.uri_2}",
-        bins=bins,
+def get_reads_size(reads: PairedEndReads) -> int:
+    return get_content_length(reads.uri_1, reads.storage) + get_content_length(
+        reads.uri_2, reads.storage
     )
 
-    paired_end_shards = job.addFollowOnFn(
-        coalesce_shards,
-        mate1_shards=mates_1_shards.rv(),
-        mate2_shards=mates_2_shards.rv(),
-        reads_name=paired_end_reads.name,
-    ).rv()
 
-    return paired_end_shards
-
-
-def flatten_paired_end_shards(
-    shards: List[List[PairedEndReadShard]],
-) -> List[PairedEndReadShard]:
-    return list(itertools.chain(*shards))
+def shard_count(
+    reads_size: int, *, bins: int, target_shard_bytes: Optional[int] = None
+) -> int:
+    """
+    Number of shards to split a sample into. Without a target every sample gets
+    `bins` shards, with one the count scales with the (compressed) input size
+    so that shards take roughly the same time to align across a cohort.
+    """
+    if target_shard_bytes is None:
+        return bins
+    assert target_shard_bytes > 0, f"illegal target shard size {target_shard_bytes}"
+    return min(MAX_BINS, max(1, math.ceil(reads_size / target_shard_bytes)))
 
 
 def get_resource_requirements_for_reads(
@@ -84,22 +185,63 @@ def get_resource_requirements_for_reads(
     return uri1_res + uri2_res
 
 
-def shard_input_fastq(job, reads: List[PairedEndReads], utils_image: str, bins: int):
-    resource_requirements = [
-        get_resource_requirements_for_reads(paired_end_reads) * 2
-        for paired_end_reads in reads
-    ]
-    shards = [
-        job.addChildJobFn(
-            shard_reads,
-            paired_end_reads=pe,
-            utils_image=utils_image,
-            bins=bins,
-            disk=resource_requirements.disc.to_string(),
-            memory=resource_requirements.disc.to_string(),
-            name=f"sharding_{pe.name}",
-        )
-        for (resource_requirements, pe) in zip(resource_requirements, reads)
-    ]
-    shards = [r.rv() for r in shards]
-    return job.addFollowOnFn(flatten_paired_end_shards, shards=shards).rv()
+def add_sharding_job(
+    job,
+    *,
+    paired_end_reads: PairedEndReads,
+    utils_image: str,
+    bins: int,
+    transfer: TransferSettings,
+    stream: bool,
+    resource_model: ResourceModel,
+    profile_store: ResourceProfileStore,
+    compression: ShardCompressionSettings,
+    target_shard_bytes: Optional[int] = None,
+    result_cache: Optional[StageResultCache] = None,
+):
+    """
+    Add a child of `job` that shards one sample's reads, or restores its
+    shards from the result cache, and return it so the sample's next stage
+    can follow on from it alone.
+    """
+    pe = paired_end_reads
+    metadata = probe_objects([(pe.uri_1, pe.storage), (pe.uri_2, pe.storage)])
+    reads_size = get_reads_size(pe)
+    pe_bins = shard_count(reads_size, bins=bins, target_shard_bytes=target_shard_bytes)
+    result_key = None
+    if result_cache is not None:
+        parts = [metadata[pe.uri_1].etag, metadata[pe.uri_2].etag, str(pe_bins)]
+        if compression.enabled:
+            parts.append(f"gzip-{compression.level}")
+        result_key = result_cache.key(Stage.SHARDING, parts)
+        if result_cache.contains([result_key])[result_key]:
+            job.log(f"reusing the shards of {pe.name} from the result cache")
+            return job.addChildJobFn(
+                restore_shards,
+                name=f"sharding_{pe.name}",
+                sample=pe.name,
+                result_cache=result_cache,
+                result_key=result_key,
+                compressed=compression.enabled,
+            )
+    return job.addChildJobFn(
+        shard_reads,
+        paired_end_reads=pe,
+        utils_image=utils_image,
+        bins=pe_bins,
+        transfer=transfer,
+        stream=stream,
+        reads_bytes=reads_size,
+        profile_store=profile_store,
+        compression=compression,
+        result_cache=result_cache,
+        result_key=result_key,
+        name=f"sharding_{pe.name}",
+        **resource_model.sharding_job(
+            reads_bytes=reads_size,
+            staged=not stream,
+            compression=compression,
+            # one stream per mate
+            stream_buffer_bytes=2 * transfer.stream_buffer_bytes,
+        ).to_job_kwargs(),
+    )
@@ -0,0 +1,265 @@
+import dataclasses
+import json
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import List, Optional
+
+from docker.errors import APIError, ContainerError
+from toil.lib.docker import apiDockerCall
+
+from aws_utils import list_s3_objects, parse_prefix_and_bucket
+from domain import ResourceModel, S3OutputLocation, Stage, StageResourceModel
+from transfer import get_s3_client
+
+
+@dataclass
+class StageProfile:
+    """
+    What one run of a stage actually used. Disk figures are the job temp dir
+    usage, before the stage started, at its peak and once it finished.
+    """
+
+    stage: str
+    input_bytes: int
+    reference_bytes: int
+    threads: int
+    peak_memory: int
+    start_disk: int
+    peak_disk: int
+    end_disk: int
+    wall_seconds: float
+
+    @property
+    def disk_written(self) -> int:
+        return max(0, self.peak_disk - self.start_disk)
+
+    @property
+    def output_bytes(self) -> int:
+        return max(0, self.end_disk - self.start_disk)
+
+
+def directory_usage(path: str) -> int:
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_blocks * 512
+            except FileNotFoundError:
+                # tools delete their temporary files while we walk
+                continue
+    return total
+
+
+def _container_memory(stats: dict) -> int:
+    memory_stats = stats.get("memory_stats", {})
+    if "max_usage" in memory_stats:
+        # cgroup v1 tracks the high-water mark for us
+        return memory_stats["max_usage"]
+    usage = memory_stats.get("usage", 0)
+    inactive_file = memory_stats.get("stats", {}).get("inactive_file", 0)
+    return max(0, usage - inactive_file)
+
+
+class ContainerMonitor(threading.Thread):
+    """
+    Follows a running container's stats stream, recording its peak memory and
+    the peak usage of the work directory it writes to.
+    """
+
+    def __init__(self, container, work_dir: str):
+        super().__init__(daemon=True)
+        self.container = container
+        self.work_dir = work_dir
+        self.peak_memory = 0
+        self.peak_disk = directory_usage(work_dir)
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        # the stream yields about once a second and ends with the container
+        for stats in self.container.stats(decode=True, stream=True):
+            if self.stopped.is_set():
+                return
+            self.peak_memory = max(self.peak_memory, _container_memory(stats))
+            self.peak_disk = max(self.peak_disk, directory_usage(self.work_dir))
+
+
+class StageProfiler:
+    """
+    Runs a job's containers through apiDockerCall while recording a
+    StageProfile for each, to be flushed to a ResourceProfileStore when the
+    job is done.
+    """
+
+    def __init__(self, job, store: Optional["ResourceProfileStore"]):
+        self.job = job
+        self.store = store
+        self.records: List[StageProfile] = []
+
+    def docker_call(
+        self,
+        *,
+        stage: Stage,
+        work_dir: str,
+        input_bytes: int,
+        reference_bytes: int = 0,
+        threads: int = 1,
+        **docker_kwargs,
+    ):
+        """
+        Same arguments and return value (the container's stdout) as
+        apiDockerCall, plus what the profile needs to know about the stage.
+        """
+        start_disk = directory_usage(work_dir)
+        start = time.monotonic()
+        container = apiDockerCall(self.job, detach=True, **docker_kwargs)
+        monitor = ContainerMonitor(container, work_dir)
+        monitor.start()
+        try:
+            exit_status = container.wait()["StatusCode"]
+            monitor.join()
+            wall_seconds = time.monotonic() - start
+
+            output = container.logs(stdout=True, stderr=False)
+            if exit_status != 0:
+                stderr = container.logs(stdout=False, stderr=True)
+                raise ContainerError(
+                    container,
+                    exit_status,
+                    docker_kwargs.get("parameters"),
+                    docker_kwargs.get("image"),
+                    stderr,
+                )
+        finally:
+            # also kills a container that is still running, which ends the
+            # monitor's stats stream
+            monitor.stop()
+            try:
+                container.remove(force=True)
+            except APIError as e:
+                self.job.log(f"failed to remove container {container.id}, {e}")
+            monitor.join()
+
+        record = StageProfile(
+            stage=stage.value,
+            input_bytes=input_bytes,
+            reference_bytes=reference_bytes,
+            threads=threads,
+            peak_memory=monitor.peak_memory,
+            start_disk=start_disk,
+            peak_disk=monitor.peak_disk,
+            end_disk=directory_usage(work_dir),
+            wall_seconds=wall_seconds,
+        )
+        self.job.log(f"{stage.value} used {record}")
+        self.records.append(record)
+        return output
+
+    def flush(self):
+        if self.store is not None and self.records:
+            self.store.append(self.records)
+        self.records = []
+
+
+@dataclass
+class ResourceProfileStore:
+    """
+    StageProfiles of past runs as JSON-lines objects under an S3 prefix, one
+    object per job since S3 objects can't be appended to.
+    """
+
+    url: str
+
+    @classmethod
+    def for_output(cls, s3_output: S3OutputLocation):
+        return ResourceProfileStore(url=s3_output.to_url("resource_profile"))
+
+    def append(self, records: List[StageProfile]):
+        bucket, prefix = parse_prefix_and_bucket(self.url)
+        body = "\n".join(json.dumps(dataclasses.asdict(r)) for r in records)
+        get_s3_client().put_object(
+            Bucket=bucket,
+            Key=f"{prefix.rstrip('/')}/{uuid.uuid4()}.jsonl",
+            Body=body.encode("utf-8"),
+        )
+
+    def load(self) -> List[StageProfile]:
+        bucket, prefix = parse_prefix_and_bucket(self.url)
+        client = get_s3_client()
+        records = []
+        for obj in list_s3_objects(bucket=bucket, prefix=f"{prefix.rstrip('/')}/"):
+            body = client.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read()
+            for line in body.decode("utf-8").splitlines():
+                if line.strip():
+                    records.append(StageProfile(**json.loads(line)))
+        return records
+
+
+def _upper_envelope(xs: List[float], ys: List[float]) -> (float, float):
+    """
+    Least-squares slope, with the intercept raised until the line is at or
+    above every observation.
+    """
+    n = len(xs)
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x == 0:
+        slope = 0.0
+    else:
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+    slope = max(0.0, slope)
+    intercept = max(0.0, max(y - slope * x for x, y in zip(xs, ys)))
+    return intercept, slope
+
+
+def fit_stage_model(
+    records: List[StageProfile], prior: StageResourceModel, headroom: float
+) -> StageResourceModel:
+    """
+    Refit a stage's base and per-input-byte terms to observed usage. The
+    reference and per-thread terms of the prior are kept and taken out of the
+    observations first, so the fit still applies when those change.
+    """
+    xs = [r.input_bytes for r in records]
+    memory = [
+        r.peak_memory
+        - prior.memory_per_reference * r.reference_bytes
+        - prior.memory_per_thread * max(0, r.threads - 1)
+        for r in records
+    ]
+    memory_base, memory_per_input = _upper_envelope(xs, memory)
+    disk_base, disk_per_input = _upper_envelope(xs, [r.disk_written for r in records])
+    _, output_per_input = _upper_envelope(xs, [r.output_bytes for r in records])
+    return dataclasses.replace(
+        prior,
+        memory_base=int(memory_base * headroom),
+        memory_per_input=memory_per_input * headroom,
+        disk_base=int(disk_base * headroom),
+        disk_per_input=disk_per_input * headroom,
+        output_per_input=output_per_input,
+    )
+
+
+def fit_resource_model(
+    history: List[StageProfile],
+    prior: ResourceModel,
+    *,
+    min_records: int = 3,
+    headroom: float = 1.1,
+) -> ResourceModel:
+    """
+    A ResourceModel whose stage estimators are refit to `history`. Stages with
+    fewer than `min_records` observations keep the prior's estimator.
+    """
+    stages = dict(prior.stages)
+    for stage in Stage:
+        records = [r for r in history if r.stage == stage.value]
+        if len(records) >= min_records:
+            stages[stage] = fit_stage_model(records, stages[stage], headroom)
+    return dataclasses.replace(prior, stages=stages)
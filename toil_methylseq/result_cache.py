@@ -0,0 +1,131 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import docker
+from botocore.exceptions import ClientError
+from toil.fileStores import FileID
+
+from aws_utils import parse_prefix_and_bucket
+from domain import ResultCacheSettings, S3OutputLocation, Stage
+from genome_cache import cache_key
+from transfer import get_s3_client
+
+
+class ResultCacheConsts:
+    manifest = "manifest.json"
+
+
+def image_digest(image: str) -> str:
+    """
+    The registry digest `image` currently resolves to, so a moved tag like
+    `latest` invalidates what was computed with the image it used to name.
+    """
+    if "@sha256:" in image:
+        return image.split("@", 1)[1]
+    return docker.from_env().images.get_registry_data(image).id
+
+
+@dataclass
+class StageResultCache:
+    """
+    Outputs of the stages of earlier runs as S3 objects under `url`, one
+    prefix per entry. An entry's key hashes everything its outputs depend on:
+    the stage, its parameters, the keys of its inputs (or the ETags of the
+    reads for sharding) and the digests of the images, so a run reuses
+    whatever an earlier one already computed the same way. The manifest of an
+    entry is written last, entries without one are incomplete.
+    """
+
+    url: str
+    image_digests: List[str]
+
+    @classmethod
+    def resolve(
+        cls,
+        settings: ResultCacheSettings,
+        *,
+        s3_output: S3OutputLocation,
+        images: List[str],
+    ) -> Optional["StageResultCache"]:
+        if not settings.enabled:
+            return None
+        url = settings.url or s3_output.sibling_url("stage_cache")
+        return StageResultCache(
+            url=url.rstrip("/"),
+            image_digests=[image_digest(image) for image in images],
+        )
+
+    def key(self, stage: Stage, parts: List[str]) -> str:
+        return cache_key([stage.value, *self.image_digests, *parts])
+
+    def _object_key(self, key: str, name: str) -> (str, str):
+        bucket, prefix = parse_prefix_and_bucket(self.url)
+        return bucket, f"{prefix}/{key}/{name}"
+
+    def _object_url(self, key: str, name: str) -> str:
+        return f"{self.url}/{key}/{name}"
+
+    def _manifest(self, key: str) -> Optional[Dict[str, str]]:
+        bucket, manifest_key = self._object_key(key, ResultCacheConsts.manifest)
+        try:
+            body = get_s3_client().get_object(Bucket=bucket, Key=manifest_key)["Body"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return json.loads(body.read().decode("utf-8"))["files"]
+
+    def contains(self, keys: List[str], concurrency: int = 32) -> Dict[str, bool]:
+        """
+        Which of `keys` have complete entries, checked concurrently.
+        """
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            manifests = list(pool.map(self._manifest, keys))
+        return {key: m is not None for key, m in zip(keys, manifests)}
+
+    def restore(self, job, key: str) -> Dict[str, FileID]:
+        """
+        Import the files of the entry at `key` into the file store, by the
+        names they were stored under.
+        """
+        manifest = self._manifest(key)
+        assert manifest is not None, f"missing result cache entry {key}"
+        return {
+            name: job.fileStore.importFile(self._object_url(key, object_name))
+            for name, object_name in manifest.items()
+        }
+
+    def store(self, job, key: str, files: Dict[str, FileID]):
+        # names may be anything, objects are numbered
+        manifest = {name: str(i) for i, name in enumerate(sorted(files))}
+        for name, object_name in manifest.items():
+            job.fileStore.exportFile(files[name], self._object_url(key, object_name))
+        bucket, manifest_key = self._object_key(key, ResultCacheConsts.manifest)
+        get_s3_client().put_object(
+            Bucket=bucket,
+            Key=manifest_key,
+            Body=json.dumps({"files": manifest}).encode("utf-8"),
+        )
+        job.log(f"stored {len(files)} files as result cache entry {key}")
+
+    def schedule_store(self, job, key: str, files: Dict[str, FileID]):
+        """
+        Store the entry from a follow-on of `job`, so it doesn't hold the
+        job's resources while it uploads.
+        """
+        job.addFollowOnJobFn(
+            store_stage_result,
+            name=f"store_{key[:12]}",
+            result_cache=self,
+            result_key=key,
+            files=files,
+            cores=1,
+        )
+
+
+def store_stage_result(
+    job, *, result_cache: StageResultCache, result_key: str, files: Dict[str, FileID]
+):
+    result_cache.store(job, result_key, files)
@@ -0,0 +1,246 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, List, Tuple
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+from domain import TransferSettings
+
+logger = logging.getLogger(__name__)
+
+_client_lock = threading.Lock()
+_clients = dict()
+
+
+def get_s3_client(max_pool_connections: int = TransferSettings.default_concurrency):
+    """
+    One S3 client per process and connection pool size. Clients are thread
+    safe, building them isn't, and every new client pays for its own
+    connection set up, so transfers share these.
+    """
+    with _client_lock:
+        client = _clients.get(max_pool_connections)
+        if client is None:
+            client = boto3.client(
+                "s3", config=Config(max_pool_connections=max_pool_connections)
+            )
+            _clients[max_pool_connections] = client
+        return client
+
+
+@dataclass
+class TransferStats:
+    url: str
+    size: int
+    seconds: float
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.size / self.seconds if self.seconds > 0 else float(self.size)
+
+    def __str__(self):
+        mib_per_second = self.bytes_per_second / (1024 * 1024)
+        return (
+            f"{self.url}: {self.size} bytes in {self.seconds:.1f}s "
+            f"({mib_per_second:.1f} MiB/s)"
+        )
+
+
+class FifoFeeder:
+    """
+    Copies an S3 object body into a named pipe. A fetch thread reads the body
+    into a bounded queue and a write thread drains it into the pipe, so the
+    network read runs ahead of the consumer by at most `buffer_bytes` and
+    neither side waits on the other's per-chunk latency.
+    """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(
+        self, *, client, bucket: str, key: str, fifo_path: str, buffer_bytes: int
+    ):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.fifo_path = fifo_path
+        self.chunks = queue.Queue(maxsize=max(1, buffer_bytes // self.chunk_size))
+        self.opened = threading.Event()
+        self.aborted = threading.Event()
+        self.errors = []
+        self.size = 0
+        self.start_time = None
+        self.threads = [
+            threading.Thread(target=self._fetch, daemon=True),
+            threading.Thread(target=self._write, daemon=True),
+        ]
+
+    def _put(self, item) -> bool:
+        while not self.aborted.is_set():
+            try:
+                self.chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fetch(self):
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=self.key)["Body"]
+            for chunk in body.iter_chunks(chunk_size=self.chunk_size):
+                if not self._put(chunk):
+                    return
+        except Exception as e:
+            self.errors.append(e)
+            self.aborted.set()
+        finally:
+            self._put(None)
+
+    def _write(self):
+        try:
+            with open(self.fifo_path, "wb") as fh:
+                self.opened.set()
+                while True:
+                    try:
+                        chunk = self.chunks.get(timeout=1)
+                    except queue.Empty:
+                        if self.aborted.is_set():
+                            return
+                        continue
+                    if chunk is None:
+                        return
+                    fh.write(chunk)
+                    self.size += len(chunk)
+        except BrokenPipeError as e:
+            if not self.aborted.is_set():
+                self.errors.append(e)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self.opened.set()
+            self.aborted.set()
+
+    def start(self):
+        os.mkfifo(self.fifo_path)
+        self.start_time = time.monotonic()
+        for thread in self.threads:
+            thread.start()
+
+    def abort(self):
+        self.aborted.set()
+        writer = self.threads[1]
+        while writer.is_alive() and not self.opened.is_set():
+            # the consumer never opened the pipe, open and close the read end
+            # so the writer's open() returns and it sees the broken pipe
+            fd = os.open(self.fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+            os.close(fd)
+            writer.join(timeout=0.1)
+
+    def join(self) -> TransferStats:
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+        return TransferStats(
+            url=f"s3://{self.bucket}/{self.key}",
+            size=self.size,
+            seconds=time.monotonic() - self.start_time,
+        )
+
+
+class S3TransferEngine:
+    """
+    Downloads (and uploads) S3 objects as ranged multipart requests spread over
+    a thread pool. Many-object transfers additionally run objects concurrently,
+    so small index files aren't bound by per-request latency.
+    """
+
+    def __init__(self, settings: TransferSettings = None):
+        self.settings = settings if settings is not None else TransferSettings()
+        self.client = get_s3_client(self.settings.concurrency)
+        self.transfer_config = TransferConfig(
+            multipart_threshold=self.settings.part_size,
+            multipart_chunksize=self.settings.part_size,
+            max_concurrency=self.settings.concurrency,
+            use_threads=True,
+        )
+
+    def download(self, *, bucket: str, key: str, destination: str) -> TransferStats:
+        start = time.monotonic()
+        self.client.download_file(bucket, key, destination, Config=self.transfer_config)
+        stats = TransferStats(
+            url=f"s3://{bucket}/{key}",
+            size=os.path.getsize(destination),
+            seconds=time.monotonic() - start,
+        )
+        logger.info(f"downloaded {stats}")
+        return stats
+
+    def download_many(self, work: List[Tuple[str, str, str]]) -> List[TransferStats]:
+        """
+        `work` is a list of (bucket, key, destination) tuples.
+        """
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.settings.concurrency) as pool:
+            results = list(
+                pool.map(
+                    lambda w: self.download(bucket=w[0], key=w[1], destination=w[2]),
+                    work,
+                )
+            )
+        total = TransferStats(
+            url=f"{len(work)} objects",
+            size=sum(r.size for r in results),
+            seconds=time.monotonic() - start,
+        )
+        logger.info(f"downloaded {total}")
+        return results
+
+    @contextmanager
+    def stream_to_fifo(
+        self, *, bucket: str, key: str, fifo_path: str
+    ) -> Iterator[FifoFeeder]:
+        """
+        Create a named pipe at `fifo_path` and stream the object into it while
+        the body of the `with` block runs a consumer that reads the pipe to
+        the end.
+        """
+        feeder = FifoFeeder(
+            client=self.client,
+            bucket=bucket,
+            key=key,
+            fifo_path=fifo_path,
+            buffer_bytes=self.settings.stream_buffer_bytes,
+        )
+        feeder.start()
+        try:
+            yield feeder
+            if not feeder.opened.is_set():
+                raise RuntimeError(f"nothing read from {fifo_path}")
+            stats = feeder.join()
+        except BaseException:
+            feeder.abort()
+            for thread in feeder.threads:
+                thread.join()
+            raise
+        finally:
+            os.remove(fifo_path)
+        logger.info(f"streamed {stats}")
+
+    def upload(self, *, source: str, bucket: str, key: str) -> TransferStats:
+        start = time.monotonic()
+        self.client.upload_file(source, bucket, key, Config=self.transfer_config)
+        stats = TransferStats(
+            url=f"s3://{bucket}/{key}",
+            size=os.path.getsize(source),
+            seconds=time.monotonic() - start,
+        )
+        logger.info(f"uploaded {stats}")
+        return stats